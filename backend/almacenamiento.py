@@ -0,0 +1,331 @@
+"""
+Almacenamiento de capturas por fecha (UTC): storage/capturas/AAAA/MM/DD/HH/<nombre>.
+
+Ningún directorio crece con el histórico (a lo sumo una hora de capturas por carpeta)
+y la retención trabaja por días completos, así que su costo no depende de cuántos
+meses se hayan acumulado.
+
+- La ruta relativa ("2025/03/14/09/vehicle_1741960800.jpg") es la identidad de la
+  captura: URL pública = PUBLIC_BASE_URL/<relativa>, y así se guarda en Imagen.ruta_archivo.
+- Los nombres antiguos sin carpeta (vehicle_<epoch>.jpg) se resuelven a su carpeta,
+  así que las URLs viejas siguen funcionando.
+- Los días retenidos se empaquetan en storage/archivo/AAAA/MM/AAAA-MM-DD.zip; abrir()
+  lee de ahí cuando el archivo ya no está en disco, y las URLs no cambian.
+
+    python almacenamiento.py --migrar                   # mueve las capturas planas a carpetas (una vez)
+    python almacenamiento.py --retener-dias 90          # empaqueta los días con todas sus predicciones
+    python almacenamiento.py --retener-dias 90 --modo eliminar
+"""
+import io
+import os
+import re
+import shutil
+import zipfile
+from datetime import date, datetime, timedelta
+from typing import Iterator, List, Optional, Tuple
+
+STORAGE_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "storage"))
+CAPTURA_DIR = os.path.join(STORAGE_DIR, "capturas")
+ARCHIVO_DIR = os.path.join(STORAGE_DIR, "archivo")
+
+# ✅ URL pública donde FastAPI sirve las capturas (main.py monta /capturas)
+PUBLIC_BASE_URL = "http://localhost:8000/capturas"
+
+EXTENSIONES = (".jpg", ".jpeg", ".png", ".webp")
+CAPTURAS_RETENCION_DIAS = int(os.getenv("CAPTURAS_RETENCION_DIAS", "90"))
+CAPTURAS_RETENCION_MODO = os.getenv("CAPTURAS_RETENCION_MODO", "archivar")
+LOTE_MIGRACION = 1000
+# retener() la toca al terminar; catalogo.sincronizar() vigila su mtime para soltar los días retenidos
+MARCA_RETENCION = os.path.join(CAPTURA_DIR, ".retencion")
+
+_EPOCH = re.compile(r"_(\d{9,11})\.[A-Za-z]+$")
+_DIGITOS = re.compile(r"^\d+$")
+
+
+def es_captura(nombre: str) -> bool:
+    return nombre.lower().endswith(EXTENSIONES) and not nombre.startswith(".")
+
+
+def carpeta(ts: float) -> str:
+    # Horas en UTC, como Imagen.fecha_subida; las carpetas anteriores están en hora local (ver resolver)
+    return datetime.utcfromtimestamp(ts).strftime("%Y/%m/%d/%H")
+
+
+def _carpeta_local(ts: float) -> str:
+    return datetime.fromtimestamp(ts).strftime("%Y/%m/%d/%H")
+
+
+def _ts_de_nombre(nombre: str) -> Optional[int]:
+    m = _EPOCH.search(nombre)
+    return int(m.group(1)) if m else None
+
+
+def relativa(nombre: str, ts: float) -> str:
+    return f"{carpeta(ts)}/{nombre}"
+
+
+def nueva_captura(nombre: str, ts: float) -> Tuple[str, str]:
+    """(relativa, ruta absoluta) para una captura nueva; crea la carpeta de su hora."""
+    rel = relativa(nombre, ts)
+    ruta = os.path.join(CAPTURA_DIR, rel)
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    return rel, ruta
+
+
+def validar(rel: str) -> str:
+    """Normaliza una ruta relativa; ValueError si sale de capturas o no es una captura."""
+    rel = rel.replace("\\", "/").strip("/")
+    partes = rel.split("/")
+    if not rel or any(p in ("", ".", "..") for p in partes) or not es_captura(partes[-1]):
+        raise ValueError(f"Ruta de captura inválida: {rel}")
+    return rel
+
+
+def absoluta(rel: str) -> str:
+    return os.path.join(CAPTURA_DIR, *validar(rel).split("/"))
+
+
+def url_publica(rel: str) -> str:
+    return f"{PUBLIC_BASE_URL}/{rel}"
+
+
+def relativa_desde_url(url: str) -> Optional[str]:
+    prefijo = PUBLIC_BASE_URL + "/"
+    return url[len(prefijo):] if url.startswith(prefijo) else None
+
+
+def resolver(rel: str) -> str:
+    """Ruta relativa vigente: un nombre plano antiguo se traduce a su carpeta si ya fue migrado."""
+    rel = validar(rel)
+    if "/" not in rel and not os.path.isfile(absoluta(rel)):
+        ts = _ts_de_nombre(rel)
+        if ts is not None:
+            # --migrar anterior al paso a UTC dejó la captura en la carpeta de su hora local
+            local = f"{_carpeta_local(ts)}/{rel}"
+            if not _existe(relativa(rel, ts)) and _existe(local):
+                return local
+            return relativa(rel, ts)
+    return rel
+
+
+def _existe(rel: str) -> bool:
+    if os.path.isfile(absoluta(rel)):
+        return True
+    dia = dia_de(rel)
+    if dia is None or not os.path.isfile(archivo_del_dia(dia)):
+        return False
+    with zipfile.ZipFile(archivo_del_dia(dia)) as zf:
+        return rel in zf.NameToInfo
+
+
+def archivo_del_dia(dia: date) -> str:
+    return os.path.join(ARCHIVO_DIR, f"{dia:%Y}", f"{dia:%m}", f"{dia:%Y-%m-%d}.zip")
+
+
+def carpeta_del_dia(dia: date) -> str:
+    return os.path.join(CAPTURA_DIR, f"{dia:%Y}", f"{dia:%m}", f"{dia:%d}")
+
+
+def dia_de(rel: str) -> Optional[date]:
+    partes = rel.split("/")
+    if len(partes) < 4:
+        return None
+    try:
+        return date(int(partes[0]), int(partes[1]), int(partes[2]))
+    except ValueError:
+        return None
+
+
+def abrir(rel: str):
+    """Archivo binario de la captura, desde disco o desde el zip de su día; FileNotFoundError si no existe."""
+    rel = resolver(rel)
+    ruta = absoluta(rel)
+    if os.path.isfile(ruta):
+        return open(ruta, "rb")
+    dia = dia_de(rel)
+    if dia is not None and os.path.isfile(archivo_del_dia(dia)):
+        with zipfile.ZipFile(archivo_del_dia(dia)) as zf:
+            try:
+                return io.BytesIO(zf.read(rel))
+            except KeyError:
+                pass
+    raise FileNotFoundError(rel)
+
+
+def firma(rel: str) -> Tuple[int, int]:
+    """(mtime en s, tamaño) de la captura, en disco o en el zip de su día; FileNotFoundError si no existe."""
+    rel = resolver(rel)
+    ruta = absoluta(rel)
+    if os.path.isfile(ruta):
+        st = os.stat(ruta)
+        return int(st.st_mtime), st.st_size
+    dia = dia_de(rel)
+    if dia is not None and os.path.isfile(archivo_del_dia(dia)):
+        with zipfile.ZipFile(archivo_del_dia(dia)) as zf:
+            try:
+                info = zf.getinfo(rel)
+            except KeyError:
+                pass
+            else:
+                return int(datetime(*info.date_time).timestamp()), info.file_size
+    raise FileNotFoundError(rel)
+
+
+def leer(rel: str) -> bytes:
+    with abrir(rel) as f:
+        return f.read()
+
+
+def _subdirs(directorio: str) -> List[str]:
+    try:
+        return sorted(n for n in os.listdir(directorio) if _DIGITOS.match(n))
+    except FileNotFoundError:
+        return []
+
+
+def dias() -> Iterator[Tuple[date, str]]:
+    """(día, carpeta) de cada día con capturas en disco, en orden."""
+    for anio in _subdirs(CAPTURA_DIR):
+        for mes in _subdirs(os.path.join(CAPTURA_DIR, anio)):
+            for dia in _subdirs(os.path.join(CAPTURA_DIR, anio, mes)):
+                try:
+                    yield date(int(anio), int(mes), int(dia)), os.path.join(CAPTURA_DIR, anio, mes, dia)
+                except ValueError:
+                    continue
+
+
+def _capturas_en(directorio: str) -> Iterator[Tuple[float, str]]:
+    for raiz, _, archivos in os.walk(directorio):
+        for nombre in archivos:
+            if es_captura(nombre):
+                ruta = os.path.join(raiz, nombre)
+                yield os.path.getmtime(ruta), os.path.relpath(ruta, CAPTURA_DIR).replace(os.sep, "/")
+
+
+def capturas_de_hora(ts: float) -> Iterator[Tuple[float, str]]:
+    """Capturas de la carpeta de la hora de `ts` (un solo directorio)."""
+    directorio = os.path.join(CAPTURA_DIR, *carpeta(ts).split("/"))
+    if os.path.isdir(directorio):
+        yield from _capturas_en(directorio)
+
+
+def marca_retencion() -> float:
+    """mtime de MARCA_RETENCION; 0 si nunca se retuvo nada."""
+    try:
+        return os.path.getmtime(MARCA_RETENCION)
+    except FileNotFoundError:
+        return 0.0
+
+
+def recorrer() -> Iterator[Tuple[float, str]]:
+    """(timestamp, relativa) de todas las capturas en disco, incluidas las planas sin migrar."""
+    if not os.path.isdir(CAPTURA_DIR):
+        return
+    with os.scandir(CAPTURA_DIR) as it:
+        for e in it:
+            if e.is_file() and es_captura(e.name):
+                yield e.stat().st_mtime, e.name
+    for _, directorio in dias():
+        yield from _capturas_en(directorio)
+
+
+# ======================
+# MIGRACIÓN Y RETENCIÓN
+# ======================
+def migrar(engine) -> int:
+    """Mueve las capturas planas a su carpeta y actualiza Imagen.ruta_archivo; devuelve cuántas movió."""
+    from sqlalchemy import text
+
+    planas = [e.name for e in os.scandir(CAPTURA_DIR) if e.is_file() and es_captura(e.name)]
+    movidas = 0
+    for i in range(0, len(planas), LOTE_MIGRACION):
+        cambios = []
+        for nombre in planas[i:i + LOTE_MIGRACION]:
+            origen = os.path.join(CAPTURA_DIR, nombre)
+            ts = _ts_de_nombre(nombre) or os.path.getmtime(origen)
+            rel, destino = nueva_captura(nombre, ts)
+            os.replace(origen, destino)
+            cambios.append({"n": nombre, "url": url_publica(rel)})
+        with engine.begin() as conn:
+            conn.execute(text("UPDATE imagenes SET ruta_archivo = :url WHERE filename_original = :n"), cambios)
+        movidas += len(cambios)
+        print(f"  → {movidas}/{len(planas)} capturas")
+    return movidas
+
+
+def _con_prediccion(engine, nombres: List[str]) -> set:
+    from sqlalchemy import bindparam, text
+
+    encontrados = set()
+    with engine.connect() as conn:
+        for i in range(0, len(nombres), LOTE_MIGRACION):
+            filas = conn.execute(
+                text(
+                    "SELECT i.filename_original FROM imagenes i JOIN predicciones p ON p.imagen_id = i.id "
+                    "WHERE i.filename_original IN :nombres"
+                ).bindparams(bindparam("nombres", expanding=True)),
+                {"nombres": nombres[i:i + LOTE_MIGRACION]},
+            )
+            encontrados.update(r[0] for r in filas)
+    return encontrados
+
+
+def retener(engine, dias_retencion: int = CAPTURAS_RETENCION_DIAS, modo: str = CAPTURAS_RETENCION_MODO) -> int:
+    """
+    Archiva (zip por día) o elimina los días anteriores a `dias_retencion` cuyas capturas
+    tienen todas predicción. Los días con capturas pendientes se dejan para la próxima vez.
+    """
+    from miniaturas import VARIANTES_DIR
+
+    limite = datetime.utcnow().date() - timedelta(days=dias_retencion)
+    procesados = 0
+    for dia, directorio in dias():
+        if dia >= limite:
+            break
+        capturas = [rel for _, rel in _capturas_en(directorio)]
+        pendientes = {rel.rsplit("/", 1)[-1] for rel in capturas} - _con_prediccion(
+            engine, [rel.rsplit("/", 1)[-1] for rel in capturas]
+        )
+        if pendientes:
+            print(f"⚠️ {dia}: {len(pendientes)} capturas sin predicción; se conserva")
+            continue
+        if modo == "archivar" and capturas:
+            destino = archivo_del_dia(dia)
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            # "a": un día retenido antes puede recibir capturas tardías
+            with zipfile.ZipFile(destino, "a", compression=zipfile.ZIP_DEFLATED) as zf:
+                existentes = set(zf.namelist())
+                for rel in capturas:
+                    if rel not in existentes:
+                        zf.write(absoluta(rel), rel)
+        print(f"  {'→' if modo == 'archivar' else '-'} {dia}: {len(capturas)} capturas")
+        shutil.rmtree(directorio)
+        shutil.rmtree(os.path.join(VARIANTES_DIR, *f"{dia:%Y/%m/%d}".split("/")), ignore_errors=True)
+        procesados += 1
+    if procesados:
+        with open(MARCA_RETENCION, "a"):
+            pass
+        os.utime(MARCA_RETENCION)
+    return procesados
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from db import engine
+
+    parser = argparse.ArgumentParser(description="Almacenamiento de capturas por fecha")
+    parser.add_argument("--migrar", action="store_true", help="Mueve las capturas planas a AAAA/MM/DD/HH")
+    parser.add_argument(
+        "--retener-dias", type=int, nargs="?", const=CAPTURAS_RETENCION_DIAS, metavar="N",
+        help=f"Retiene los días anteriores a N días (por defecto {CAPTURAS_RETENCION_DIAS})",
+    )
+    parser.add_argument("--modo", choices=["archivar", "eliminar"], default=CAPTURAS_RETENCION_MODO)
+    args = parser.parse_args()
+
+    if not args.migrar and args.retener_dias is None:
+        parser.error("Indique --migrar y/o --retener-dias N")
+    if args.migrar:
+        print(f"✅ {migrar(engine)} capturas migradas")
+    if args.retener_dias is not None:
+        print(f"✅ {retener(engine, args.retener_dias, args.modo)} días retenidos ({args.modo})")
@@ -1,13 +1,23 @@
-from fastapi import APIRouter, Body, Depends, HTTPException
+from fastapi import APIRouter, Body, Depends, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from typing import List, Optional
+from sqlalchemy import and_, or_, select
+from typing import List, Optional, Tuple
 from pydantic import BaseModel
-from datetime import datetime, date
-
-from cnn_queue import start_queue, get_status
+from datetime import datetime, date, timedelta
+import base64
+import orjson
+
+from cnn_queue import solicitar_cola, estado_compartido
+from analisis_jobs import iniciar_analisis_hoy, obtener_job, cancelar_job
+from geocoding import obtener_o_crear_ubicacion
+import eventos
+import exportacion
+from placas import normalizar_placa
 from auth import get_current_user
-from db import get_db, Usuario, Imagen, Prediccion, Ubicacion
+from db import get_async_db, get_async_read_db, ReadSessionLocal, Usuario, Imagen, Prediccion
 
 router = APIRouter()
 
@@ -30,61 +40,183 @@ class AnalisisItem(BaseModel):
     fecha_prediccion: str
 
 
+CAMPOS_ANALISIS = list(AnalisisItem.__fields__.keys())
+LIMITE_EMISIONES_MAX = 1000
+
+
+def _encode_cursor(fecha: datetime, pred_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{fecha.isoformat()}|{pred_id}".encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        fecha, pred_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(fecha), int(pred_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+
+def _row_to_dict(row, campos: List[str]) -> dict:
+    item = {
+        "id": row.id,
+        "imagen_id": row.id,
+        "filename_original": row.filename_original,
+        "ruta_archivo": row.ruta_archivo,
+        "placa_manual": row.placa_manual,
+        "clase_predicha": row.clase_predicha,
+        "confianza": float(row.confianza),
+        "p_smog": float(row.p_smog),
+        "observacion": row.observacion,
+        "fecha_prediccion": row.fecha_prediccion.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    return {c: item[c] for c in campos}
+
+
 @router.get("/emisiones", response_model=List[AnalisisItem])
 async def obtener_analisis_emisiones(
     current_user: Usuario = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_read_db),
+    limit: int = Query(100, ge=1, le=LIMITE_EMISIONES_MAX),
+    cursor: Optional[str] = Query(None, description="Valor de X-Next-Cursor de la página anterior"),
+    desde: Optional[date] = Query(None, description="YYYY-MM-DD"),
+    hasta: Optional[date] = Query(None, description="YYYY-MM-DD"),
+    clase: Optional[str] = Query(None, description="smog | sin_smog"),
+    p_smog_min: Optional[float] = Query(None, ge=0, le=1),
+    p_smog_max: Optional[float] = Query(None, ge=0, le=1),
+    ubicacion_id: Optional[int] = None,
+    placa: Optional[str] = Query(None, description="Prefijo de placa"),
+    campos: Optional[str] = Query(None, description="Campos separados por coma"),
+    formato: str = Query("json", regex="^(json|ndjson)$"),
 ):
-    results = (
-        db.query(
-            Imagen.id,
-            Imagen.filename_original,
-            Imagen.ruta_archivo,
-            Imagen.placa_manual,
-            Prediccion.clase_predicha,
-            Prediccion.confianza,
-            Prediccion.p_smog,
-            Prediccion.observacion,
-            Prediccion.fecha_prediccion,
-        )
-        .join(Prediccion, Imagen.id == Prediccion.imagen_id)
-        .all()
-    )
-
-    analisis_items: List[AnalisisItem] = []
-    for row in results:
-        analisis_items.append(
-            AnalisisItem(
-                id=row.id,
-                imagen_id=row.id,
-                filename_original=row.filename_original,
-                ruta_archivo=row.ruta_archivo,
-                placa_manual=row.placa_manual,
-                clase_predicha=row.clase_predicha,
-                confianza=float(row.confianza),
-                p_smog=float(row.p_smog),
-                observacion=row.observacion,
-                fecha_prediccion=row.fecha_prediccion.strftime("%Y-%m-%d %H:%M:%S"),
+    """
+    Predicciones más recientes primero, paginadas por cursor sobre (fecha_prediccion, id).
+    El cursor de la página siguiente va en la cabecera X-Next-Cursor.
+    formato=ndjson transmite todas las filas filtradas (desde el cursor) como JSON por línea.
+    """
+    seleccion = CAMPOS_ANALISIS
+    if campos:
+        seleccion = [c.strip() for c in campos.split(",") if c.strip()]
+        desconocidos = [c for c in seleccion if c not in CAMPOS_ANALISIS]
+        if desconocidos:
+            raise HTTPException(status_code=400, detail=f"Campos desconocidos: {', '.join(desconocidos)}")
+    # Se valida aquí y no dentro de build_query: en ndjson la consulta corre ya con la respuesta iniciada
+    posicion = _decode_cursor(cursor) if cursor else None
+
+    def build_query(session: Session):
+        q = (
+            session.query(
+                Imagen.id,
+                Imagen.filename_original,
+                Imagen.ruta_archivo,
+                Imagen.placa_manual,
+                Prediccion.id.label("prediccion_id"),
+                Prediccion.clase_predicha,
+                Prediccion.confianza,
+                Prediccion.p_smog,
+                Prediccion.observacion,
+                Prediccion.fecha_prediccion,
             )
+            .join(Prediccion, Imagen.id == Prediccion.imagen_id)
         )
-    return analisis_items
+        if desde is not None:
+            q = q.filter(Prediccion.fecha_prediccion >= datetime.combine(desde, datetime.min.time()))
+        if hasta is not None:
+            q = q.filter(Prediccion.fecha_prediccion < datetime.combine(hasta + timedelta(days=1), datetime.min.time()))
+        if clase:
+            q = q.filter(Prediccion.clase_predicha == clase)
+        if p_smog_min is not None:
+            q = q.filter(Prediccion.p_smog >= p_smog_min)
+        if p_smog_max is not None:
+            q = q.filter(Prediccion.p_smog <= p_smog_max)
+        if ubicacion_id is not None:
+            q = q.filter(Imagen.ubicacion_id == ubicacion_id)
+        if placa:
+            q = q.filter(Imagen.placa_normalizada.like(f"{normalizar_placa(placa) or ''}%"))
+        if posicion:
+            fecha_c, id_c = posicion
+            q = q.filter(
+                or_(
+                    Prediccion.fecha_prediccion < fecha_c,
+                    and_(Prediccion.fecha_prediccion == fecha_c, Prediccion.id < id_c),
+                )
+            )
+        return q.order_by(Prediccion.fecha_prediccion.desc(), Prediccion.id.desc())
+
+    if formato == "ndjson":
+        # Sesión propia: el generador sigue corriendo después de que la ruta retorna
+        session = ReadSessionLocal()
+        try:
+            query = build_query(session)
+        except Exception:
+            session.close()
+            raise
+
+        def stream():
+            try:
+                for row in query.yield_per(1000):
+                    yield orjson.dumps(_row_to_dict(row, seleccion)) + b"\n"
+            finally:
+                session.close()
+
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+    rows = await db.run_sync(lambda session: build_query(session).limit(limit + 1).all())
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        headers["X-Next-Cursor"] = _encode_cursor(last.fecha_prediccion, last.prediccion_id)
+
+    # Se serializa directamente con orjson, sin construir un AnalisisItem por fila
+    return ORJSONResponse([_row_to_dict(row, seleccion) for row in rows], headers=headers)
+
+
+@router.get("/exportar")
+async def exportar_predicciones(
+    current_user: Usuario = Depends(get_current_user),
+    formato: Optional[str] = Query(None, regex="^(parquet|arrow|csv)$", description="Por defecto parquet si hay pyarrow, si no csv"),
+    desde: Optional[date] = Query(None, description="YYYY-MM-DD"),
+    hasta: Optional[date] = Query(None, description="YYYY-MM-DD"),
+    campos: Optional[str] = Query(None, description="Columnas separadas por coma"),
+):
+    """
+    Exporta imagenes + predicciones + ubicaciones en streaming (Parquet, Arrow IPC o CSV).
+    Se leen y escriben lotes de tamaño fijo, así que la memoria no crece con el rango.
+    """
+    formato = formato or exportacion.formato_por_defecto()
+    if formato != "csv" and not exportacion.pyarrow_disponible():
+        raise HTTPException(status_code=501, detail="Parquet/Arrow requieren pyarrow en el servidor; use formato=csv")
+    try:
+        columnas = exportacion.validar_columnas(campos)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    media_type, extension = exportacion.FORMATOS[formato]
+    nombre = f"predicciones_{desde or 'inicio'}_{hasta or 'hoy'}.{extension}"
+    return StreamingResponse(
+        exportacion.exportar(formato, columnas, desde, hasta),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{nombre}"'},
+    )
 
 
 @router.post("/analizar/{imagen_id}")
 async def analizar_con_ia(
     imagen_id: int,
     current_user: Usuario = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    imagen = db.query(Imagen).filter(Imagen.id == imagen_id).first()
+    imagen = await db.get(Imagen, imagen_id)
     if not imagen:
         raise HTTPException(status_code=404, detail="Imagen no encontrada")
 
-    prediccion = db.query(Prediccion).filter(Prediccion.imagen_id == imagen_id).first()
+    result = await db.execute(select(Prediccion).where(Prediccion.imagen_id == imagen_id).limit(1))
+    prediccion = result.scalars().first()
     if not prediccion:
         raise HTTPException(status_code=404, detail="Predicción no encontrada para esta imagen")
 
     from openai_service import analizar_imagen_openai
+    from rate_limit import CircuitOpenError
 
     try:
         resultado = await analizar_imagen_openai(imagen.ruta_archivo)
@@ -97,52 +229,33 @@ async def analizar_con_ia(
         if resultado.get("placa") and resultado["placa"] != "undefined":
             imagen.placa_manual = resultado["placa"]
 
-        db.commit()
+        await db.commit()
+        await run_in_threadpool(eventos.publicar, "enriquecimiento_completado", {
+            "imagen_id": imagen_id,
+            "clase_predicha": prediccion.clase_predicha,
+            "p_smog": prediccion.p_smog,
+            "placa": imagen.placa_manual,
+        })
         return {"message": "Análisis completado y actualizado", "resultado": resultado}
 
+    except CircuitOpenError as e:
+        await db.rollback()
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"Error en el análisis con IA: {str(e)}")
 
 
-async def _reverse_geocode_nombre(lat: float, lng: float) -> Optional[str]:
-    """Obtiene dirección desde Nominatim (OpenStreetMap)."""
-    try:
-        import httpx
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            r = await client.get(
-                "https://nominatim.openstreetmap.org/reverse",
-                params={"lat": lat, "lon": lng, "format": "json"},
-                headers={"User-Agent": "PiscoNawi-App/1.0"},
-            )
-            if r.status_code != 200:
-                return None
-            data = r.json()
-            return data.get("display_name") or None
-    except Exception:
-        return None
-
-
 @router.post("/procesar-cnn")
 async def procesar_cnn(
     current_user: Usuario = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     body: ProcesarCnnBody = Body(...),
 ):
-    # ✅ SOLO direccion (sin nombre)
-    direccion = await _reverse_geocode_nombre(body.lat, body.lng)
-
-    ub = Ubicacion(
-        latitud=body.lat,
-        longitud=body.lng,
-        direccion=direccion.strip() if direccion else None,
-    )
+    # Reutiliza una ubicación cercana; la dirección sale de caché o se completa en segundo plano
+    ub = await db.run_sync(obtener_o_crear_ubicacion, body.lat, body.lng)
 
-    db.add(ub)
-    db.commit()
-    db.refresh(ub)
-
-    start_queue(ubicacion_id=ub.id)
+    await run_in_threadpool(solicitar_cola, ub.id)
     return {
         "message": "Procesamiento CNN iniciado (FIFO 1 por 1)",
         "ubicacion_id": ub.id
@@ -151,81 +264,40 @@ async def procesar_cnn(
 
 @router.get("/estado-cnn")
 async def estado_cnn(current_user: Usuario = Depends(get_current_user)):
-    return get_status()
+    return await run_in_threadpool(estado_compartido)
 
 
-class BulkAnalysisResult(BaseModel):
+class AnalisisJobStatus(BaseModel):
+    job_id: str
+    estado: str
+    total: int
+    omitidas: int
     processed_count: int
     success_count: int
     failed_count: int
     errors: List[str]
+    creado_en: str
+    finalizado_en: Optional[str]
 
 
-@router.post("/analizar-todas-hoy", response_model=BulkAnalysisResult)
-async def analizar_todas_imagenes_hoy(
-    current_user: Usuario = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
-    today = date.today()
-    start_of_day = datetime.combine(today, datetime.min.time())
-
-    images_with_predictions = db.query(Imagen).join(Prediccion).filter(
-        Imagen.fecha_subida >= start_of_day
-    ).all()
-
-    if not images_with_predictions:
-        return BulkAnalysisResult(
-            processed_count=0,
-            success_count=0,
-            failed_count=0,
-            errors=["No hay imágenes para analizar hoy"]
-        )
-
-    processed_count = 0
-    success_count = 0
-    failed_count = 0
-    errors = []
-
-    from openai_service import analizar_imagen_openai
-
-    for imagen in images_with_predictions:
-        processed_count += 1
-        try:
-            prediccion = db.query(Prediccion).filter(Prediccion.imagen_id == imagen.id).first()
-            if not prediccion:
-                failed_count += 1
-                errors.append(f"Predicción no encontrada para imagen {imagen.id}")
-                continue
+@router.post("/analizar-todas-hoy", response_model=AnalisisJobStatus, status_code=202)
+async def analizar_todas_imagenes_hoy(current_user: Usuario = Depends(get_current_user)):
+    """Inicia el análisis de las imágenes de hoy en segundo plano y retorna el ID del trabajo."""
+    # Consulta las imágenes del día con la sesión síncrona del módulo de trabajos
+    return await run_in_threadpool(iniciar_analisis_hoy)
 
-            resultado = await analizar_imagen_openai(imagen.ruta_archivo)
 
-            prediccion.clase_predicha = "smog" if resultado["smog_visible"] else "sin_smog"
-            prediccion.confianza = resultado["nivel_confianza"] / 100.0
-            prediccion.p_smog = resultado["porcentaje_smog"] / 100.0
-            prediccion.observacion = resultado["descripcion_corta"]
-            prediccion.fecha_prediccion = func.now()
+@router.get("/jobs/{job_id}", response_model=AnalisisJobStatus)
+async def estado_job_analisis(job_id: str, current_user: Usuario = Depends(get_current_user)):
+    job = await run_in_threadpool(obtener_job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return job
 
-            if resultado.get("placa") and resultado["placa"] != "undefined":
-                imagen.placa_manual = resultado["placa"]
 
-            success_count += 1
-
-        except Exception as e:
-            failed_count += 1
-            error_msg = str(e) if str(e) else f"Error desconocido (tipo: {type(e).__name__})"
-            errors.append(f"Error procesando imagen {imagen.id}: {error_msg}")
-            db.rollback()
-            continue
-
-    try:
-        db.commit()
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=500, detail=f"Error guardando cambios: {str(e)}")
-
-    return BulkAnalysisResult(
-        processed_count=processed_count,
-        success_count=success_count,
-        failed_count=failed_count,
-        errors=errors
-    )
+@router.post("/jobs/{job_id}/cancelar", response_model=AnalisisJobStatus)
+async def cancelar_job_analisis(job_id: str, current_user: Usuario = Depends(get_current_user)):
+    job = await run_in_threadpool(cancelar_job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return job
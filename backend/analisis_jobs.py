@@ -0,0 +1,330 @@
+import asyncio
+import json
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from db import SessionLocal, AnalisisReserva, AnalisisTrabajo, Imagen, Prediccion, engine
+import eventos
+
+# ======================
+# CONFIGURACIÓN
+# ======================
+# Paquetes de imágenes analizados en paralelo dentro de un mismo trabajo
+JOB_CONCURRENCY = max(1, int(os.getenv("ANALISIS_JOB_CONCURRENCY", "3")))
+# Trabajos finalizados que se conservan en la tabla analisis_trabajos para consulta
+MAX_JOBS_FINALIZADOS = 50
+# Una reserva más antigua que esto es de un trabajo cuyo proceso murió: otra corrida puede tomarla
+ANALISIS_RESERVA_HORAS = float(os.getenv("ANALISIS_RESERVA_HORAS", "6"))
+
+# ======================
+# ESTADO GLOBAL
+# ======================
+# El proceso que ejecuta un trabajo lleva sus contadores en memoria y los vuelca en
+# analisis_trabajos tras cada paquete; consultas y cancelaciones van a la tabla, así
+# que funcionan desde cualquier worker.
+_lock = threading.Lock()
+
+
+class AnalisisJob:
+    def __init__(self, job_id: str, imagen_ids: List[int], omitidas: int):
+        self.id = job_id
+        self.imagen_ids = imagen_ids
+        self.estado = "pendiente"  # pendiente | en_curso | completado | cancelado | error
+        self.total = len(imagen_ids)
+        self.omitidas = omitidas
+        self.processed_count = 0
+        self.success_count = 0
+        self.failed_count = 0
+        self.errors: List[str] = []
+        self.cancelar = False
+        self.creado_en = datetime.utcnow()
+        self.finalizado_en: Optional[datetime] = None
+
+    def fila(self) -> Dict:
+        """Columnas de analisis_trabajos (todas salvo id y cancelar); llamar con _lock tomado."""
+        return {
+            "estado": self.estado,
+            "total": self.total,
+            "omitidas": self.omitidas,
+            "processed_count": self.processed_count,
+            "success_count": self.success_count,
+            "failed_count": self.failed_count,
+            "errors": json.dumps(self.errors),
+            "creado_en": self.creado_en,
+            "finalizado_en": self.finalizado_en,
+        }
+
+
+def _a_dict(fila) -> Dict:
+    return {
+        "job_id": fila.id,
+        "estado": fila.estado,
+        "total": fila.total,
+        "omitidas": fila.omitidas,
+        "processed_count": fila.processed_count,
+        "success_count": fila.success_count,
+        "failed_count": fila.failed_count,
+        "errors": json.loads(fila.errors),
+        "creado_en": fila.creado_en.strftime("%Y-%m-%d %H:%M:%S"),
+        "finalizado_en": fila.finalizado_en.strftime("%Y-%m-%d %H:%M:%S") if fila.finalizado_en else None,
+    }
+
+
+def _guardar(job: AnalisisJob, nuevo: bool = False) -> None:
+    """Vuelca el estado del trabajo en analisis_trabajos (sin tocar la marca de cancelación)."""
+    tabla = AnalisisTrabajo.__table__
+    with _lock:
+        fila = job.fila()
+    with engine.begin() as conn:
+        if nuevo:
+            conn.execute(insert(tabla).values(id=job.id, cancelar=False, **fila))
+        else:
+            conn.execute(update(tabla).where(tabla.c.id == job.id).values(**fila))
+
+
+def _cancelacion_pedida(job: AnalisisJob) -> bool:
+    """Lee la marca de cancelación (la pone cancelar_job desde cualquier worker)."""
+    if not job.cancelar:
+        tabla = AnalisisTrabajo.__table__
+        with engine.connect() as conn:
+            job.cancelar = bool(conn.execute(select(tabla.c.cancelar).where(tabla.c.id == job.id)).scalar())
+    return job.cancelar
+
+
+def _imagenes_de_hoy() -> List[int]:
+    today = datetime.utcnow().date()  # fecha_subida está en UTC
+    start_of_day = datetime.combine(today, datetime.min.time())
+    db = SessionLocal()
+    try:
+        rows = (
+            db.query(Imagen.id)
+            .join(Prediccion)
+            .filter(Imagen.fecha_subida >= start_of_day)
+            .order_by(Imagen.id)
+            .all()
+        )
+        return [r.id for r in rows]
+    finally:
+        db.close()
+
+
+def _reservar(job_id: str, imagen_ids: List[int]) -> List[int]:
+    """
+    Reserva en la tabla analisis_reservas las imágenes que ningún otro trabajo (de este
+    u otro worker) tiene tomadas; devuelve las obtenidas, en el orden recibido.
+    """
+    if not imagen_ids:
+        return []
+    tabla = AnalisisReserva.__table__
+    ahora = datetime.utcnow()
+    with engine.begin() as conn:
+        conn.execute(delete(tabla).where(tabla.c.creado_en < ahora - timedelta(hours=ANALISIS_RESERVA_HORAS)))
+        # IGNORE: las ya reservadas chocan con la clave primaria y se saltan
+        conn.execute(
+            mysql_insert(tabla).prefix_with("IGNORE"),
+            [{"imagen_id": i, "job_id": job_id, "creado_en": ahora} for i in imagen_ids],
+        )
+        obtenidas = set(conn.execute(select(tabla.c.imagen_id).where(tabla.c.job_id == job_id)).scalars())
+    return [i for i in imagen_ids if i in obtenidas]
+
+
+def _liberar(job_id: str) -> None:
+    tabla = AnalisisReserva.__table__
+    with engine.begin() as conn:
+        conn.execute(delete(tabla).where(tabla.c.job_id == job_id))
+
+
+def _registrar_error(job: AnalisisJob, imagen_id: int, error: Exception):
+    error_msg = str(error) if str(error) else f"Error desconocido (tipo: {type(error).__name__})"
+    with _lock:
+        job.failed_count += 1
+        job.errors.append(f"Error procesando imagen {imagen_id}: {error_msg}")
+
+
+async def _procesar_paquete(job: AnalisisJob, imagen_ids: List[int], sem: asyncio.Semaphore):
+    async with sem:
+        if await asyncio.to_thread(_cancelacion_pedida, job):
+            return
+        # Sesión propia: el commit o rollback de un paquete no arrastra los cambios de otro
+        db = SessionLocal()
+        try:
+            await _analizar_paquete(job, db, imagen_ids)
+        finally:
+            db.close()
+
+
+async def _analizar_paquete(job: AnalisisJob, db, imagen_ids: List[int]):
+    from openai_service import analizar_imagenes_openai
+
+    imagenes = {
+        img.id: img for img in db.query(Imagen).filter(Imagen.id.in_(imagen_ids)).all()
+    }
+    pares = []
+    for imagen_id in imagen_ids:
+        imagen = imagenes.get(imagen_id)
+        if imagen is None or imagen.prediccion is None:
+            with _lock:
+                job.processed_count += 1
+                job.failed_count += 1
+                job.errors.append(f"Predicción no encontrada para imagen {imagen_id}")
+            continue
+        pares.append((imagen, imagen.prediccion))
+
+    try:
+        resultados = await analizar_imagenes_openai(
+            [imagen.ruta_archivo for imagen, _ in pares], tamano_lote=len(pares) or None
+        )
+    except Exception as e:
+        resultados = [e] * len(pares)
+
+    enriquecidas = []
+    for (imagen, prediccion), resultado in zip(pares, resultados):
+        try:
+            if isinstance(resultado, Exception):
+                raise resultado
+
+            prediccion.clase_predicha = "smog" if resultado["smog_visible"] else "sin_smog"
+            prediccion.confianza = resultado["nivel_confianza"] / 100.0
+            prediccion.p_smog = resultado["porcentaje_smog"] / 100.0
+            prediccion.observacion = resultado["descripcion_corta"]
+            prediccion.fecha_prediccion = datetime.utcnow()
+
+            if resultado.get("placa") and resultado["placa"] != "undefined":
+                imagen.placa_manual = resultado["placa"]
+
+            enriquecidas.append({
+                "imagen_id": imagen.id,
+                "clase_predicha": prediccion.clase_predicha,
+                "p_smog": prediccion.p_smog,
+                "placa": imagen.placa_manual,
+                "job_id": job.id,
+            })
+        except Exception as e:
+            _registrar_error(job, imagen.id, e)
+
+    exitos = len(enriquecidas)
+    # Commit por paquete: los resultados parciales quedan guardados aunque el trabajo se cancele
+    try:
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        with _lock:
+            job.failed_count += exitos
+            job.errors.append(f"Error guardando cambios del paquete {imagen_ids}: {str(e)}")
+        exitos = 0
+    else:
+        await asyncio.to_thread(eventos.publicar_varios, "enriquecimiento_completado", enriquecidas)
+
+    with _lock:
+        job.processed_count += len(pares)
+        job.success_count += exitos
+    await asyncio.to_thread(_guardar, job)
+
+
+async def _ejecutar(job: AnalisisJob):
+    from openai_service import OPENAI_BATCH_SIZE
+
+    sem = asyncio.Semaphore(JOB_CONCURRENCY)
+    paquetes = [
+        job.imagen_ids[i:i + OPENAI_BATCH_SIZE]
+        for i in range(0, len(job.imagen_ids), OPENAI_BATCH_SIZE)
+    ]
+    await asyncio.gather(*(_procesar_paquete(job, p, sem) for p in paquetes))
+
+
+def _worker(job: AnalisisJob):
+    try:
+        cancelado = _cancelacion_pedida(job)
+        with _lock:
+            job.estado = "cancelado" if cancelado else "en_curso"
+        _guardar(job)
+        if job.estado == "en_curso":
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(_ejecutar(job))
+            finally:
+                loop.close()
+        with _lock:
+            job.estado = "cancelado" if job.cancelar else "completado"
+    except Exception as e:
+        print("❌ Error en trabajo de análisis:", str(e))
+        with _lock:
+            job.estado = "error"
+            job.errors.append(f"Error general: {str(e)}")
+    finally:
+        try:
+            _liberar(job.id)
+        except Exception as e:
+            # Si no se puede, la reserva vence sola tras ANALISIS_RESERVA_HORAS
+            print(f"⚠️ No se pudieron liberar las imágenes del trabajo {job.id}: {e}")
+        with _lock:
+            job.finalizado_en = datetime.utcnow()
+        try:
+            _guardar(job)
+        except Exception as e:
+            print(f"⚠️ No se pudo guardar el estado final del trabajo {job.id}: {e}")
+        print(
+            f"✅ Trabajo de análisis {job.id} {job.estado}: "
+            f"{job.success_count} exitosos, {job.failed_count} fallidos"
+        )
+
+
+def _purgar_finalizados():
+    """Borra los trabajos finalizados más antiguos; se conservan los últimos MAX_JOBS_FINALIZADOS."""
+    tabla = AnalisisTrabajo.__table__
+    with engine.begin() as conn:
+        limite = conn.execute(
+            select(tabla.c.finalizado_en)
+            .where(tabla.c.finalizado_en.isnot(None))
+            .order_by(tabla.c.finalizado_en.desc())
+            .offset(MAX_JOBS_FINALIZADOS - 1)
+            .limit(1)
+        ).scalar()
+        if limite is not None:
+            conn.execute(delete(tabla).where(tabla.c.finalizado_en < limite))
+
+
+def iniciar_analisis_hoy() -> Dict:
+    """
+    Crea un trabajo en segundo plano para analizar las imágenes de hoy y retorna su estado inicial.
+    Las imágenes ya reservadas por otro trabajo en curso (en cualquier worker) se omiten.
+    """
+    imagen_ids = _imagenes_de_hoy()
+    job_id = uuid.uuid4().hex
+    libres = _reservar(job_id, imagen_ids)
+
+    job = AnalisisJob(job_id, libres, omitidas=len(imagen_ids) - len(libres))
+    if not imagen_ids:
+        job.errors.append("No hay imágenes para analizar hoy")
+    elif not libres:
+        job.errors.append("Las imágenes de hoy ya están siendo analizadas por otro trabajo")
+    _purgar_finalizados()
+    _guardar(job, nuevo=True)
+    estado = obtener_job(job.id)
+
+    t = threading.Thread(target=_worker, args=(job,), daemon=True)
+    t.start()
+    return estado
+
+
+def obtener_job(job_id: str) -> Optional[Dict]:
+    tabla = AnalisisTrabajo.__table__
+    with engine.connect() as conn:
+        fila = conn.execute(select(tabla).where(tabla.c.id == job_id)).first()
+    return _a_dict(fila) if fila else None
+
+
+def cancelar_job(job_id: str) -> Optional[Dict]:
+    """Marca el trabajo para cancelación; los paquetes en curso terminan, los pendientes no inician."""
+    tabla = AnalisisTrabajo.__table__
+    with engine.begin() as conn:
+        conn.execute(
+            update(tabla).where(tabla.c.id == job_id, tabla.c.finalizado_en.is_(None)).values(cancelar=True)
+        )
+    return obtener_job(job_id)
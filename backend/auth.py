@@ -1,24 +1,37 @@
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Optional
-from fastapi import Depends, HTTPException, status
+from typing import Optional, Tuple
+import threading
+import time
+from fastapi import Depends, HTTPException, Query, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy import event, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel
 import os
 from dotenv import load_dotenv
 
-from db import get_db, Usuario
+import metrics
+from db import get_async_db, AppSession, Usuario
+from report_cache import SharedVersion
 
 load_dotenv()
 
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-here")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 43200  # 30 days in minutes
+# Caché de usuarios resueltos por get_current_user (clave: `sub` del token)
+AUTH_USER_CACHE_TTL = float(os.getenv("AUTH_USER_CACHE_TTL", "60"))
+AUTH_USER_CACHE_SIZE = int(os.getenv("AUTH_USER_CACHE_SIZE", "1024"))
+# Cada cuánto relee cada proceso la versión compartida de usuarios (cambios hechos en otro worker)
+AUTH_USER_VERSION_VIGENCIA = float(os.getenv("AUTH_USER_VERSION_VIGENCIA", "1"))
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
+security_opcional = HTTPBearer(auto_error=False)
 
 class Token(BaseModel):
     access_token: str
@@ -37,11 +50,85 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
-def authenticate_user(db: Session, username: str, password: str):
-    user = db.query(Usuario).filter(Usuario.username == username).first()
+# (vence, versión de usuarios con la que se leyó, usuario). La versión vive en estado_compartido:
+# un cambio de usuario en cualquier worker la incrementa y deja sin efecto las entradas de todos
+_usuarios: "OrderedDict[str, Tuple[float, int, Usuario]]" = OrderedDict()
+_usuarios_lock = threading.Lock()
+_version = SharedVersion(AUTH_USER_VERSION_VIGENCIA, clave="usuarios_version")
+
+
+def _cache_get(username: str, version: int) -> Optional[Usuario]:
+    with _usuarios_lock:
+        entry = _usuarios.get(username)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic() or entry[1] != version:
+            del _usuarios[username]
+            return None
+        _usuarios.move_to_end(username)
+        return entry[2]
+
+
+def _cache_put(username: str, version: int, user: Usuario) -> None:
+    with _usuarios_lock:
+        _usuarios[username] = (time.monotonic() + AUTH_USER_CACHE_TTL, version, user)
+        _usuarios.move_to_end(username)
+        while len(_usuarios) > AUTH_USER_CACHE_SIZE:
+            _usuarios.popitem(last=False)
+
+
+def invalidar_usuario(username: str) -> None:
+    with _usuarios_lock:
+        _usuarios.pop(username, None)
+
+
+def _before_flush(session, flush_context, instances) -> None:
+    # Cualquier cambio o borrado de un usuario lo saca de la caché (con su username anterior)
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Usuario):
+            hist = inspect(obj).attrs.username.history
+            for username in [obj.username, *hist.deleted]:
+                invalidar_usuario(username)
+            session.info["auth_usuarios_modificados"] = True
+
+
+def _incrementar_version() -> None:
+    try:
+        _version.incr()
+    except Exception as e:
+        print(f"⚠️ No se pudo incrementar la versión de usuarios: {e}")
+
+
+def _after_commit(session) -> None:
+    # En un hilo: con AsyncSession este hook corre en el event loop (los cambios de usuario son raros)
+    if session.info.pop("auth_usuarios_modificados", False):
+        threading.Thread(target=_incrementar_version, daemon=True).start()
+
+
+def _after_soft_rollback(session, previous_transaction) -> None:
+    session.info.pop("auth_usuarios_modificados", None)
+
+
+event.listen(AppSession, "before_flush", _before_flush)
+event.listen(AppSession, "after_commit", _after_commit)
+event.listen(AppSession, "after_soft_rollback", _after_soft_rollback)
+metrics.register_section(
+    "auth_user_cache",
+    lambda: {"entries": len(_usuarios), "ttl_s": AUTH_USER_CACHE_TTL, "max_entries": AUTH_USER_CACHE_SIZE},
+)
+
+
+async def _buscar_usuario(db: AsyncSession, username: str) -> Optional[Usuario]:
+    result = await db.execute(select(Usuario).where(Usuario.username == username).limit(1))
+    return result.scalars().first()
+
+
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = await _buscar_usuario(db, username)
     if not user:
         return False
-    if not verify_password(password, user.password_hash):
+    # bcrypt es CPU intensivo: fuera del event loop
+    if not await run_in_threadpool(verify_password, password, user.password_hash):
         return False
     return user
 
@@ -55,14 +142,17 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+async def _usuario_de_token(token: str, db: AsyncSession) -> Usuario:
+    credentials_exception = _credentials_exception()
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
@@ -70,7 +160,39 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except JWTError:
         raise credentials_exception
 
-    user = db.query(Usuario).filter(Usuario.username == token_data.username).first()
+    if _version.vencida():
+        try:
+            await run_in_threadpool(_version.get)
+        except Exception as e:
+            print(f"⚠️ Versión de usuarios no disponible: {e}")
+    version = _version.valor
+    user = _cache_get(token_data.username, version)
+    if user is not None:
+        metrics.increment("auth_user_cache_hits")
+        return user
+
+    metrics.increment("auth_user_cache_misses")
+    user = await _buscar_usuario(db, token_data.username)
     if user is None:
         raise credentials_exception
-    return user
\ No newline at end of file
+    # Desvinculado de la sesión de esta petición para poder compartirlo entre peticiones
+    db.expunge(user)
+    _cache_put(token_data.username, version, user)
+    return user
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: AsyncSession = Depends(get_async_db)):
+    return await _usuario_de_token(credentials.credentials, db)
+
+async def get_current_user_stream(
+    token: Optional[str] = Query(None, description="JWT, para clientes que no envían Authorization (<img>, EventSource)"),
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(security_opcional),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Como get_current_user, pero acepta también ?token= y no retiene conexión durante el stream."""
+    valor = credentials.credentials if credentials else token
+    if not valor:
+        raise _credentials_exception()
+    user = await _usuario_de_token(valor, db)
+    # La sesión de la dependencia vive lo que dure la respuesta: se libera ya su conexión
+    await db.close()
+    return user
@@ -1,11 +1,11 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from typing import List
 import os
 import subprocess
 import signal
 from datetime import datetime
-import glob
 import threading
 import cv2
 import time
@@ -16,15 +16,27 @@ from pydantic import BaseModel
 
 from auth import get_current_user
 from db import Usuario
+from miniaturas import pregenerar
+import almacenamiento
+import catalogo
+import eventos
+import liderazgo
+import vista_previa
 
 router = APIRouter()
 
-# Global variables to track the running process
+# Global variables to track the running process (solo en el proceso líder, ver liderazgo.py)
 capture_process = None
 capture_thread = None
 camera_active = False
-CAPTURA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "storage", "capturas")  # Directory for YOLO captures
-CAPTURA_DIR = os.path.normpath(CAPTURA_DIR)
+# Iniciar y detener la cámara nunca corren a la vez (ciclo del líder y pérdida del liderazgo)
+_camara_lock = threading.Lock()
+CAPTURA_DIR = almacenamiento.CAPTURA_DIR  # Directory for YOLO captures (AAAA/MM/DD/HH subfolders)
+LIMITE_IMAGENES_MAX = 500
+
+# Un solo recorrido del directorio; desde aquí el catálogo lo mantiene camera_capture_loop
+os.makedirs(CAPTURA_DIR, exist_ok=True)
+catalogo.sembrar()
 
 # Load YOLO model for vehicle detection
 print("Loading YOLOv8 model...")
@@ -54,6 +66,7 @@ def camera_capture_loop():
     if not cap.isOpened():
         print("❌ Could not open camera")
         camera_active = False
+        eventos.publicar("captura_estado", {"is_running": False})
         return
 
     print("✅ Camera opened successfully!")
@@ -87,18 +100,29 @@ def camera_capture_loop():
                     cv2.putText(frame, label, (x1, y1-10),
                                cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0,255,0), 2)
 
+        # Latest annotated frame for /preview (reference only, encoded in its own thread)
+        vista_previa.publicar_frame(frame)
+
         # Save image if vehicle detected and cooldown period passed
         now = time.time()
         if detected and now - last_capture > COOLDOWN:
-            filename = f"{CAPTURA_DIR}/vehicle_{int(now)}.jpg"
+            rel, filename = almacenamiento.nueva_captura(f"vehicle_{int(now)}.jpg", int(now))
             cv2.imwrite(filename, frame)
             print(f"🚗 Vehicle detected! Saved: {filename}")
+            catalogo.agregar(rel, os.path.getmtime(filename))
+            pregenerar(rel)
+            eventos.publicar("captura_guardada", {
+                "filename": os.path.basename(rel),
+                "url": almacenamiento.url_publica(rel),
+                "timestamp": datetime.fromtimestamp(now),
+            })
             last_capture = now
 
         # Small delay to prevent high CPU usage
         time.sleep(0.1)
 
     cap.release()
+    vista_previa.detener()
     print("📷 Vehicle detection capture stopped")
 
 class CapturedImage(BaseModel):
@@ -110,43 +134,87 @@ class CaptureStatus(BaseModel):
     is_running: bool
     process_id: Optional[int] = None
 
-@router.post("/iniciar", response_model=CaptureStatus)
-async def iniciar_captura(current_user: Usuario = Depends(get_current_user)):
+def _iniciar_camara():
     global capture_thread, camera_active
 
-    if camera_active:
-        raise HTTPException(status_code=400, detail="La captura ya está en ejecución")
+    # Ensure captura directory exists
+    os.makedirs(CAPTURA_DIR, exist_ok=True)
 
-    try:
-        # Ensure captura directory exists
-        os.makedirs(CAPTURA_DIR, exist_ok=True)
+    # Start camera capture in a thread
+    camera_active = True
+    capture_thread = threading.Thread(target=camera_capture_loop, daemon=True)
+    capture_thread.start()
+    vista_previa.iniciar()
+    eventos.publicar("captura_estado", {"is_running": True})
 
-        # Start camera capture in a thread
-        camera_active = True
-        capture_thread = threading.Thread(target=camera_capture_loop, daemon=True)
-        capture_thread.start()
+def _detener_camara():
+    global camera_active
 
-        return CaptureStatus(is_running=True, process_id=os.getpid())
+    # Stop camera capture
+    camera_active = False
+
+    # Wait for thread to finish (with timeout)
+    if capture_thread and capture_thread.is_alive():
+        capture_thread.join(timeout=5)
+    vista_previa.detener()
+    eventos.publicar("captura_estado", {"is_running": False})
+
+def _aplicar_solicitud(solicitud: dict):
+    with _camara_lock:
+        if solicitud["activa"] and not camera_active:
+            # Un hilo anterior que no terminó dentro del timeout seguiría usando la cámara
+            if capture_thread and capture_thread.is_alive():
+                capture_thread.join(timeout=5)
+            if capture_thread and capture_thread.is_alive():
+                print("⚠️ La captura anterior aún no libera la cámara; se reintentará con la próxima solicitud")
+            else:
+                _iniciar_camara()
+        elif not solicitud["activa"] and camera_active:
+            _detener_camara()
+    liderazgo.publicar("captura", {"is_running": camera_active, "process_id": os.getpid(), "lider": liderazgo.IDENTIDAD})
+
+@liderazgo.al_ser_lider
+def _reconciliar_captura():
+    """En el líder: aplica la solicitud de iniciar/detener pendiente y publica el estado de la cámara."""
+    solicitud = liderazgo.tomar("captura_solicitud")
+    if solicitud:
+        _aplicar_solicitud(solicitud)
+    else:
+        liderazgo.publicar("captura", {"is_running": camera_active, "process_id": os.getpid(), "lider": liderazgo.IDENTIDAD})
+
+@liderazgo.al_perder_liderazgo
+def _detener_por_liderazgo():
+    with _camara_lock:
+        _detener_camara()
+
+def _solicitar_captura(activa: bool):
+    # Cualquier worker registra la solicitud; solo el ciclo del líder la aplica (ver liderazgo.tomar)
+    liderazgo.solicitar("captura_solicitud", {"activa": activa})
+
+def _estado_compartido() -> CaptureStatus:
+    if liderazgo.es_lider():
+        return CaptureStatus(is_running=camera_active, process_id=os.getpid() if camera_active else None)
+    estado = liderazgo.leer("captura", vigencia=liderazgo.LIDER_VIGENCIA)
+    if not estado or not estado["is_running"]:
+        return CaptureStatus(is_running=False)
+    return CaptureStatus(is_running=True, process_id=estado["process_id"])
+
+@router.post("/iniciar", response_model=CaptureStatus)
+async def iniciar_captura(current_user: Usuario = Depends(get_current_user)):
+    if (await run_in_threadpool(_estado_compartido)).is_running:
+        raise HTTPException(status_code=400, detail="La captura ya está en ejecución")
+
+    try:
+        await run_in_threadpool(_solicitar_captura, True)
+        return CaptureStatus(is_running=True, process_id=os.getpid() if liderazgo.es_lider() else None)
 
     except Exception as e:
-        camera_active = False
         raise HTTPException(status_code=500, detail=f"Error al iniciar captura: {str(e)}")
 
 @router.post("/detener", response_model=CaptureStatus)
 async def detener_captura(current_user: Usuario = Depends(get_current_user)):
-    global capture_thread, camera_active
-
-    if not camera_active:
-        return CaptureStatus(is_running=False)
-
     try:
-        # Stop camera capture
-        camera_active = False
-
-        # Wait for thread to finish (with timeout)
-        if capture_thread and capture_thread.is_alive():
-            capture_thread.join(timeout=5)
-
+        await run_in_threadpool(_solicitar_captura, False)
         return CaptureStatus(is_running=False)
 
     except Exception as e:
@@ -154,56 +222,44 @@ async def detener_captura(current_user: Usuario = Depends(get_current_user)):
 
 @router.get("/estado", response_model=CaptureStatus)
 async def obtener_estado_captura(current_user: Usuario = Depends(get_current_user)):
-    global camera_active
-
-    return CaptureStatus(is_running=camera_active, process_id=os.getpid() if camera_active else None)
+    return await run_in_threadpool(_estado_compartido)
 
 @router.get("/logs", response_model=ProcessOutput)
 async def obtener_logs_captura(current_user: Usuario = Depends(get_current_user)):
-    global camera_active, CAPTURA_DIR
-
-    # Check if captura directory exists and count files
-    if os.path.exists(CAPTURA_DIR):
-        image_count = len([f for f in os.listdir(CAPTURA_DIR) if f.endswith(('.jpg', '.jpeg', '.png'))])
-        latest_file = ""
-        if image_count > 0:
-            files = sorted([f for f in os.listdir(CAPTURA_DIR) if f.endswith(('.jpg', '.jpeg', '.png'))],
-                          key=lambda x: os.path.getmtime(os.path.join(CAPTURA_DIR, x)), reverse=True)
-            latest_file = files[0]
-    else:
-        image_count = 0
-        latest_file = ""
+    estado = await run_in_threadpool(_estado_compartido)
+    await run_in_threadpool(catalogo.sincronizar)
 
-    status_msg = f"Camera active: {camera_active}, Images captured: {image_count}"
-    if latest_file:
-        status_msg += f", Latest: {latest_file}"
+    image_count = catalogo.total()
+    latest = catalogo.ultima()
+
+    status_msg = f"Camera active: {estado.is_running}, Images captured: {image_count}"
+    if latest:
+        status_msg += f", Latest: {os.path.basename(latest[1])}"
 
     return ProcessOutput(stdout=status_msg, stderr="")
 
 @router.get("/imagenes", response_model=List[CapturedImage])
-async def listar_imagenes_capturadas(current_user: Usuario = Depends(get_current_user)):
-    if not os.path.exists(CAPTURA_DIR):
-        return []
-
-    # Get all image files from captura directory
-    image_extensions = ['*.jpg', '*.jpeg', '*.png', '*.webp']
-    image_files = []
-
-    for ext in image_extensions:
-        image_files.extend(glob.glob(os.path.join(CAPTURA_DIR, ext)))
-
-    captured_images = []
-    for filepath in sorted(image_files, key=os.path.getmtime, reverse=True):
-        filename = os.path.basename(filepath)
-        timestamp = datetime.fromtimestamp(os.path.getmtime(filepath))
-
-        # Return HTTP URL instead of file path
-        image_url = f"http://localhost:8000/capturas/{filename}"
-
-        captured_images.append(CapturedImage(
-            filename=filename,
-            url=image_url,
-            timestamp=timestamp
-        ))
-
-    return captured_images
\ No newline at end of file
+async def listar_imagenes_capturadas(
+    response: Response,
+    current_user: Usuario = Depends(get_current_user),
+    limit: int = Query(100, ge=1, le=LIMITE_IMAGENES_MAX),
+    cursor: Optional[str] = Query(None, description="Valor de X-Next-Cursor de la página anterior"),
+):
+    await run_in_threadpool(catalogo.sincronizar)
+    try:
+        entradas, siguiente = catalogo.pagina(limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    if siguiente:
+        response.headers["X-Next-Cursor"] = siguiente
+    response.headers["X-Total-Count"] = str(catalogo.total())
+
+    return [
+        CapturedImage(
+            filename=os.path.basename(rel),
+            # Return HTTP URL instead of file path
+            url=almacenamiento.url_publica(rel),
+            timestamp=datetime.fromtimestamp(timestamp),
+        )
+        for timestamp, rel in entradas
+    ]
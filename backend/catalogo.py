@@ -0,0 +1,160 @@
+"""
+Catálogo en memoria de las capturas, ordenado por fecha.
+
+Se siembra una vez, en el primer uso (un solo recorrido de storage/capturas), y lo
+mantiene el escritor de capturas con agregar(). /api/captura/imagenes,
+/logs y la cola CNN lo consultan sin tocar el disco. Las entradas son rutas
+relativas de almacenamiento.py (AAAA/MM/DD/HH/<nombre>).
+
+Con varios workers solo el líder escribe capturas; los demás procesos llaman a
+sincronizar(), que recorre únicamente las carpetas de las horas transcurridas
+desde la última vez. sincronizar() también suelta los días que
+`almacenamiento.py --retener-dias` sacó del disco (lo avisa la marca de retención),
+en este y en cualquier otro proceso:
+
+- total() y ultima() son O(1)
+- pagina() es O(log n + limit), más reciente primero, con cursor opaco
+"""
+import base64
+import bisect
+import os
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import almacenamiento
+
+# (timestamp, relativa) en orden ascendente; la ruta desempata capturas del mismo segundo
+Entrada = Tuple[float, str]
+
+_entradas: List[Entrada] = []
+_por_ruta: dict = {}
+_sembrado = False
+_sincronizado_hasta = 0.0
+_marca_retencion = 0.0
+_lock = threading.Lock()
+_sembrar_lock = threading.Lock()
+
+
+def sembrar() -> int:
+    """Reemplaza el catálogo con las capturas en disco; devuelve cuántas hay."""
+    global _sembrado, _sincronizado_hasta, _marca_retencion
+    _sincronizado_hasta = time.time()
+    _marca_retencion = almacenamiento.marca_retencion()
+    entradas = sorted(almacenamiento.recorrer())
+    with _lock:
+        _entradas[:] = entradas
+        _por_ruta.clear()
+        _por_ruta.update((n, t) for t, n in entradas)
+        _sembrado = True
+    print(f"🗂  Catálogo de capturas: {len(entradas)} imágenes")
+    return len(entradas)
+
+
+def _asegurar() -> None:
+    if not _sembrado:
+        with _sembrar_lock:
+            if not _sembrado:
+                sembrar()
+
+
+def sincronizar(intervalo: float = 1.0) -> int:
+    """
+    Agrega las capturas escritas por otro proceso y quita las de los días retenidos;
+    como mucho una vez cada `intervalo` segundos.
+    """
+    global _sincronizado_hasta, _marca_retencion
+    _asegurar()
+    ahora = time.time()
+    marca = almacenamiento.marca_retencion()
+    with _lock:
+        if ahora - _sincronizado_hasta < intervalo:
+            return 0
+        # Desde la hora anterior: la carpeta de la última sincronización pudo seguir recibiendo capturas
+        hora = _sincronizado_hasta - 3600
+        _sincronizado_hasta = ahora
+        retencion, _marca_retencion = marca != _marca_retencion, marca
+    if retencion:
+        _descartar_retenidos()
+    nuevas = 0
+    while hora <= ahora + 3600:
+        for ts, rel in almacenamiento.capturas_de_hora(hora):
+            if rel not in _por_ruta:
+                agregar(rel, ts)
+                nuevas += 1
+        hora += 3600
+    return nuevas
+
+
+def agregar(rel: str, timestamp: float) -> None:
+    _asegurar()
+    entrada = (timestamp, rel)
+    with _lock:
+        anterior = _por_ruta.get(rel)
+        if anterior is not None:
+            _entradas.pop(bisect.bisect_left(_entradas, (anterior, rel)))
+        _por_ruta[rel] = timestamp
+        # Lo normal es que la captura nueva sea la más reciente: append sin desplazar nada
+        if not _entradas or _entradas[-1] <= entrada:
+            _entradas.append(entrada)
+        else:
+            bisect.insort(_entradas, entrada)
+
+
+def _descartar_retenidos() -> int:
+    """Quita las entradas de los días cuya carpeta ya no está en disco; devuelve cuántas quitó."""
+    with _lock:
+        dias = {almacenamiento.dia_de(rel) for _, rel in _entradas}
+    dias.discard(None)
+    retenidos = {d for d in dias if not os.path.isdir(almacenamiento.carpeta_del_dia(d))}
+    if not retenidos:
+        return 0
+    with _lock:
+        quitadas = [rel for _, rel in _entradas if almacenamiento.dia_de(rel) in retenidos]
+        _entradas[:] = [e for e in _entradas if almacenamiento.dia_de(e[1]) not in retenidos]
+        for rel in quitadas:
+            del _por_ruta[rel]
+    print(f"🗂  Catálogo de capturas: {len(quitadas)} imágenes de {len(retenidos)} días retenidos")
+    return len(quitadas)
+
+
+def total() -> int:
+    _asegurar()
+    return len(_entradas)
+
+
+def ultima() -> Optional[Entrada]:
+    _asegurar()
+    with _lock:
+        return _entradas[-1] if _entradas else None
+
+
+def codificar_cursor(entrada: Entrada) -> str:
+    return base64.urlsafe_b64encode(f"{entrada[0]!r}|{entrada[1]}".encode()).decode()
+
+
+def decodificar_cursor(cursor: str) -> Entrada:
+    """ValueError si el cursor no es válido."""
+    try:
+        timestamp, nombre = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return float(timestamp), nombre
+    except Exception as e:
+        raise ValueError("Cursor inválido") from e
+
+
+def pagina(limit: int, cursor: Optional[str] = None) -> Tuple[List[Entrada], Optional[str]]:
+    """Hasta `limit` capturas anteriores al cursor (más recientes primero) y el cursor siguiente."""
+    _asegurar()
+    with _lock:
+        fin = bisect.bisect_left(_entradas, decodificar_cursor(cursor)) if cursor else len(_entradas)
+        inicio = max(fin - limit, 0)
+        items = _entradas[inicio:fin][::-1]
+    siguiente = codificar_cursor(items[-1]) if items and inicio > 0 else None
+    return items, siguiente
+
+
+def posteriores(desde: Optional[Entrada] = None) -> List[Entrada]:
+    """Capturas posteriores a `desde` (todas si es None), de la más antigua a la más reciente (orden FIFO de la cola CNN)."""
+    _asegurar()
+    with _lock:
+        return _entradas[bisect.bisect_right(_entradas, desde):] if desde else list(_entradas)
@@ -1,39 +1,38 @@
 import os
-import glob
 import threading
 import time
 import asyncio
-from datetime import datetime, date
+from datetime import datetime
 from typing import Optional
 from sqlalchemy.orm import Session
-from sqlalchemy import func
 
 from db import SessionLocal, Imagen, Prediccion
 from smog_model import predict_smog  # <- usa tu CNN ya existente
+import almacenamiento
+import catalogo
+import eventos
+import liderazgo
+import rollups  # noqa: F401  (registra el mantenimiento incremental de agregados)
+import placas  # noqa: F401  (mantiene placa_normalizada y sus trigramas)
 
 # ======================
-# ESTADO GLOBAL
+# ESTADO GLOBAL (solo en el proceso líder; los demás leen el estado publicado)
 # ======================
 queue_running = False
 current_file = None
 processed_count = 0
 pending_count = 0
 _lock = threading.Lock()
+# Lo activa la pérdida del liderazgo: el worker termina tras la imagen en curso
+_cancelar = threading.Event()
+# Hasta aquí (en orden del catálogo) todas las capturas tienen predicción: cada corrida mira solo las posteriores
+_ultima_procesada: Optional[catalogo.Entrada] = None
 
-CAPTURA_DIR = os.path.join(os.path.dirname(__file__), "..", "storage", "capturas")
-CAPTURA_DIR = os.path.normpath(CAPTURA_DIR)
 
-# ✅ URL pública donde FastAPI sirve las capturas (main.py monta /capturas)
-PUBLIC_BASE_URL = "http://localhost:8000/capturas"
-
-
-def _get_all_images_fifo():
-    exts = ["*.jpg", "*.jpeg", "*.png", "*.webp"]
-    files = []
-    for ext in exts:
-        files.extend(glob.glob(os.path.join(CAPTURA_DIR, ext)))
-    files.sort(key=os.path.getmtime)  # FIFO: más antigua primero
-    return files
+def _capturas_nuevas():
+    # FIFO: más antigua primero (el catálogo ya está ordenado; no se recorre el disco)
+    catalogo.sincronizar()
+    return catalogo.posteriores(_ultima_procesada)
 
 
 def _image_has_prediction(db: Session, image_path: str) -> bool:
@@ -49,12 +48,12 @@ def _image_has_prediction(db: Session, image_path: str) -> bool:
 
 def _ensure_image_row(db: Session, image_path: str, ubicacion_id: Optional[int] = None) -> Imagen:
     """
-    ✅ Guarda ruta_archivo como URL pública: http://localhost:8000/capturas/<filename>
+    ✅ Guarda ruta_archivo como URL pública: http://localhost:8000/capturas/AAAA/MM/DD/HH/<filename>
     ✅ Mantiene filename_original para vincular la imagen al archivo físico.
     ✅ Opcionalmente asocia la imagen a una ubicación (ubicacion_id).
     """
     filename = os.path.basename(image_path)
-    public_url = f"{PUBLIC_BASE_URL}/{filename}"
+    public_url = almacenamiento.url_publica(os.path.relpath(image_path, almacenamiento.CAPTURA_DIR).replace(os.sep, "/"))
 
     # Si ya existe por URL pública
     img = db.query(Imagen).filter(Imagen.ruta_archivo == public_url).first()
@@ -79,7 +78,7 @@ def _ensure_image_row(db: Session, image_path: str, ubicacion_id: Optional[int]
     img = Imagen(
         filename_original=filename,
         ruta_archivo=public_url,
-        fecha_subida=datetime.fromtimestamp(os.path.getmtime(image_path)),
+        fecha_subida=datetime.utcfromtimestamp(os.path.getmtime(image_path)),
         usuario_id=None,
         ubicacion_id=ubicacion_id,
     )
@@ -89,8 +88,46 @@ def _ensure_image_row(db: Session, image_path: str, ubicacion_id: Optional[int]
     return img
 
 
+def _guardar_prediccion(db: Session, image_path: str, ubicacion_id: Optional[int] = None) -> Prediccion:
+    """Una imagen de la cola: fila en imagenes, CNN y predicción (benchmarks/bench_pipeline.py mide este paso)."""
+    filename = os.path.basename(image_path)
+
+    # 1) asegurar fila en imagenes (guardando URL pública y opcional ubicación)
+    img_row = _ensure_image_row(db, image_path, ubicacion_id=ubicacion_id)
+
+    # 2) correr CNN usando la RUTA LOCAL REAL (no URL)
+    result = predict_smog(image_path)
+
+    # 3) guardar predicción (1-1). La BD no tiene UNIQUE(imagen_id) (ver particiones.py):
+    #    la fila de la imagen bloqueada serializa a quien guarde otra predicción para ella
+    db.query(Imagen.id).filter(Imagen.id == img_row.id).with_for_update().one()
+    existente = db.query(Prediccion).filter(Prediccion.imagen_id == img_row.id).first()
+    if existente is not None:
+        db.commit()
+        return existente
+    pred = Prediccion(
+        imagen_id=img_row.id,
+        clase_predicha=result["clase_predicha"],
+        confianza=float(result["confianza"]),
+        p_smog=float(result["p_smog"]),
+        fecha_prediccion=datetime.utcnow(),
+        observacion="CNN last_model.keras (FIFO)"
+    )
+    db.add(pred)
+    db.commit()
+
+    eventos.publicar("prediccion_escrita", {
+        "imagen_id": img_row.id,
+        "filename": filename,
+        "clase_predicha": pred.clase_predicha,
+        "confianza": pred.confianza,
+        "p_smog": pred.p_smog,
+    })
+    return pred
+
+
 def _worker(ubicacion_id: Optional[int] = None):
-    global queue_running, current_file, processed_count, pending_count
+    global queue_running, current_file, processed_count, pending_count, _ultima_procesada
 
     with _lock:
         if queue_running:
@@ -98,48 +135,44 @@ def _worker(ubicacion_id: Optional[int] = None):
         queue_running = True
         processed_count = 0
         current_file = None
+        _cancelar.clear()
 
     db = None
     try:
         db = SessionLocal()
 
-        files = _get_all_images_fifo()
-        pending = [f for f in files if not _image_has_prediction(db, f)]
+        nuevas = _capturas_nuevas()
+        pending = [e for e in nuevas if not _image_has_prediction(db, e[1])]
 
         with _lock:
             pending_count = len(pending)
+        eventos.publicar("cola_progreso", get_status())
 
-        for image_path in pending:
+        for entrada in pending:
+            if _cancelar.is_set():
+                break
+            image_path = almacenamiento.absoluta(entrada[1])
             filename = os.path.basename(image_path)
             with _lock:
                 current_file = filename
 
-            # 1) asegurar fila en imagenes (guardando URL pública y opcional ubicación)
-            img_row = _ensure_image_row(db, image_path, ubicacion_id=ubicacion_id)
-
-            # 2) correr CNN usando la RUTA LOCAL REAL (no URL)
-            result = predict_smog(image_path)
-
-            # 3) guardar predicción (1-1)
-            pred = Prediccion(
-                imagen_id=img_row.id,
-                clase_predicha=result["clase_predicha"],
-                confianza=float(result["confianza"]),
-                p_smog=float(result["p_smog"]),
-                fecha_prediccion=datetime.utcnow(),
-                observacion="CNN last_model.keras (FIFO)"
-            )
-            db.add(pred)
-            db.commit()
+            _guardar_prediccion(db, image_path, ubicacion_id)
 
             with _lock:
+                _ultima_procesada = entrada
                 processed_count += 1
                 pending_count -= 1
+            eventos.publicar("cola_progreso", get_status())
 
             time.sleep(0.2)
 
         # ✅ After CNN processing completes, automatically run additional analysis
-        _run_post_processing_analysis(db)
+        if _cancelar.is_set():
+            print("🔻 Cola CNN detenida: este proceso dejó de ser el líder")
+        else:
+            if nuevas:
+                _ultima_procesada = nuevas[-1]
+            _run_post_processing_analysis(db)
 
     except Exception as e:
         if db:
@@ -153,6 +186,7 @@ def _worker(ubicacion_id: Optional[int] = None):
             queue_running = False
             current_file = None
             pending_count = 0
+        eventos.publicar("cola_progreso", get_status())
 
 
 def start_queue(ubicacion_id: Optional[int] = None):
@@ -172,16 +206,44 @@ def get_status():
         }
 
 
+@liderazgo.al_ser_lider
+def _reconciliar():
+    """En el líder: atiende la solicitud de procesamiento pendiente y publica el estado de la cola."""
+    solicitud = liderazgo.tomar("cnn_solicitud")
+    if solicitud:
+        start_queue(ubicacion_id=solicitud.get("ubicacion_id"))
+    liderazgo.publicar("cnn", get_status())
+
+
+@liderazgo.al_perder_liderazgo
+def _detener_cola():
+    _cancelar.set()
+
+
+def solicitar_cola(ubicacion_id: Optional[int] = None):
+    """Pide al líder que inicie la cola (la aplica su ciclo, también si el líder es este proceso)."""
+    liderazgo.solicitar("cnn_solicitud", {"ubicacion_id": ubicacion_id})
+
+
+def estado_compartido():
+    """Estado de la cola visto desde cualquier worker."""
+    if liderazgo.es_lider():
+        return get_status()
+    return liderazgo.leer("cnn", vigencia=liderazgo.LIDER_VIGENCIA) or {
+        "running": False, "current_file": None, "processed": 0, "pending": 0,
+    }
+
+
 def _run_post_processing_analysis(db: Session):
     """
     Internal function that runs additional analysis after CNN processing completes.
     This automatically enhances predictions for today's images.
     """
     try:
-        from openai_service import analizar_imagen_openai
+        from openai_service import analizar_imagenes_openai
         
-        # Get today's date (start of day)
-        today = date.today()
+        # Get today's date (start of day, UTC like fecha_subida)
+        today = datetime.utcnow().date()
         start_of_day = datetime.combine(today, datetime.min.time())
 
         # Get all images uploaded today that have predictions
@@ -198,47 +260,66 @@ def _run_post_processing_analysis(db: Session):
         success_count = 0
         failed_count = 0
 
+        pares = []
         for imagen in images_with_predictions:
+            # Get the prediction for this image
+            prediccion = db.query(Prediccion).filter(Prediccion.imagen_id == imagen.id).first()
+            if not prediccion:
+                failed_count += 1
+                print(f"⚠️ Predicción no encontrada para imagen {imagen.id}")
+                continue
+            pares.append((imagen, prediccion))
+
+        # Analyze with additional service (packed mode, several images per request)
+        # We need to run async function in sync context
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            resultados = loop.run_until_complete(
+                analizar_imagenes_openai([imagen.ruta_archivo for imagen, _ in pares])
+            )
+        except Exception as e:
+            resultados = [e] * len(pares)
+        finally:
+            loop.close()
+
+        enriquecidas = []
+        for (imagen, prediccion), resultado in zip(pares, resultados):
             try:
-                # Get the prediction for this image
-                prediccion = db.query(Prediccion).filter(Prediccion.imagen_id == imagen.id).first()
-                if not prediccion:
-                    failed_count += 1
-                    print(f"⚠️ Predicción no encontrada para imagen {imagen.id}")
-                    continue
-
-                # Analyze with additional service
-                # We need to run async function in sync context
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                resultado = loop.run_until_complete(analizar_imagen_openai(imagen.ruta_archivo))
-                loop.close()
+                if isinstance(resultado, Exception):
+                    raise resultado
 
                 # Update the prediction
                 prediccion.clase_predicha = "smog" if resultado["smog_visible"] else "sin_smog"
                 prediccion.confianza = resultado["nivel_confianza"] / 100.0
                 prediccion.p_smog = resultado["porcentaje_smog"] / 100.0
                 prediccion.observacion = resultado["descripcion_corta"]
-                prediccion.fecha_prediccion = func.now()
+                prediccion.fecha_prediccion = datetime.utcnow()
 
                 # Update license plate if detected
                 if resultado.get("placa") and resultado["placa"] != "undefined":
                     imagen.placa_manual = resultado["placa"]
 
                 success_count += 1
+                enriquecidas.append({
+                    "imagen_id": imagen.id,
+                    "clase_predicha": prediccion.clase_predicha,
+                    "p_smog": prediccion.p_smog,
+                    "placa": imagen.placa_manual,
+                })
                 print(f"✅ Análisis adicional completado para imagen {imagen.id}")
 
             except Exception as e:
                 failed_count += 1
                 error_msg = str(e) if str(e) else f"Error desconocido (tipo: {type(e).__name__})"
                 print(f"❌ Error en análisis adicional de imagen {imagen.id}: {error_msg}")
-                db.rollback()
                 continue
 
         # Commit all successful updates
         try:
             db.commit()
             print(f"✅ Análisis adicional finalizado: {success_count} exitosos, {failed_count} fallidos")
+            eventos.publicar_varios("enriquecimiento_completado", enriquecidas)
         except Exception as e:
             db.rollback()
             print(f"❌ Error guardando cambios del análisis adicional: {str(e)}")
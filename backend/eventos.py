@@ -0,0 +1,275 @@
+"""
+Bus de eventos del pipeline y su stream Server-Sent Events: GET /api/eventos.
+
+    captura_guardada            captura.py, al guardar cada captura
+    captura_estado              captura.py, al iniciar o detener la cámara
+    prediccion_escrita          cnn_queue.py, por cada predicción de la CNN
+    cola_progreso               cnn_queue.py, al avanzar, iniciar y terminar la cola
+    enriquecimiento_completado  cnn_queue.py / analisis_jobs.py / analisis.py, al guardar un análisis con IA
+
+publicar() inserta el evento en la tabla eventos y su id autoincremental es el id
+SSE: un cliente que se reconecta (a este u otro worker) manda Last-Event-ID y recibe
+lo que se perdió. Cada proceso tiene un solo hilo lector que trae los eventos nuevos
+cada EVENTOS_INTERVALO segundos (una consulta por tick, sin importar cuántos
+clientes haya) y los reparte en memoria; publicar() despierta al lector del propio
+proceso para no esperar el tick. Un cliente lento que llena su cola se desconecta y,
+al reconectarse, retoma desde su último id.
+
+Los ids se asignan al INSERT y se ven al COMMIT, así que un hueco puede ser un evento
+que otro proceso todavía no confirma. El lector se detiene en el hueco mientras siga
+abierta alguna transacción con lock sobre eventos iniciada antes de verlo (la única
+que puede tener ese id); cuando no queda ninguna, el id no llegará (rollback) y se salta.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Deque, List, Optional, Set, Tuple
+
+from fastapi import APIRouter, Depends, Header, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy import delete, func, insert, select, text
+
+import liderazgo
+import metrics
+from auth import get_current_user_stream
+from db import Evento, Usuario, engine
+
+router = APIRouter()
+
+EVENTOS_INTERVALO = float(os.getenv("EVENTOS_INTERVALO", "0.5"))
+EVENTOS_BUFFER = int(os.getenv("EVENTOS_BUFFER", "1000"))
+EVENTOS_RETENCION_HORAS = float(os.getenv("EVENTOS_RETENCION_HORAS", "24"))
+COLA_CLIENTE = 256
+KEEPALIVE = 15.0
+# Sin permiso para ver las transacciones abiertas, segundos que se espera un hueco antes de saltarlo
+EVENTOS_ESPERA_HUECO_MAX = float(os.getenv("EVENTOS_ESPERA_HUECO_MAX", "60"))
+PURGA_CADA = 600.0
+
+# (id, tipo, datos JSON)
+EventoSSE = Tuple[int, str, str]
+
+_buffer: Deque[EventoSSE] = deque(maxlen=EVENTOS_BUFFER)
+_ultimo_id: Optional[int] = None
+# Hora de la BD y monotónica en que se vio el hueco actual
+_hueco_desde: Optional[Tuple[datetime, float]] = None
+_sin_permiso_transacciones = False
+_suscriptores: Set["_Suscriptor"] = set()
+_despertar = threading.Event()
+_hilo: Optional[threading.Thread] = None
+_lock = threading.Lock()
+_ultima_purga = 0.0
+
+
+class _Suscriptor:
+    def __init__(self, tipos: Optional[Set[str]]):
+        self.loop = asyncio.get_running_loop()
+        self.cola: asyncio.Queue = asyncio.Queue(maxsize=COLA_CLIENTE)
+        self.tipos = tipos
+        self.desbordado = False
+
+    def entregar(self, evento: EventoSSE) -> None:
+        """Corre en el loop del cliente (call_soon_threadsafe)."""
+        try:
+            self.cola.put_nowait(evento)
+        except asyncio.QueueFull:
+            self.desbordado = True
+            metrics.increment("eventos_clientes_desbordados")
+
+
+def publicar(tipo: str, datos: dict) -> None:
+    publicar_varios(tipo, [datos])
+
+
+def publicar_varios(tipo: str, lista: List[dict]) -> None:
+    """Un INSERT para todos; un fallo aquí nunca interrumpe a quien publica."""
+    if not lista:
+        return
+    ahora = datetime.utcnow()
+    try:
+        with engine.begin() as conn:
+            conn.execute(
+                insert(Evento.__table__),
+                [{"tipo": tipo, "datos": json.dumps(d, default=str), "creado_en": ahora} for d in lista],
+            )
+    except Exception as e:
+        print(f"⚠️ No se pudo publicar el evento {tipo}: {e}")
+        return
+    metrics.increment("eventos_publicados", len(lista))
+    _despertar.set()
+
+
+_TRANSACCIONES_EN_EVENTOS = text(
+    "SELECT COUNT(*) FROM information_schema.innodb_trx t"
+    " JOIN performance_schema.data_locks l ON l.ENGINE_TRANSACTION_ID = t.trx_id"
+    " WHERE l.OBJECT_SCHEMA = DATABASE() AND l.OBJECT_NAME = 'eventos' AND l.LOCK_TYPE = 'TABLE'"
+    " AND t.trx_started <= :visto AND t.trx_mysql_thread_id <> CONNECTION_ID()"
+)
+
+
+def _hueco_pendiente(conn) -> bool:
+    """
+    ¿Puede confirmarse todavía el id que falta? Sí mientras siga abierta una transacción
+    que ya escribía en eventos cuando se vio el hueco.
+    """
+    global _sin_permiso_transacciones
+    visto, visto_mono = _hueco_desde
+    if not _sin_permiso_transacciones:
+        try:
+            return bool(conn.execute(_TRANSACCIONES_EN_EVENTOS, {"visto": visto}).scalar())
+        except Exception as e:
+            # Requiere PROCESS y SELECT sobre performance_schema
+            _sin_permiso_transacciones = True
+            print(f"⚠️ Eventos: no se pueden consultar las transacciones abiertas ({e}); "
+                  f"los huecos se esperan {EVENTOS_ESPERA_HUECO_MAX:g}s")
+    return time.monotonic() - visto_mono < EVENTOS_ESPERA_HUECO_MAX
+
+
+def _leer_nuevos() -> List[EventoSSE]:
+    global _ultimo_id, _hueco_desde
+    nuevos = []
+    with engine.connect() as conn:
+        filas = conn.execute(
+            select(Evento.id, Evento.tipo, Evento.datos)
+            .where(Evento.id > _ultimo_id)
+            .order_by(Evento.id)
+            .limit(EVENTOS_BUFFER)
+        ).all()
+        for fila in filas:
+            if fila.id != _ultimo_id + 1:
+                if _hueco_desde is None:
+                    _hueco_desde = (conn.execute(select(func.now())).scalar(), time.monotonic())
+                if _hueco_pendiente(conn):
+                    break
+                metrics.increment("eventos_huecos_saltados")
+            _hueco_desde = None
+            _ultimo_id = fila.id
+            nuevos.append((fila.id, fila.tipo, fila.datos))
+    return nuevos
+
+
+def _repartir(nuevos: List[EventoSSE]) -> None:
+    _buffer.extend(nuevos)
+    with _lock:
+        suscriptores = list(_suscriptores)
+    for s in suscriptores:
+        for evento in nuevos:
+            if s.tipos is None or evento[1] in s.tipos:
+                s.loop.call_soon_threadsafe(s.entregar, evento)
+
+
+def _leer() -> None:
+    while True:
+        _despertar.wait(EVENTOS_INTERVALO)
+        _despertar.clear()
+        try:
+            nuevos = _leer_nuevos()
+        except Exception as e:
+            print(f"⚠️ Eventos: {e}")
+            time.sleep(EVENTOS_INTERVALO)
+            continue
+        if nuevos:
+            _repartir(nuevos)
+
+
+def _asegurar_lector() -> None:
+    global _hilo, _ultimo_id
+    with _lock:
+        if _hilo is None:
+            # El lector arranca en el presente; lo anterior se pide con Last-Event-ID
+            with engine.connect() as conn:
+                _ultimo_id = conn.execute(select(func.coalesce(func.max(Evento.id), 0))).scalar()
+            _hilo = threading.Thread(target=_leer, daemon=True, name="eventos")
+            _hilo.start()
+
+
+def _pendientes(desde: int, tipos: Optional[Set[str]]) -> List[EventoSSE]:
+    """Eventos posteriores a `desde`: del buffer si lo cubre, si no de la tabla."""
+    buffer = list(_buffer)
+    if buffer and buffer[0][0] <= desde + 1:
+        eventos = [e for e in buffer if e[0] > desde]
+    else:
+        metrics.increment("eventos_reanudados_desde_bd")
+        with engine.connect() as conn:
+            # Lo posterior a _ultimo_id llega por la cola del suscriptor
+            filas = conn.execute(
+                select(Evento.id, Evento.tipo, Evento.datos)
+                .where(Evento.id > desde, Evento.id <= _ultimo_id)
+                .order_by(Evento.id)
+                .limit(EVENTOS_BUFFER)
+            )
+            eventos = [tuple(f) for f in filas]
+    return [e for e in eventos if tipos is None or e[1] in tipos]
+
+
+@liderazgo.al_ser_lider
+def _purgar():
+    """En el líder: borra los eventos con más de EVENTOS_RETENCION_HORAS (cada PURGA_CADA segundos)."""
+    global _ultima_purga
+    if time.monotonic() - _ultima_purga < PURGA_CADA:
+        return
+    _ultima_purga = time.monotonic()
+    limite = datetime.utcnow() - timedelta(hours=EVENTOS_RETENCION_HORAS)
+    with engine.begin() as conn:
+        conn.execute(delete(Evento).where(Evento.creado_en < limite))
+
+
+def _formato(evento: EventoSSE) -> str:
+    ident, tipo, datos = evento
+    return f"id: {ident}\nevent: {tipo}\ndata: {datos}\n\n"
+
+
+async def _sse(desde: Optional[int], tipos: Optional[Set[str]]):
+    await run_in_threadpool(_asegurar_lector)
+    suscriptor = _Suscriptor(tipos)
+    # Suscrito antes de reponer: lo que llegue mientras tanto queda en la cola y se deduplica por id
+    with _lock:
+        _suscriptores.add(suscriptor)
+    try:
+        yield f"retry: {int(EVENTOS_INTERVALO * 4000)}\n\n"
+        enviado = desde or 0
+        if desde is not None:
+            for evento in await run_in_threadpool(_pendientes, desde, tipos):
+                enviado = evento[0]
+                yield _formato(evento)
+        while not suscriptor.desbordado:
+            try:
+                evento = await asyncio.wait_for(suscriptor.cola.get(), KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            if evento[0] > enviado:
+                enviado = evento[0]
+                yield _formato(evento)
+    finally:
+        with _lock:
+            _suscriptores.discard(suscriptor)
+
+
+metrics.register_section(
+    "eventos",
+    lambda: {"suscriptores": len(_suscriptores), "ultimo_id": _ultimo_id, "buffer": len(_buffer)},
+)
+
+
+@router.get("")
+async def stream_eventos(
+    tipos: Optional[str] = Query(None, description="Tipos separados por coma; por defecto todos"),
+    last_event_id: Optional[int] = Query(None, ge=0, description="Como la cabecera Last-Event-ID"),
+    last_event_id_cabecera: Optional[str] = Header(None, alias="Last-Event-ID"),
+    current_user: Usuario = Depends(get_current_user_stream),
+):
+    desde = last_event_id
+    if last_event_id_cabecera and last_event_id_cabecera.isdigit():
+        desde = int(last_event_id_cabecera)
+    filtro = {t.strip() for t in tipos.split(",") if t.strip()} if tipos else None
+    return StreamingResponse(
+        _sse(desde, filtro or None),
+        media_type="text/event-stream",
+        # X-Accel-Buffering: sin buffer en un nginx delante
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
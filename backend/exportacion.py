@@ -0,0 +1,221 @@
+"""
+Exportación de predicciones (Imagen ⨝ Prediccion ⨝ Ubicacion) en streaming.
+
+Las filas se leen con un cursor del lado del servidor (yield_per) y se escriben
+en lotes de EXPORT_BATCH_ROWS filas, así que la memoria no depende del total.
+La lectura va a la réplica (DATABASE_READ_URL) cuando está configurada.
+
+- parquet: un row group por lote (requiere `pip install pyarrow`)
+- arrow:   Arrow IPC stream, un record batch por lote (requiere pyarrow)
+- csv:     siempre disponible
+
+    python exportacion.py --formato parquet --desde 2025-01-01 --salida predicciones.parquet
+"""
+import csv
+import io
+import os
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterator, List, Optional
+
+from sqlalchemy.orm import Session
+
+from db import ReadSessionLocal, Imagen, Prediccion, Ubicacion
+
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "10000"))
+
+# nombre -> (columna, tipo)
+COLUMNAS_EXPORTACION = {
+    "imagen_id": (Imagen.id, "int"),
+    "filename_original": (Imagen.filename_original, "str"),
+    "ruta_archivo": (Imagen.ruta_archivo, "str"),
+    "placa_manual": (Imagen.placa_manual, "str"),
+    "fecha_subida": (Imagen.fecha_subida, "fecha"),
+    "usuario_id": (Imagen.usuario_id, "int"),
+    "ubicacion_id": (Imagen.ubicacion_id, "int"),
+    "latitud": (Ubicacion.latitud, "float"),
+    "longitud": (Ubicacion.longitud, "float"),
+    "direccion": (Ubicacion.direccion, "str"),
+    "prediccion_id": (Prediccion.id, "int"),
+    "clase_predicha": (Prediccion.clase_predicha, "str"),
+    "confianza": (Prediccion.confianza, "float"),
+    "p_smog": (Prediccion.p_smog, "float"),
+    "observacion": (Prediccion.observacion, "str"),
+    "fecha_prediccion": (Prediccion.fecha_prediccion, "fecha"),
+}
+
+FORMATOS = {
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+    "csv": ("text/csv; charset=utf-8", "csv"),
+}
+
+
+def pyarrow_disponible() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def formato_por_defecto() -> str:
+    return "parquet" if pyarrow_disponible() else "csv"
+
+
+def validar_columnas(campos: Optional[str]) -> List[str]:
+    """Lista de columnas a exportar; ValueError si alguna no existe."""
+    if not campos:
+        return list(COLUMNAS_EXPORTACION)
+    seleccion = [c.strip() for c in campos.split(",") if c.strip()]
+    desconocidas = [c for c in seleccion if c not in COLUMNAS_EXPORTACION]
+    if desconocidas:
+        raise ValueError(f"Columnas desconocidas: {', '.join(desconocidas)}")
+    return seleccion
+
+
+def _consulta(session: Session, columnas: List[str], desde: Optional[date], hasta: Optional[date]):
+    q = (
+        session.query(*(COLUMNAS_EXPORTACION[c][0].label(c) for c in columnas))
+        .select_from(Prediccion)
+        .join(Imagen, Imagen.id == Prediccion.imagen_id)
+        .outerjoin(Ubicacion, Ubicacion.id == Imagen.ubicacion_id)
+    )
+    if desde is not None:
+        q = q.filter(Prediccion.fecha_prediccion >= datetime.combine(desde, datetime.min.time()))
+    if hasta is not None:
+        q = q.filter(Prediccion.fecha_prediccion < datetime.combine(hasta + timedelta(days=1), datetime.min.time()))
+    return q.order_by(Prediccion.id)
+
+
+def _convertir(valor, tipo: str):
+    if valor is None:
+        return None
+    if tipo == "float":
+        return float(valor)
+    return valor
+
+
+def lotes(
+    session: Session, columnas: List[str], desde: Optional[date] = None, hasta: Optional[date] = None
+) -> Iterator[Dict[str, list]]:
+    """Lotes columnares {columna: [valores]} de hasta EXPORT_BATCH_ROWS filas."""
+    tipos = [COLUMNAS_EXPORTACION[c][1] for c in columnas]
+    lote: Dict[str, list] = {c: [] for c in columnas}
+    n = 0
+    for row in _consulta(session, columnas, desde, hasta).yield_per(EXPORT_BATCH_ROWS):
+        for c, tipo, valor in zip(columnas, tipos, row):
+            lote[c].append(_convertir(valor, tipo))
+        n += 1
+        if n >= EXPORT_BATCH_ROWS:
+            yield lote
+            lote = {c: [] for c in columnas}
+            n = 0
+    if n:
+        yield lote
+
+
+class _Sumidero(io.RawIOBase):
+    """Archivo de solo escritura que acumula bytes hasta que se retiran con vaciar()."""
+
+    def __init__(self):
+        self._partes: List[bytes] = []
+        self._pos = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        datos = bytes(b)
+        self._partes.append(datos)
+        self._pos += len(datos)
+        return len(datos)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def vaciar(self) -> bytes:
+        datos = b"".join(self._partes)
+        self._partes = []
+        return datos
+
+
+def _esquema_arrow(columnas: List[str]):
+    import pyarrow as pa
+
+    tipos = {"int": pa.int64(), "str": pa.string(), "float": pa.float64(), "fecha": pa.timestamp("s")}
+    return pa.schema([(c, tipos[COLUMNAS_EXPORTACION[c][1]]) for c in columnas])
+
+
+def _escribir_arrow(fuente: Iterator[Dict[str, list]], columnas: List[str], formato: str) -> Iterator[bytes]:
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+
+    esquema = _esquema_arrow(columnas)
+    sumidero = _Sumidero()
+    if formato == "parquet":
+        writer = pq.ParquetWriter(sumidero, esquema, compression="zstd")
+    else:
+        writer = ipc.new_stream(sumidero, esquema)
+    try:
+        for lote in fuente:
+            writer.write_batch(pa.RecordBatch.from_pydict(lote, schema=esquema))
+            datos = sumidero.vaciar()
+            if datos:
+                yield datos
+    finally:
+        writer.close()
+    yield sumidero.vaciar()
+
+
+def _escribir_csv(fuente: Iterator[Dict[str, list]], columnas: List[str]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columnas)
+    for lote in fuente:
+        writer.writerows(zip(*(lote[c] for c in columnas)))
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+
+def exportar(
+    formato: str, columnas: List[str], desde: Optional[date] = None, hasta: Optional[date] = None
+) -> Iterator[bytes]:
+    """Genera el archivo exportado por partes. Abre y cierra su propia sesión."""
+    session = ReadSessionLocal()
+    try:
+        fuente = lotes(session, columnas, desde, hasta)
+        if formato == "csv":
+            yield from _escribir_csv(fuente, columnas)
+        else:
+            yield from _escribir_arrow(fuente, columnas, formato)
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Exporta predicciones en streaming")
+    parser.add_argument("--formato", choices=list(FORMATOS), default=formato_por_defecto())
+    parser.add_argument("--desde", type=date.fromisoformat, help="YYYY-MM-DD")
+    parser.add_argument("--hasta", type=date.fromisoformat, help="YYYY-MM-DD")
+    parser.add_argument("--campos", help="Columnas separadas por coma (por defecto todas)")
+    parser.add_argument("--salida", required=True, help="Archivo de salida")
+    args = parser.parse_args()
+
+    if args.formato != "csv" and not pyarrow_disponible():
+        parser.error("Los formatos parquet/arrow requieren pyarrow (pip install pyarrow); use --formato csv")
+    try:
+        columnas = validar_columnas(args.campos)
+    except ValueError as e:
+        parser.error(str(e))
+
+    total = 0
+    with open(args.salida, "wb") as f:
+        for parte in exportar(args.formato, columnas, args.desde, args.hasta):
+            f.write(parte)
+            total += len(parte)
+    print(f"✅ Exportado {args.salida} ({total:,} bytes)")
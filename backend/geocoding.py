@@ -0,0 +1,230 @@
+"""
+Geocodificación inversa con caché y reutilización de ubicaciones cercanas.
+
+- Caché en memoria (LRU) + tabla geocode_cache, con clave en coordenadas redondeadas.
+- Las consultas a Nominatim se hacen en segundo plano: el endpoint no espera por ellas.
+  Cada clave se consulta como mucho una vez: antes de programarla se reserva su fila en
+  geocode_cache (sin dirección); si Nominatim falla, la fila queda así y no se reintenta.
+- Antes de crear una Ubicacion se busca una existente dentro de UBICACION_RADIO_METROS.
+"""
+import asyncio
+import math
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, Set, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import metrics
+from db import AsyncSessionLocal, GeocodeCache, Ubicacion
+
+# Decimales de redondeo para la clave de caché (4 ≈ 11 m)
+GEOCODE_PRECISION = int(os.getenv("GEOCODE_PRECISION", "4"))
+GEOCODE_LRU_SIZE = int(os.getenv("GEOCODE_LRU_SIZE", "1024"))
+# Radio dentro del cual se reutiliza una Ubicacion existente
+UBICACION_RADIO_METROS = float(os.getenv("UBICACION_RADIO_METROS", "50"))
+
+RADIO_TIERRA_METROS = 6371000.0
+
+_lru: "OrderedDict[Tuple[int, int], str]" = OrderedDict()
+_lock = threading.Lock()
+# Referencias a tareas en segundo plano (evita que el GC las cancele)
+_tareas: Set[asyncio.Task] = set()
+
+
+def _clave(lat: float, lng: float) -> Tuple[int, int]:
+    factor = 10 ** GEOCODE_PRECISION
+    return int(round(lat * factor)), int(round(lng * factor))
+
+
+def _lru_get(clave: Tuple[int, int]) -> Optional[str]:
+    with _lock:
+        direccion = _lru.get(clave)
+        if direccion is not None:
+            _lru.move_to_end(clave)
+        return direccion
+
+
+def _lru_put(clave: Tuple[int, int], direccion: str) -> None:
+    with _lock:
+        _lru[clave] = direccion
+        _lru.move_to_end(clave)
+        while len(_lru) > GEOCODE_LRU_SIZE:
+            _lru.popitem(last=False)
+
+
+def direccion_en_cache(db: Session, lat: float, lng: float) -> Optional[str]:
+    """Busca la dirección en el LRU y luego en la tabla persistente; nunca llama a Nominatim."""
+    clave = _clave(lat, lng)
+    direccion = _lru_get(clave)
+    if direccion is not None:
+        metrics.increment("geocode_cache_hits_memoria")
+        return direccion
+
+    row = (
+        db.query(GeocodeCache)
+        .filter(GeocodeCache.lat_key == clave[0], GeocodeCache.lng_key == clave[1])
+        .first()
+    )
+    if row and row.direccion:
+        metrics.increment("geocode_cache_hits_db")
+        _lru_put(clave, row.direccion)
+        return row.direccion
+
+    metrics.increment("geocode_cache_misses")
+    return None
+
+
+def _guardar_en_cache(db: Session, lat: float, lng: float, direccion: str) -> None:
+    clave = _clave(lat, lng)
+    _lru_put(clave, direccion)
+    row = (
+        db.query(GeocodeCache)
+        .filter(GeocodeCache.lat_key == clave[0], GeocodeCache.lng_key == clave[1])
+        .first()
+    )
+    try:
+        if row is None:
+            db.add(GeocodeCache(lat_key=clave[0], lng_key=clave[1], direccion=direccion))
+        else:
+            row.direccion = direccion
+        db.commit()
+    except IntegrityError:
+        # Otra petición guardó la misma clave primero
+        db.rollback()
+
+
+def _reservar_consulta(db: Session, lat: float, lng: float) -> bool:
+    """Reserva la clave en geocode_cache (sin dirección); False si ya se consultó o hay una consulta en curso."""
+    clave = _clave(lat, lng)
+    try:
+        # Savepoint: un conflicto no expira la Ubicacion que el llamador va a devolver
+        with db.begin_nested():
+            db.add(GeocodeCache(lat_key=clave[0], lng_key=clave[1], direccion=None))
+    except IntegrityError:
+        metrics.increment("geocode_consultas_evitadas")
+        return False
+    db.commit()
+    return True
+
+
+def distancia_metros(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Distancia haversine entre dos coordenadas."""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lng2 - lng1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * RADIO_TIERRA_METROS * math.asin(math.sqrt(a))
+
+
+def buscar_ubicacion_cercana(
+    db: Session, lat: float, lng: float, radio_metros: Optional[float] = None
+) -> Optional[Ubicacion]:
+    """Retorna la Ubicacion existente más cercana dentro del radio, o None."""
+    radio = UBICACION_RADIO_METROS if radio_metros is None else radio_metros
+    if radio <= 0:
+        return None
+
+    # Prefiltro por caja envolvente (usa el índice de latitud/longitud), luego distancia exacta.
+    # Las más cercanas primero (distancia equirectangular al cuadrado): el límite no descarta a la mejor
+    cos_lat = max(math.cos(math.radians(lat)), 1e-6)
+    dlat = math.degrees(radio / RADIO_TIERRA_METROS)
+    dlng = dlat / cos_lat
+    candidatas = (
+        db.query(Ubicacion)
+        .filter(
+            Ubicacion.latitud.between(lat - dlat, lat + dlat),
+            Ubicacion.longitud.between(lng - dlng, lng + dlng),
+        )
+        .order_by(func.pow(Ubicacion.latitud - lat, 2) + func.pow((Ubicacion.longitud - lng) * cos_lat, 2))
+        .limit(50)
+        .all()
+    )
+
+    mejor, mejor_dist = None, radio
+    for ub in candidatas:
+        d = distancia_metros(lat, lng, float(ub.latitud), float(ub.longitud))
+        if d <= mejor_dist:
+            mejor, mejor_dist = ub, d
+    return mejor
+
+
+async def _reverse_geocode_nombre(lat: float, lng: float) -> Optional[str]:
+    """Obtiene dirección desde Nominatim (OpenStreetMap)."""
+    try:
+        import httpx
+        async with httpx.AsyncClient(timeout=5.0) as client:
+            r = await client.get(
+                "https://nominatim.openstreetmap.org/reverse",
+                params={"lat": lat, "lon": lng, "format": "json"},
+                headers={"User-Agent": "PiscoNawi-App/1.0"},
+            )
+            if r.status_code != 200:
+                return None
+            data = r.json()
+            return data.get("display_name") or None
+    except Exception:
+        return None
+
+
+def _guardar_direccion(db: Session, ubicacion_id: int, lat: float, lng: float, direccion: str) -> None:
+    _guardar_en_cache(db, lat, lng, direccion)
+    ub = db.query(Ubicacion).filter(Ubicacion.id == ubicacion_id).first()
+    if ub and not ub.direccion:
+        ub.direccion = direccion
+        db.commit()
+
+
+async def _completar_direccion(ubicacion_id: int, lat: float, lng: float) -> None:
+    direccion = await _reverse_geocode_nombre(lat, lng)
+    if not direccion:
+        return
+    direccion = direccion.strip()[:255]
+
+    # Corre en el event loop: sesión asíncrona para no bloquearlo
+    async with AsyncSessionLocal() as db:
+        try:
+            await db.run_sync(_guardar_direccion, ubicacion_id, lat, lng, direccion)
+        except Exception as e:
+            await db.rollback()
+            print(f"⚠️ Error guardando dirección de ubicación {ubicacion_id}: {e}")
+
+
+def programar_direccion(ubicacion_id: int, lat: float, lng: float) -> None:
+    """Completa Ubicacion.direccion en segundo plano (llamar desde el event loop)."""
+    tarea = asyncio.get_running_loop().create_task(_completar_direccion(ubicacion_id, lat, lng))
+    _tareas.add(tarea)
+    tarea.add_done_callback(_tareas.discard)
+
+
+def obtener_o_crear_ubicacion(db: Session, lat: float, lng: float) -> Ubicacion:
+    """
+    Reutiliza una Ubicacion cercana o crea una nueva sin esperar a Nominatim.
+    Si la dirección no está en caché se completa después en segundo plano (una sola vez por clave).
+    """
+    ub = buscar_ubicacion_cercana(db, lat, lng)
+    if ub is not None:
+        metrics.increment("ubicaciones_reutilizadas")
+        if not ub.direccion:
+            ub_lat, ub_lng = float(ub.latitud), float(ub.longitud)
+            direccion = direccion_en_cache(db, ub_lat, ub_lng)
+            if direccion is not None:
+                ub.direccion = direccion
+                db.commit()
+            elif _reservar_consulta(db, ub_lat, ub_lng):
+                programar_direccion(ub.id, ub_lat, ub_lng)
+        return ub
+
+    direccion = direccion_en_cache(db, lat, lng)
+    ub = Ubicacion(latitud=lat, longitud=lng, direccion=direccion)
+    db.add(ub)
+    db.commit()
+    db.refresh(ub)
+    metrics.increment("ubicaciones_creadas")
+
+    if direccion is None and _reservar_consulta(db, lat, lng):
+        programar_direccion(ub.id, lat, lng)
+    return ub
@@ -0,0 +1,182 @@
+"""
+Elección de líder entre procesos de la API (uvicorn --workers N).
+
+Un solo proceso, el que tiene el lock con nombre de MySQL (GET_LOCK), maneja la
+cámara y la cola CNN. El lock vive en una conexión dedicada: si el proceso muere o
+pierde la conexión, MySQL lo libera y otro worker lo toma en el siguiente ciclo.
+
+Cada LIDER_INTERVALO segundos todos los procesos intentan tomar (o verifican) el
+lock, y el líder ejecuta los reconciliadores registrados con al_ser_lider(). Un
+reconciliador consume con tomar() las solicitudes que cualquier worker dejó con
+solicitar() y publica su estado con publicar(); cualquier worker lo lee con leer().
+Ambos viven en la tabla estado_compartido.
+
+Las solicitudes solo se aplican en el hilo del ciclo (solicitar() lo despierta si
+este proceso es el líder), se borran al tomarlas y las anteriores al mandato actual
+se descartan: un líder nuevo no repite lo que ya atendió uno anterior.
+"""
+import json
+import os
+import socket
+import threading
+import time
+from typing import Callable, List, Optional
+
+from sqlalchemy import create_engine, delete, func, select, text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.pool import NullPool
+
+import metrics
+from db import DATABASE_URL, EstadoCompartido, engine
+
+LIDER_LOCK = os.getenv("LIDER_LOCK", "pisconawi_lider")
+LIDER_INTERVALO = float(os.getenv("LIDER_INTERVALO", "1"))
+# Un estado publicado hace más de esto se considera de un líder caído
+LIDER_VIGENCIA = 3 * LIDER_INTERVALO
+IDENTIDAD = f"{socket.gethostname()}:{os.getpid()}"
+
+# Fuera del pool: la conexión del lock queda tomada mientras el proceso sea líder
+_engine_lock = create_engine(DATABASE_URL, poolclass=NullPool, isolation_level="AUTOCOMMIT")
+_conexion = None
+_es_lider = False
+# Hora UTC de la base en que este proceso tomó el liderazgo
+_mandato_desde = None
+_despertar = threading.Event()
+_reconciliadores: List[Callable[[], None]] = []
+_al_perder: List[Callable[[], None]] = []
+_hilo: Optional[threading.Thread] = None
+_lock = threading.Lock()
+
+
+def es_lider() -> bool:
+    return _es_lider
+
+
+def al_ser_lider(fn: Callable[[], None]) -> Callable[[], None]:
+    """Registra `fn` para ejecutarse en cada ciclo mientras este proceso sea el líder."""
+    _reconciliadores.append(fn)
+    return fn
+
+
+def al_perder_liderazgo(fn: Callable[[], None]) -> Callable[[], None]:
+    _al_perder.append(fn)
+    return fn
+
+
+def publicar(clave: str, valor: dict) -> None:
+    stmt = mysql_insert(EstadoCompartido.__table__).values(
+        clave=clave, valor=json.dumps(valor, default=str), actualizado_en=func.utc_timestamp()
+    )
+    with engine.begin() as conn:
+        conn.execute(stmt.on_duplicate_key_update(valor=stmt.inserted.valor, actualizado_en=stmt.inserted.actualizado_en))
+
+
+def solicitar(clave: str, valor: dict) -> int:
+    """Publica una solicitud para el líder; devuelve su `seq`, que la identifica."""
+    seq = time.time_ns()
+    publicar(clave, {**valor, "seq": seq, "por": IDENTIDAD})
+    if _es_lider:
+        _despertar.set()
+    return seq
+
+
+def tomar(clave: str) -> Optional[dict]:
+    """
+    En el líder: saca la solicitud pendiente bajo `clave` (la borra) y la devuelve;
+    None si no hay o si es anterior al mandato actual.
+    """
+    with engine.begin() as conn:
+        fila = conn.execute(
+            select(EstadoCompartido.valor, EstadoCompartido.actualizado_en)
+            .where(EstadoCompartido.clave == clave)
+            .with_for_update()
+        ).first()
+        if fila is None:
+            return None
+        conn.execute(delete(EstadoCompartido).where(EstadoCompartido.clave == clave))
+    if _mandato_desde is None or fila[1] < _mandato_desde:
+        metrics.increment("lider_solicitudes_descartadas")
+        return None
+    return json.loads(fila[0])
+
+
+def leer(clave: str, vigencia: Optional[float] = None) -> Optional[dict]:
+    """Valor publicado bajo `clave`; None si no existe o tiene más de `vigencia` segundos."""
+    with engine.connect() as conn:
+        fila = conn.execute(
+            select(
+                EstadoCompartido.valor,
+                func.timestampdiff(text("SECOND"), EstadoCompartido.actualizado_en, func.utc_timestamp()),
+            ).where(EstadoCompartido.clave == clave)
+        ).first()
+    if fila is None or (vigencia is not None and fila[1] > vigencia):
+        return None
+    return json.loads(fila[0])
+
+
+def _verificar_lock() -> bool:
+    global _conexion
+    try:
+        if _conexion is None:
+            _conexion = _engine_lock.connect()
+        if _es_lider:
+            sql = "SELECT IS_USED_LOCK(:n) = CONNECTION_ID()"
+        else:
+            sql = "SELECT GET_LOCK(:n, 0)"
+        return bool(_conexion.execute(text(sql), {"n": LIDER_LOCK}).scalar())
+    except Exception as e:
+        print(f"⚠️ Liderazgo: conexión del lock perdida ({e})")
+        if _conexion is not None:
+            try:
+                _conexion.close()
+            except Exception:
+                pass
+        _conexion = None
+        return False
+
+
+def _inicio_mandato():
+    with engine.connect() as conn:
+        return conn.execute(select(func.utc_timestamp())).scalar()
+
+
+def _ciclo() -> None:
+    global _es_lider, _mandato_desde
+    while True:
+        lider = _verificar_lock()
+        if lider and not _es_lider:
+            try:
+                _mandato_desde = _inicio_mandato()
+            except Exception as e:
+                print(f"⚠️ Liderazgo: {e}")
+                lider = False
+        if lider != _es_lider:
+            _es_lider = lider
+            metrics.increment("lider_cambios")
+            print(f"👑 {IDENTIDAD} es el líder" if lider else f"🔻 {IDENTIDAD} dejó de ser el líder")
+            if not lider:
+                for fn in _al_perder:
+                    try:
+                        fn()
+                    except Exception as e:
+                        print(f"⚠️ Liderazgo: {fn.__name__} falló: {e}")
+        if lider:
+            for fn in _reconciliadores:
+                try:
+                    fn()
+                except Exception as e:
+                    print(f"⚠️ Liderazgo: {fn.__name__} falló: {e}")
+        _despertar.wait(LIDER_INTERVALO)
+        _despertar.clear()
+
+
+def iniciar() -> None:
+    """Arranca el ciclo de elección (una vez por proceso)."""
+    global _hilo
+    with _lock:
+        if _hilo is None:
+            _hilo = threading.Thread(target=_ciclo, daemon=True, name="liderazgo")
+            _hilo.start()
+
+
+metrics.register_section("liderazgo", lambda: {"identidad": IDENTIDAD, "es_lider": _es_lider})
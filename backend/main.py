@@ -1,16 +1,23 @@
 from fastapi import FastAPI, Depends, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer
-from fastapi.staticfiles import StaticFiles
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
 import os
 
-from db import engine, Base, get_db
+from db import engine, Base, get_async_db
+from migrations import asegurar_esquema
 from auth import authenticate_user, create_access_token, Token, UserLogin, get_current_user
 from captura import router as captura_router
 from analisis import router as analisis_router
 from reports import router as reports_router
+from placas import router as placas_router
+from miniaturas import router as miniaturas_router
+from vista_previa import router as vista_previa_router
+from eventos import router as eventos_router
+import liderazgo
+import metrics
+import rollups  # noqa: F401  (registra el mantenimiento incremental de agregados)
 
 # Test database connection and create tables if needed
 try:
@@ -19,7 +26,8 @@ try:
         print("Database connection successful!")
     # Create tables (will skip if they already exist)
     Base.metadata.create_all(bind=engine)
-    print("Database tables ready!")
+    # Columns and indexes added to existing tables (e.g. imagenes.placa_normalizada)
+    print(f"Database tables ready! (schema version {asegurar_esquema(engine)})")
 except Exception as e:
     print(f"Database connection failed: {e}")
     raise
@@ -33,23 +41,30 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Total-Count"],
 )
 
 security = HTTPBearer()
 
-# Mount static files directory for captured images
+# Captured images (originals and resized variants, see miniaturas.py)
 capturas_path = os.path.join(os.path.dirname(__file__), "..", "storage", "capturas")
 os.makedirs(capturas_path, exist_ok=True)
-app.mount("/capturas", StaticFiles(directory=capturas_path), name="capturas")
+app.include_router(miniaturas_router, prefix="/capturas", tags=["capturas"])
 
 # Include routers
 app.include_router(captura_router, prefix="/api/captura", tags=["captura"])
+app.include_router(vista_previa_router, prefix="/api/captura", tags=["captura"])
 app.include_router(analisis_router, prefix="/api/analisis", tags=["analisis"])
 app.include_router(reports_router, prefix="/api/reports", tags=["reports"])
+app.include_router(placas_router, prefix="/api/placas", tags=["placas"])
+app.include_router(eventos_router, prefix="/api/eventos", tags=["eventos"])
+
+# Un solo worker (el que tome el lock de MySQL) maneja la cámara y la cola CNN
+liderazgo.iniciar()
 
 @app.post("/api/auth/login", response_model=Token)
-async def login(form_data: UserLogin, db: Session = Depends(get_db)):
-    user = authenticate_user(db, form_data.username, form_data.password)
+async def login(form_data: UserLogin, db: AsyncSession = Depends(get_async_db)):
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -67,6 +82,10 @@ async def get_current_user_info(current_user = Depends(get_current_user)):
         "username": current_user.username
     }
 
+@app.get("/api/metrics")
+async def get_metrics(current_user = Depends(get_current_user)):
+    return metrics.snapshot()
+
 @app.get("/")
 async def root():
     return {"message": "PISCONAWI IA API"}
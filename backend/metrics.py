@@ -0,0 +1,33 @@
+"""
+In-process metrics registry.
+Modules increment counters or register a section callback; GET /api/metrics returns a snapshot.
+"""
+import threading
+from typing import Any, Callable, Dict
+
+_counters: Dict[str, float] = {}
+_sections: Dict[str, Callable[[], Dict[str, Any]]] = {}
+_lock = threading.Lock()
+
+
+def increment(name: str, value: float = 1) -> None:
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def register_section(name: str, provider: Callable[[], Dict[str, Any]]) -> None:
+    """Registers a callback whose dict is included under `name` in every snapshot."""
+    with _lock:
+        _sections[name] = provider
+
+
+def snapshot() -> Dict[str, Any]:
+    with _lock:
+        data: Dict[str, Any] = {"counters": dict(_counters)}
+        sections = list(_sections.items())
+    for name, provider in sections:
+        try:
+            data[name] = provider()
+        except Exception as e:
+            data[name] = {"error": str(e)}
+    return data
@@ -0,0 +1,329 @@
+"""
+Migraciones de esquema versionadas.
+
+Base.metadata.create_all crea tablas nuevas pero no modifica las existentes; los
+cambios sobre tablas ya creadas (índices, columnas) van aquí como migraciones
+numeradas. La versión aplicada se guarda en la tabla schema_migrations.
+
+    python migrations.py             # aplica las migraciones pendientes
+    python migrations.py --status    # muestra versión actual y pendientes
+    python migrations.py --down N    # revierte hasta dejar la versión N
+
+La API llama a asegurar_esquema() al iniciar: aplica las pendientes (un proceso a la
+vez, con un lock de MySQL) o, con MIGRAR_AL_INICIAR=0, se niega a arrancar si quedan
+pendientes, porque los modelos ya usan sus columnas (p. ej. imagenes.placa_normalizada).
+"""
+import os
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, List, Sequence, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+MIGRAR_AL_INICIAR = os.getenv("MIGRAR_AL_INICIAR", "1") == "1"
+MIGRACIONES_LOCK = "pisconawi_migraciones"
+# Segundos que un worker espera a que otro termine de migrar
+MIGRACIONES_ESPERA = 600
+
+# (tabla, nombre, columnas)
+IndiceSpec = Tuple[str, str, Sequence[str]]
+
+
+@dataclass
+class Migracion:
+    version: int
+    nombre: str
+    up: Callable[[Connection], None]
+    down: Callable[[Connection], None]
+    indices: List[IndiceSpec] = field(default_factory=list)
+
+
+def _indice_existe(conn: Connection, tabla: str, nombre: str) -> bool:
+    return bool(conn.execute(
+        text(
+            "SELECT COUNT(*) FROM information_schema.statistics "
+            "WHERE table_schema = DATABASE() AND table_name = :t AND index_name = :i"
+        ),
+        {"t": tabla, "i": nombre},
+    ).scalar())
+
+
+def columna_existe(conn: Connection, tabla: str, columna: str) -> bool:
+    return bool(conn.execute(
+        text(
+            "SELECT COUNT(*) FROM information_schema.columns "
+            "WHERE table_schema = DATABASE() AND table_name = :t AND column_name = :c"
+        ),
+        {"t": tabla, "c": columna},
+    ).scalar())
+
+
+def crear_indice(conn: Connection, tabla: str, nombre: str, columnas: Sequence[str]) -> None:
+    if _indice_existe(conn, tabla, nombre):
+        return
+    cols = ", ".join(f"`{c}`" for c in columnas)
+    print(f"  + {tabla}.{nombre} ({cols})")
+    conn.execute(text(f"CREATE INDEX `{nombre}` ON `{tabla}` ({cols})"))
+
+
+def eliminar_indice(conn: Connection, tabla: str, nombre: str) -> None:
+    if not _indice_existe(conn, tabla, nombre):
+        return
+    print(f"  - {tabla}.{nombre}")
+    conn.execute(text(f"DROP INDEX `{nombre}` ON `{tabla}`"))
+
+
+def migracion_indices(version: int, nombre: str, indices: List[IndiceSpec]) -> Migracion:
+    def up(conn: Connection) -> None:
+        for tabla, idx, cols in indices:
+            crear_indice(conn, tabla, idx, cols)
+
+    def down(conn: Connection) -> None:
+        for tabla, idx, _ in reversed(indices):
+            eliminar_indice(conn, tabla, idx)
+
+    return Migracion(version, nombre, up, down, indices)
+
+
+# ======================
+# MIGRACIONES
+# ======================
+INDICES_CONSULTAS_FRECUENTES: List[IndiceSpec] = [
+    # cnn_queue._ensure_image_row / _image_has_prediction
+    ("imagenes", "ix_imagenes_filename_original", ["filename_original"]),
+    ("imagenes", "ix_imagenes_ruta_archivo", ["ruta_archivo"]),
+    # análisis diario (fecha_subida >= hoy)
+    ("imagenes", "ix_imagenes_fecha_subida", ["fecha_subida"]),
+    # agrupaciones por ubicación / usuario
+    ("imagenes", "ix_imagenes_ubicacion_fecha", ["ubicacion_id", "fecha_subida"]),
+    ("imagenes", "ix_imagenes_usuario_fecha", ["usuario_id", "fecha_subida"]),
+    # reportes y cursor de /emisiones
+    ("predicciones", "ix_predicciones_fecha", ["fecha_prediccion"]),
+    ("predicciones", "ix_predicciones_clase_fecha", ["clase_predicha", "fecha_prediccion"]),
+    ("predicciones", "ix_predicciones_fecha_valores", ["fecha_prediccion", "clase_predicha", "confianza", "p_smog"]),
+    # búsqueda de ubicaciones cercanas
+    ("ubicaciones", "ix_ubicaciones_lat_lng", ["latitud", "longitud"]),
+]
+
+
+def _up_coordenadas_espaciales(conn: Connection) -> None:
+    # Columna generada: el ORM sigue escribiendo solo latitud/longitud
+    if not columna_existe(conn, "ubicaciones", "coordenadas"):
+        print("  + ubicaciones.coordenadas (POINT generado) + SPATIAL INDEX")
+        conn.execute(text(
+            "ALTER TABLE ubicaciones "
+            "ADD COLUMN coordenadas POINT SRID 0 "
+            "GENERATED ALWAYS AS (ST_SRID(POINT(longitud, latitud), 0)) STORED NOT NULL"
+        ))
+    if not _indice_existe(conn, "ubicaciones", "sx_ubicaciones_coordenadas"):
+        conn.execute(text("CREATE SPATIAL INDEX sx_ubicaciones_coordenadas ON ubicaciones (coordenadas)"))
+
+
+def _down_coordenadas_espaciales(conn: Connection) -> None:
+    eliminar_indice(conn, "ubicaciones", "sx_ubicaciones_coordenadas")
+    if columna_existe(conn, "ubicaciones", "coordenadas"):
+        conn.execute(text("ALTER TABLE ubicaciones DROP COLUMN coordenadas"))
+
+
+def _up_placa_normalizada(conn: Connection) -> None:
+    if not columna_existe(conn, "imagenes", "placa_normalizada"):
+        print("  + imagenes.placa_normalizada")
+        conn.execute(text("ALTER TABLE imagenes ADD COLUMN placa_normalizada VARCHAR(16) NULL AFTER placa_manual"))
+    crear_indice(conn, "imagenes", "ix_imagenes_placa_normalizada_fecha", ["placa_normalizada", "fecha_subida"])
+    from placas import reindexar
+    reindexar(conn)
+
+
+def _down_placa_normalizada(conn: Connection) -> None:
+    eliminar_indice(conn, "imagenes", "ix_imagenes_placa_normalizada_fecha")
+    if columna_existe(conn, "imagenes", "placa_normalizada"):
+        conn.execute(text("ALTER TABLE imagenes DROP COLUMN placa_normalizada"))
+
+
+def _up_sin_smog_rollups(conn: Connection) -> None:
+    # Hasta aquí sin_smog era predicciones - smog: se cuenta la clase para separar las demás
+    for tabla, clave in (("rollup_diario_ubicacion", "ubicacion_id"), ("rollup_diario_usuario", "usuario_id")):
+        if not columna_existe(conn, tabla, "sin_smog"):
+            print(f"  + {tabla}.sin_smog")
+            conn.execute(text(f"ALTER TABLE {tabla} ADD COLUMN sin_smog INT NOT NULL DEFAULT 0 AFTER smog"))
+        conn.execute(text(
+            f"UPDATE {tabla} r JOIN ("
+            f" SELECT DATE(p.fecha_prediccion) AS dia, COALESCE(i.{clave}, 0) AS clave, COUNT(*) AS n"
+            " FROM predicciones p JOIN imagenes i ON i.id = p.imagen_id"
+            " WHERE p.clase_predicha = 'sin_smog' GROUP BY dia, clave"
+            f") s ON s.dia = r.dia AND s.clave = r.{clave} SET r.sin_smog = s.n"
+        ))
+
+
+def _down_sin_smog_rollups(conn: Connection) -> None:
+    for tabla in ("rollup_diario_ubicacion", "rollup_diario_usuario"):
+        if columna_existe(conn, tabla, "sin_smog"):
+            conn.execute(text(f"ALTER TABLE {tabla} DROP COLUMN sin_smog"))
+
+
+def _desfase_local() -> str:
+    """Desfase de la hora local de este proceso respecto de UTC, como '+HH:MM' para CONVERT_TZ."""
+    minutos = int(datetime.now().astimezone().utcoffset().total_seconds() // 60)
+    signo = "+" if minutos >= 0 else "-"
+    return f"{signo}{abs(minutos) // 60:02d}:{abs(minutos) % 60:02d}"
+
+
+def _convertir_fecha_subida(conn: Connection, desde: str, hacia: str) -> None:
+    if desde != hacia:
+        print(f"  ~ imagenes.fecha_subida {desde} → {hacia}")
+        conn.execute(
+            text("UPDATE imagenes SET fecha_subida = CONVERT_TZ(fecha_subida, :desde, :hacia)"),
+            {"desde": desde, "hacia": hacia},
+        )
+    # Los agregados por día dependen de fecha_subida; además, hasta aquí nada los llenaba
+    # con el histórico al desplegar
+    from sqlalchemy.orm import Session
+    from rollups import rebuild
+    print("  ~ rollups.rebuild()")
+    rebuild(Session(bind=conn))
+
+
+def _up_fecha_subida_utc(conn: Connection) -> None:
+    # cnn_queue guardaba fecha_subida en hora local del servidor; ahora en UTC como el resto
+    _convertir_fecha_subida(conn, _desfase_local(), "+00:00")
+
+
+def _down_fecha_subida_utc(conn: Connection) -> None:
+    _convertir_fecha_subida(conn, "+00:00", _desfase_local())
+
+
+# (tabla, columna, tabla referenciada) de las FK que declaraba db.py
+CLAVES_FORANEAS = [
+    ("imagenes", "usuario_id", "usuarios"),
+    ("imagenes", "ubicacion_id", "ubicaciones"),
+    ("predicciones", "imagen_id", "imagenes"),
+]
+
+
+def _up_sin_claves_foraneas(conn: Connection) -> None:
+    # Lo que exige el particionado (particiones.py), aplicado siempre: así la BD coincide con db.py
+    from particiones import eliminar_claves_foraneas, unico_a_indice
+    eliminar_claves_foraneas(conn)
+    unico_a_indice(conn, "predicciones", "imagen_id", "ix_predicciones_imagen_id")
+
+
+def _down_sin_claves_foraneas(conn: Connection) -> None:
+    from particiones import TABLAS, particiones
+    if any(particiones(conn, tabla) for tabla in TABLAS):
+        raise RuntimeError("imagenes/predicciones están particionadas: no admiten UNIQUE(imagen_id) ni FK")
+    print("  ~ predicciones.ix_predicciones_imagen_id -> UNIQUE")
+    conn.execute(text(
+        "ALTER TABLE predicciones DROP INDEX ix_predicciones_imagen_id, ADD UNIQUE INDEX imagen_id (imagen_id)"
+    ))
+    for tabla, columna, referida in CLAVES_FORANEAS:
+        print(f"  + FK {tabla}.{columna} -> {referida}.id")
+        conn.execute(text(f"ALTER TABLE `{tabla}` ADD FOREIGN KEY (`{columna}`) REFERENCES `{referida}` (`id`)"))
+
+
+MIGRACIONES: List[Migracion] = [
+    migracion_indices(1, "indices_consultas_frecuentes", INDICES_CONSULTAS_FRECUENTES),
+    Migracion(2, "coordenadas_espaciales_ubicaciones", _up_coordenadas_espaciales, _down_coordenadas_espaciales),
+    Migracion(3, "placa_normalizada_imagenes", _up_placa_normalizada, _down_placa_normalizada),
+    Migracion(4, "sin_smog_rollups", _up_sin_smog_rollups, _down_sin_smog_rollups),
+    Migracion(5, "fecha_subida_utc_y_rollups", _up_fecha_subida_utc, _down_fecha_subida_utc),
+    Migracion(6, "sin_claves_foraneas_ni_unique_prediccion", _up_sin_claves_foraneas, _down_sin_claves_foraneas),
+]
+
+
+# ======================
+# EJECUCIÓN
+# ======================
+def _asegurar_tabla_versiones(conn: Connection) -> None:
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        " version INT PRIMARY KEY,"
+        " nombre VARCHAR(255) NOT NULL,"
+        " aplicada_en DATETIME NOT NULL)"
+    ))
+
+
+def version_actual(conn: Connection) -> int:
+    _asegurar_tabla_versiones(conn)
+    return conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")).scalar() or 0
+
+
+def aplicar_migraciones(engine: Engine, hasta: int = None) -> int:
+    """Aplica en orden las migraciones pendientes (hasta la versión `hasta`, inclusive)."""
+    with engine.begin() as conn:
+        actual = version_actual(conn)
+    for m in MIGRACIONES:
+        if m.version <= actual or (hasta is not None and m.version > hasta):
+            continue
+        print(f"▶ Migración {m.version}: {m.nombre}")
+        # MySQL confirma implícitamente los DDL; cada migración se registra al terminar
+        with engine.begin() as conn:
+            m.up(conn)
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, nombre, aplicada_en) VALUES (:v, :n, :f)"),
+                {"v": m.version, "n": m.nombre, "f": datetime.utcnow()},
+            )
+        actual = m.version
+    return actual
+
+
+def asegurar_esquema(engine: Engine, aplicar: bool = MIGRAR_AL_INICIAR) -> int:
+    """
+    Deja el esquema en la última versión antes de servir: con varios workers solo uno
+    migra y los demás esperan el lock y encuentran todo aplicado. Con aplicar=False
+    lanza RuntimeError si hay migraciones pendientes.
+    """
+    ultima = MIGRACIONES[-1].version
+    if not aplicar:
+        with engine.begin() as conn:
+            actual = version_actual(conn)
+        if actual < ultima:
+            raise RuntimeError(
+                f"El esquema está en la versión {actual} y el código requiere la {ultima}: "
+                "ejecute `python migrations.py` (o inicie con MIGRAR_AL_INICIAR=1)"
+            )
+        return actual
+    with engine.connect() as conn:
+        if not conn.execute(text("SELECT GET_LOCK(:n, :t)"), {"n": MIGRACIONES_LOCK, "t": MIGRACIONES_ESPERA}).scalar():
+            raise RuntimeError(f"Otro proceso lleva más de {MIGRACIONES_ESPERA}s aplicando migraciones")
+        try:
+            return aplicar_migraciones(engine)
+        finally:
+            conn.execute(text("SELECT RELEASE_LOCK(:n)"), {"n": MIGRACIONES_LOCK})
+
+
+def revertir_migraciones(engine: Engine, hasta: int) -> int:
+    """Revierte las migraciones aplicadas con versión mayor que `hasta`."""
+    with engine.begin() as conn:
+        actual = version_actual(conn)
+    for m in reversed(MIGRACIONES):
+        if m.version <= hasta or m.version > actual:
+            continue
+        print(f"◀ Revirtiendo migración {m.version}: {m.nombre}")
+        with engine.begin() as conn:
+            m.down(conn)
+            conn.execute(text("DELETE FROM schema_migrations WHERE version = :v"), {"v": m.version})
+    return hasta
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from db import engine, Base
+
+    parser = argparse.ArgumentParser(description="Migraciones de esquema")
+    parser.add_argument("--status", action="store_true", help="Muestra la versión actual y las pendientes")
+    parser.add_argument("--down", type=int, metavar="N", help="Revierte hasta la versión N")
+    args = parser.parse_args()
+
+    if args.status:
+        with engine.begin() as conn:
+            actual = version_actual(conn)
+        print(f"Versión actual: {actual}")
+        for m in MIGRACIONES:
+            print(f"  [{'x' if m.version <= actual else ' '}] {m.version}: {m.nombre}")
+    elif args.down is not None:
+        revertir_migraciones(engine, args.down)
+    else:
+        Base.metadata.create_all(bind=engine)
+        print(f"✅ Esquema en versión {asegurar_esquema(engine, aplicar=True)}")
@@ -0,0 +1,266 @@
+"""
+Servicio de capturas y variantes redimensionadas.
+
+    GET /capturas/2025/03/14/09/vehicle_123.jpg               original
+    GET /capturas/2025/03/14/09/vehicle_123.jpg?w=320         JPEG de 320 px de ancho
+    GET /capturas/2025/03/14/09/vehicle_123.jpg?w=160&fmt=webp
+
+- El ancho pedido se redondea hacia arriba al siguiente de ANCHOS (el original si
+  es más angosto), así el número de variantes por captura está acotado.
+- Las variantes se guardan en storage/variantes, con las mismas carpetas por fecha
+  que las capturas, y un límite de MINIATURAS_CACHE_MB; se descartan las menos usadas.
+- Las capturas ya archivadas (almacenamiento.py) se leen del zip de su día; el
+  original se extrae a la caché de variantes para servirlo con Range/ETag.
+- Los nombres de captura llevan timestamp y no se reescriben: las respuestas se
+  marcan immutable y llevan ETag; se responden If-None-Match (304) y Range (206).
+  El ETag sale de la captura de origen (mtime y tamaño) más el ancho y el formato,
+  así que no cambia al regenerar o volver a extraer una variante; el uso reciente
+  para el LRU se lleva en memoria.
+- captura.py llama a pregenerar() al guardar cada captura para que las grillas
+  encuentren sus miniaturas ya hechas.
+"""
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, Response
+
+import almacenamiento
+import metrics
+
+router = APIRouter()
+
+VARIANTES_DIR = os.path.join(almacenamiento.STORAGE_DIR, "variantes")
+
+ANCHOS = (160, 320, 480, 640, 960, 1280)
+FORMATOS = {"jpeg": ("image/jpeg", "jpg"), "webp": ("image/webp", "webp"), "png": ("image/png", "png")}
+MINIATURAS_CACHE_MB = int(os.getenv("MINIATURAS_CACHE_MB", "512"))
+MINIATURAS_CALIDAD = int(os.getenv("MINIATURAS_CALIDAD", "80"))
+# Variantes generadas al guardar cada captura, "ancho:formato" separados por coma
+MINIATURAS_PREGENERAR = os.getenv("MINIATURAS_PREGENERAR", "160:webp,480:webp")
+
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+_RANGO = re.compile(r"bytes=(\d*)-(\d*)$")
+
+# ruta de variante -> bytes, de la menos a la más usada
+_variantes: "OrderedDict[str, int]" = OrderedDict()
+_total = 0
+_cargado = False
+_lock = threading.Lock()
+# Un solo hilo: la pregeneración nunca compite con la captura por más de un núcleo
+_pregenerador = ThreadPoolExecutor(max_workers=1, thread_name_prefix="miniaturas")
+
+
+def _cargar() -> None:
+    """Reconstruye el índice LRU desde disco (al arrancar, las más recientes son las últimas generadas)."""
+    global _total, _cargado
+    os.makedirs(VARIANTES_DIR, exist_ok=True)
+    entradas = []
+    for raiz, _, archivos in os.walk(VARIANTES_DIR):
+        for nombre in archivos:
+            ruta = os.path.join(raiz, nombre)
+            if nombre.endswith(".tmp"):
+                os.remove(ruta)
+                continue
+            st = os.stat(ruta)
+            entradas.append((st.st_mtime, ruta, st.st_size))
+    for _, ruta, tamano in sorted(entradas):
+        _variantes[ruta] = tamano
+        _total += tamano
+    _cargado = True
+
+
+def _usar(ruta: str) -> bool:
+    """Marca la variante como recién usada (solo en memoria); False si no está en caché."""
+    with _lock:
+        if not _cargado:
+            _cargar()
+        if ruta not in _variantes:
+            return False
+        _variantes.move_to_end(ruta)
+    return os.path.isfile(ruta)
+
+
+def _registrar(ruta: str, tamano: int) -> None:
+    global _total
+    with _lock:
+        _total += tamano - _variantes.get(ruta, 0)
+        _variantes[ruta] = tamano
+        _variantes.move_to_end(ruta)
+        limite = MINIATURAS_CACHE_MB * 1024 * 1024
+        while _total > limite and len(_variantes) > 1:
+            vieja, t = _variantes.popitem(last=False)
+            _total -= t
+            try:
+                os.remove(vieja)
+            except FileNotFoundError:
+                pass
+            metrics.increment("miniaturas_desalojadas")
+
+
+def _estado() -> dict:
+    with _lock:
+        return {"variantes": len(_variantes), "bytes": _total, "limite_bytes": MINIATURAS_CACHE_MB * 1024 * 1024}
+
+
+metrics.register_section("miniaturas", _estado)
+
+
+def resolver_captura(ruta: str) -> str:
+    """Ruta relativa vigente de la captura; 404 si no es una ruta de capturas válida."""
+    try:
+        return almacenamiento.resolver(ruta)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Captura no encontrada")
+
+
+def ancho_variante(ancho: int) -> int:
+    for a in ANCHOS:
+        if a >= ancho:
+            return a
+    return ANCHOS[-1]
+
+
+def ruta_variante(rel: str, ancho: Optional[int], formato: Optional[str]) -> str:
+    """Ruta en caché; ancho None es la copia extraída del original archivado."""
+    base = os.path.join(VARIANTES_DIR, *rel.split("/"))
+    if ancho is None:
+        return base
+    return f"{os.path.splitext(base)[0]}.w{ancho}.{FORMATOS[formato][1]}"
+
+
+def _vigente(destino: str, rel: str) -> bool:
+    if not _usar(destino):
+        return False
+    original = almacenamiento.absoluta(rel)
+    # Sin original en disco (archivado) la variante en caché no puede quedar vieja
+    return not os.path.isfile(original) or os.stat(destino).st_mtime_ns >= os.stat(original).st_mtime_ns
+
+
+def _abrir(rel: str):
+    try:
+        return almacenamiento.abrir(rel)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Captura no encontrada")
+
+
+def extraer_original(rel: str) -> str:
+    """Copia en caché del original de una captura archivada."""
+    destino = ruta_variante(rel, None, None)
+    if _vigente(destino, rel):
+        return destino
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    tmp = f"{destino}.{threading.get_ident()}.tmp"
+    with _abrir(rel) as origen, open(tmp, "wb") as f:
+        f.write(origen.read())
+    os.replace(tmp, destino)
+    _registrar(destino, os.path.getsize(destino))
+    return destino
+
+
+def generar(rel: str, ancho: int, formato: str) -> str:
+    """Devuelve la variante (ancho ya normalizado), generándola si falta o es más vieja que el original."""
+    destino = ruta_variante(rel, ancho, formato)
+    if _vigente(destino, rel):
+        metrics.increment("miniaturas_hits")
+        return destino
+
+    from PIL import Image
+
+    metrics.increment("miniaturas_misses")
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    with _abrir(rel) as origen, Image.open(origen) as img:
+        img.draft("RGB", (ancho, ancho * img.height // max(img.width, 1)))  # decodificación JPEG reducida
+        if img.width > ancho:
+            img = img.resize((ancho, max(1, round(img.height * ancho / img.width))), Image.LANCZOS)
+        if formato == "jpeg" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        tmp = f"{destino}.{threading.get_ident()}.tmp"
+        opciones = {"optimize": True} if formato == "png" else {"quality": MINIATURAS_CALIDAD}
+        img.save(tmp, format=formato.upper(), **opciones)
+    os.replace(tmp, destino)
+    _registrar(destino, os.path.getsize(destino))
+    return destino
+
+
+def _pregenerar(rel: str) -> None:
+    for spec in filter(None, (s.strip() for s in MINIATURAS_PREGENERAR.split(","))):
+        ancho, _, formato = spec.partition(":")
+        try:
+            generar(rel, ancho_variante(int(ancho)), formato or "webp")
+        except Exception as e:
+            print(f"⚠️ No se pudo pregenerar {spec} de {rel}: {e}")
+
+
+def pregenerar(rel: str) -> None:
+    """Encola la generación de las variantes MINIATURAS_PREGENERAR de una captura recién guardada."""
+    _pregenerador.submit(_pregenerar, rel)
+
+
+def etag_captura(rel: str, ancho: Optional[int] = None, formato: Optional[str] = None) -> str:
+    """ETag de la captura de origen y la variante pedida (ancho None = original)."""
+    try:
+        mtime, tamano = almacenamiento.firma(rel)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Captura no encontrada")
+    variante = f"-w{ancho}.{formato}" if ancho is not None else ""
+    return f'"{mtime:x}-{tamano:x}{variante}"'
+
+
+def _rango(cabecera: str, tamano: int) -> Optional[Tuple[int, int]]:
+    """(inicio, fin inclusive) de un Range de un solo tramo; None si no aplica."""
+    m = _RANGO.match(cabecera.strip())
+    if not m or not (m.group(1) or m.group(2)):
+        return None
+    if m.group(1):
+        inicio = int(m.group(1))
+        fin = min(int(m.group(2)), tamano - 1) if m.group(2) else tamano - 1
+    else:
+        inicio, fin = max(tamano - int(m.group(2)), 0), tamano - 1
+    if inicio > fin:
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{tamano}"})
+    return inicio, fin
+
+
+def responder_archivo(request: Request, ruta: str, etag: str, media_type: Optional[str] = None) -> Response:
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    if etag in (t.strip() for t in request.headers.get("if-none-match", "").split(",")):
+        return Response(status_code=304, headers=headers)
+
+    cabecera = request.headers.get("range")
+    if cabecera and request.headers.get("if-range", etag) == etag:
+        tamano = os.path.getsize(ruta)
+        rango = _rango(cabecera, tamano)
+        if rango:
+            inicio, fin = rango
+            with open(ruta, "rb") as f:
+                f.seek(inicio)
+                datos = f.read(fin - inicio + 1)
+            headers["Content-Range"] = f"bytes {inicio}-{fin}/{tamano}"
+            return Response(datos, status_code=206, media_type=media_type, headers=headers)
+    return FileResponse(ruta, media_type=media_type, headers=headers)
+
+
+@router.api_route("/{ruta:path}", methods=["GET", "HEAD"])
+async def obtener_captura(
+    request: Request,
+    ruta: str,
+    w: Optional[int] = Query(None, ge=1, le=4096, description="Ancho máximo en px"),
+    fmt: Optional[str] = Query(None, regex="^(jpeg|webp|png)$"),
+):
+    rel = resolver_captura(ruta)
+    if w is None and fmt is None:
+        original = almacenamiento.absoluta(rel)
+        if not os.path.isfile(original):
+            original = await run_in_threadpool(extraer_original, rel)
+        return responder_archivo(request, original, await run_in_threadpool(etag_captura, rel))
+    formato = fmt or "jpeg"
+    ancho = ancho_variante(w or ANCHOS[-1])
+    archivo = await run_in_threadpool(generar, rel, ancho, formato)
+    etag = await run_in_threadpool(etag_captura, rel, ancho, formato)
+    return responder_archivo(request, archivo, etag, FORMATOS[formato][0])
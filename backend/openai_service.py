@@ -1,39 +1,94 @@
 import httpx
+import asyncio
 import base64
 import json
 import os
-from typing import Dict, Any
+import re
+from typing import Dict, Any, List, Optional, Union
 from dotenv import load_dotenv
 
+import almacenamiento
+import metrics
+from rate_limit import RateLimiter, CircuitBreaker, CircuitOpenError, backoff_delay, parse_retry_after
+
 load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_API_URL = "https://api.openai.com/v1/chat/completions"
 OPENAI_MODEL = "gpt-4o"  # Updated from deprecated gpt-4-vision-preview
 
-async def analizar_imagen_openai(ruta_archivo: str) -> Dict[str, Any]:
-    """
-    Analiza una imagen usando CNN
-    """
-    if not OPENAI_API_KEY:
-        raise ValueError("OPENAI_API_KEY no configurada")
+# Número de imágenes por solicitud en modo empaquetado (1 = sin empaquetar)
+OPENAI_BATCH_SIZE = max(1, int(os.getenv("OPENAI_BATCH_SIZE", "4")))
+
+# Límites compartidos por todo el proceso (analizar_con_ia, trabajos de análisis y post-procesamiento CNN)
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "60"))
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "30000"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "1.0"))
+OPENAI_CB_FAILURES = int(os.getenv("OPENAI_CB_FAILURES", "5"))
+OPENAI_CB_COOLDOWN = float(os.getenv("OPENAI_CB_COOLDOWN", "30"))
+
+# Estimación de tokens por imagen para el límite de tokens por minuto
+TOKENS_POR_IMAGEN = 800
+
+limiter = RateLimiter(OPENAI_RPM, OPENAI_TPM)
+breaker = CircuitBreaker(OPENAI_CB_FAILURES, OPENAI_CB_COOLDOWN)
+
+metrics.register_section("openai_rate_limiter", limiter.stats)
+metrics.register_section("openai_circuit_breaker", breaker.stats)
+
+PROMPT_INDIVIDUAL = """
+Analiza esta imagen de un vehículo y responde exclusivamente en JSON con el siguiente formato:
+{
+  "smog_visible": true/false,
+  "porcentaje_smog": 0-100,
+  "nivel_confianza": 0-100,
+  "descripcion_corta": "descripción breve del estado del vehículo",
+  "placa": "número de placa si es legible, sino 'undefined'"
+}
+
+Evalúa si hay presencia de humo negro (smog) en el escape del vehículo.
+El porcentaje_smog debe ser la estimación de intensidad del smog (0 = sin smog, 100 = smog muy intenso).
+El nivel_confianza debe indicar qué tan seguro estás de tu evaluación (0-100).
+Si puedes leer la placa del vehículo, inclúyela; de lo contrario, usa "undefined".
+"""
+
+PROMPT_LOTE = """
+Recibirás {n} imágenes de vehículos, numeradas de 0 a {ultimo} en el orden en que aparecen.
+Analiza cada imagen por separado y responde exclusivamente con un arreglo JSON con un objeto por imagen:
+[
+  {{
+    "indice": 0,
+    "smog_visible": true/false,
+    "porcentaje_smog": 0-100,
+    "nivel_confianza": 0-100,
+    "descripcion_corta": "descripción breve del estado del vehículo",
+    "placa": "número de placa si es legible, sino 'undefined'"
+  }}
+]
 
+Evalúa si hay presencia de humo negro (smog) en el escape de cada vehículo.
+El porcentaje_smog debe ser la estimación de intensidad del smog (0 = sin smog, 100 = smog muy intenso).
+El nivel_confianza debe indicar qué tan seguro estás de tu evaluación (0-100).
+Si puedes leer la placa del vehículo, inclúyela; de lo contrario, usa "undefined".
+El campo "indice" debe corresponder al número de la imagen analizada.
+"""
+
+CAMPOS_REQUERIDOS = ("smog_visible", "porcentaje_smog", "nivel_confianza", "descripcion_corta")
+
+
+async def _leer_imagen(ruta_archivo: str) -> bytes:
+    """Lee los bytes de la imagen desde URL local, URL externa o ruta de archivo."""
     # Check if ruta_archivo is a URL or a file path
-    if ruta_archivo.startswith('http://localhost:8000/capturas/'):
-        # Convert URL back to local file path for efficiency and reliability
-        filename = ruta_archivo.replace('http://localhost:8000/capturas/', '')
-        local_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'storage', 'capturas', filename)
-        print(f"Convirtiendo URL a ruta local: {ruta_archivo} -> {local_path}")
-
-        if not os.path.exists(local_path):
-            raise FileNotFoundError(f"Archivo de imagen no encontrado en ruta local: {local_path} (desde URL: {ruta_archivo})")
+    rel = almacenamiento.relativa_desde_url(ruta_archivo)
+    if rel is not None:
+        # Read the capture locally (from its date folder or its day archive) instead of over HTTP
         try:
-            with open(local_path, "rb") as image_file:
-                image_data = image_file.read()
-                if not image_data:
-                    raise ValueError(f"El archivo de imagen está vacío: {local_path}")
-        except IOError as e:
-            raise Exception(f"Error al leer el archivo: {local_path} - {str(e)}")
+            image_data = await asyncio.to_thread(almacenamiento.leer, rel)
+        except (FileNotFoundError, ValueError):
+            raise FileNotFoundError(f"Archivo de imagen no encontrado en almacenamiento: {rel} (desde URL: {ruta_archivo})")
+        if not image_data:
+            raise ValueError(f"El archivo de imagen está vacío: {rel}")
 
     elif ruta_archivo.startswith('http://') or ruta_archivo.startswith('https://'):
         # Download image from URL (fallback for external URLs)
@@ -59,32 +114,77 @@ async def analizar_imagen_openai(ruta_archivo: str) -> Dict[str, Any]:
         except IOError as e:
             raise Exception(f"Error al leer el archivo: {ruta_archivo} - {str(e)}")
 
-    # Codificar la imagen en base64
+    return image_data
+
+
+def _codificar_base64(image_data: bytes) -> str:
     try:
         base64_image = base64.b64encode(image_data).decode('utf-8')
         if not base64_image:
             raise ValueError("Error al codificar la imagen en base64")
     except Exception as e:
         raise Exception(f"Error al codificar imagen en base64: {str(e)}")
+    return base64_image
 
-    # Crear el prompt para el análisis
-    prompt = """
-Analiza esta imagen de un vehículo y responde exclusivamente en JSON con el siguiente formato:
-{
-  "smog_visible": true/false,
-  "porcentaje_smog": 0-100,
-  "nivel_confianza": 0-100,
-  "descripcion_corta": "descripción breve del estado del vehículo",
-  "placa": "número de placa si es legible, sino 'undefined'"
-}
 
-Evalúa si hay presencia de humo negro (smog) en el escape del vehículo.
-El porcentaje_smog debe ser la estimación de intensidad del smog (0 = sin smog, 100 = smog muy intenso).
-El nivel_confianza debe indicar qué tan seguro estás de tu evaluación (0-100).
-Si puedes leer la placa del vehículo, inclúyela; de lo contrario, usa "undefined".
-"""
+def _bloque_imagen(base64_image: str) -> Dict[str, Any]:
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:image/jpeg;base64,{base64_image}"
+        }
+    }
 
-    # Preparar la solicitud para análisis con CNN
+
+class _ErrorTransitorio(Exception):
+    """Error reintentable del proveedor (429, 5xx o de conexión)."""
+
+    def __init__(self, mensaje: str, retry_after: Optional[float] = None):
+        super().__init__(mensaje)
+        self.retry_after = retry_after
+
+
+class _ErrorCliente(Exception):
+    """Respuesta 4xx (salvo 429) del proveedor: la solicitud es inválida, el proveedor está en pie."""
+
+
+def _estimar_tokens(content: List[Dict[str, Any]], max_tokens: int) -> int:
+    tokens = max_tokens
+    for parte in content:
+        if parte["type"] == "text":
+            tokens += len(parte["text"]) // 4
+        else:
+            tokens += TOKENS_POR_IMAGEN
+    return tokens
+
+
+async def _post_una_vez(client: httpx.AsyncClient, headers: Dict[str, str], payload: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        response = await client.post(OPENAI_API_URL, headers=headers, json=payload)
+    except httpx.RequestError as e:
+        raise _ErrorTransitorio(f"Error de conexión con servicio de análisis: {str(e)}")
+
+    if response.status_code != 200:
+        error_text = response.text[:500] if response.text else "Sin detalles del error"
+        mensaje = f"Error en servicio de análisis: {response.status_code} - {error_text}"
+        if response.status_code == 429 or response.status_code >= 500:
+            raise _ErrorTransitorio(mensaje, parse_retry_after(response.headers.get("Retry-After")))
+        if 400 <= response.status_code < 500:
+            raise _ErrorCliente(mensaje)
+        raise Exception(mensaje)
+
+    try:
+        return response.json()
+    except json.JSONDecodeError as e:
+        raise Exception(f"Respuesta inválida del servicio de análisis: {str(e)}")
+
+
+async def _enviar_solicitud(content: List[Dict[str, Any]], max_tokens: int) -> str:
+    """
+    Envía una solicitud al servicio de análisis y retorna el texto de la respuesta.
+    Respeta el limitador compartido, reintenta errores transitorios con backoff
+    (o el Retry-After del proveedor) y falla de inmediato si el circuito está abierto.
+    """
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {OPENAI_API_KEY}"
@@ -95,77 +195,193 @@ Si puedes leer la placa del vehículo, inclúyela; de lo contrario, usa "undefin
         "messages": [
             {
                 "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
-                        }
-                    }
-                ]
+                "content": content
             }
         ],
-        "max_tokens": 500
+        "max_tokens": max_tokens
     }
+    tokens = _estimar_tokens(content, max_tokens)
 
     async with httpx.AsyncClient(timeout=60.0) as client:
+        for intento in range(OPENAI_MAX_RETRIES + 1):
+            try:
+                prueba = breaker.before_call()
+            except CircuitOpenError:
+                metrics.increment("openai_requests_rejected")
+                raise
+
+            try:
+                espera = limiter.reserve(tokens)
+                if espera > 0:
+                    await asyncio.sleep(espera)
+
+                metrics.increment("openai_requests")
+                result = await _post_una_vez(client, headers, payload)
+            except _ErrorTransitorio as e:
+                metrics.increment("openai_requests_failed")
+                breaker.record_failure()
+                if e.retry_after is not None:
+                    limiter.pause(e.retry_after)
+                if intento >= OPENAI_MAX_RETRIES:
+                    raise Exception(str(e))
+                metrics.increment("openai_retries")
+                espera = e.retry_after if e.retry_after is not None else backoff_delay(intento, OPENAI_BACKOFF_BASE)
+                print(f"⚠️ {e} — reintento {intento + 1}/{OPENAI_MAX_RETRIES} en {espera:.1f}s")
+                await asyncio.sleep(espera)
+                continue
+            except _ErrorCliente:
+                # Una respuesta 4xx no indica caída del proveedor
+                breaker.record_success()
+                raise
+            except Exception:
+                # Cualquier otro fallo (p. ej. un 200 con JSON inválido) cuenta como fallo del proveedor
+                metrics.increment("openai_requests_failed")
+                breaker.record_failure()
+                raise
+            except BaseException:
+                # Cancelada (p. ej. CancelledError) sin respuesta: no cuenta como éxito ni fallo,
+                # pero la prueba del circuito semiabierto no puede quedar tomada
+                if prueba:
+                    breaker.release_trial()
+                raise
+
+            breaker.record_success()
+            break
+
+    # Extraer el contenido JSON de la respuesta
+    if not result.get("choices") or len(result["choices"]) == 0:
+        raise Exception("Servicio de análisis no retornó respuesta válida")
+
+    content_text = result["choices"][0]["message"]["content"]
+    if not content_text:
+        raise Exception("Servicio de análisis retornó contenido vacío")
+    return content_text
+
+
+def _extraer_json(content: str) -> Optional[Any]:
+    """Intenta extraer y parsear JSON, manejando respuestas con markdown."""
+    # Primero intentar extraer JSON de bloques de código markdown
+    json_match = re.search(r'```(?:json)?\s*\n(.*?)\n```', content, re.DOTALL)
+    if json_match:
+        json_content = json_match.group(1).strip()
         try:
-            response = await client.post(OPENAI_API_URL, headers=headers, json=payload)
-        except httpx.RequestError as e:
-            raise Exception(f"Error de conexión con servicio de análisis: {str(e)}")
+            return json.loads(json_content)
+        except json.JSONDecodeError:
+            print(f"Error parseando JSON extraído de markdown: {json_content[:200]}")
+
+    # Si no se encontró JSON en markdown, intentar parsear todo el contenido
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError:
+        print(f"Error parseando JSON directamente: {content[:200]}...")
+        return None
 
-        if response.status_code != 200:
-            error_text = response.text[:500] if response.text else "Sin detalles del error"
-            raise Exception(f"Error en servicio de análisis: {response.status_code} - {error_text}")
 
+async def analizar_imagen_openai(ruta_archivo: str) -> Dict[str, Any]:
+    """
+    Analiza una imagen usando CNN
+    """
+    if not OPENAI_API_KEY:
+        raise ValueError("OPENAI_API_KEY no configurada")
+
+    base64_image = _codificar_base64(await _leer_imagen(ruta_archivo))
+
+    content = await _enviar_solicitud(
+        [{"type": "text", "text": PROMPT_INDIVIDUAL}, _bloque_imagen(base64_image)],
+        max_tokens=500,
+    )
+
+    analisis = _extraer_json(content)
+    if analisis is not None:
+        print(f"JSON parseado: {analisis}")
+
+    # Si aún no hay análisis válido, usar heurística
+    if not isinstance(analisis, dict):
+        print(f"Advertencia: Servicio de análisis retornó respuesta no-JSON, usando heurística: {content[:200]}...")
+        analisis = {
+            "smog_visible": "smog" in content.lower() and "false" not in content.lower().split("smog")[1][:20] if "smog" in content.lower() else False,
+            "porcentaje_smog": 50,  # valor por defecto
+            "nivel_confianza": 70,  # valor por defecto
+            "descripcion_corta": content.replace('```json\n', '').replace('\n```', '').strip()[:200],
+            "placa": "undefined"
+        }
+
+    return analisis
+
+
+async def _analizar_paquete(rutas: List[str]) -> Dict[int, Dict[str, Any]]:
+    """
+    Envía varias imágenes en una sola solicitud y retorna los resultados válidos
+    indexados por posición dentro del paquete. Los índices ausentes o inválidos
+    simplemente no aparecen en el diccionario.
+    """
+    content: List[Dict[str, Any]] = [
+        {"type": "text", "text": PROMPT_LOTE.format(n=len(rutas), ultimo=len(rutas) - 1)}
+    ]
+    for i, ruta in enumerate(rutas):
+        base64_image = _codificar_base64(await _leer_imagen(ruta))
+        content.append({"type": "text", "text": f"Imagen {i}:"})
+        content.append(_bloque_imagen(base64_image))
+
+    texto = await _enviar_solicitud(content, max_tokens=300 * len(rutas))
+    parsed = _extraer_json(texto)
+    if isinstance(parsed, dict):
+        # Algunas respuestas envuelven el arreglo en un objeto
+        parsed = next((v for v in parsed.values() if isinstance(v, list)), None)
+    if not isinstance(parsed, list):
+        print(f"Advertencia: respuesta empaquetada no es un arreglo JSON: {texto[:200]}...")
+        return {}
+
+    resultados: Dict[int, Dict[str, Any]] = {}
+    for pos, item in enumerate(parsed):
+        if not isinstance(item, dict):
+            continue
+        idx = item.get("indice", pos)
         try:
-            result = response.json()
-        except json.JSONDecodeError as e:
-            raise Exception(f"Respuesta inválida del servicio de análisis: {str(e)}")
-
-        # Extraer el contenido JSON de la respuesta
-        if not result.get("choices") or len(result["choices"]) == 0:
-            raise Exception("Servicio de análisis no retornó respuesta válida")
-
-        content = result["choices"][0]["message"]["content"]
-        if not content:
-            raise Exception("Servicio de análisis retornó contenido vacío")
-
-        # Intentar extraer y parsear JSON, manejando respuestas con markdown
-        analisis = None
-
-        # Primero intentar extraer JSON de bloques de código markdown
-        import re
-        json_match = re.search(r'```(?:json)?\s*\n(.*?)\n```', content, re.DOTALL)
-        if json_match:
-            json_content = json_match.group(1).strip()
+            idx = int(idx)
+        except (TypeError, ValueError):
+            continue
+        if not 0 <= idx < len(rutas) or idx in resultados:
+            continue
+        if any(campo not in item for campo in CAMPOS_REQUERIDOS):
+            continue
+        item.pop("indice", None)
+        item.setdefault("placa", "undefined")
+        resultados[idx] = item
+    return resultados
+
+
+async def analizar_imagenes_openai(
+    rutas: List[str], tamano_lote: Optional[int] = None
+) -> List[Union[Dict[str, Any], Exception]]:
+    """
+    Analiza varias imágenes empaquetando hasta `tamano_lote` imágenes por solicitud.
+    Retorna una lista alineada con `rutas`: el resultado de cada imagen o la excepción
+    que impidió analizarla. Las imágenes que faltan en la respuesta empaquetada (o
+    cuyo paquete falló) se reintentan con solicitudes individuales.
+    """
+    if not OPENAI_API_KEY:
+        raise ValueError("OPENAI_API_KEY no configurada")
+
+    k = tamano_lote or OPENAI_BATCH_SIZE
+    resultados: List[Union[Dict[str, Any], Exception, None]] = [None] * len(rutas)
+
+    for inicio in range(0, len(rutas), k):
+        paquete = rutas[inicio:inicio + k]
+        if len(paquete) > 1:
             try:
-                analisis = json.loads(json_content)
-                print(f"JSON extraído de markdown: {analisis}")
-            except json.JSONDecodeError:
-                print(f"Error parseando JSON extraído de markdown: {json_content}")
+                for idx, analisis in (await _analizar_paquete(paquete)).items():
+                    resultados[inicio + idx] = analisis
+            except Exception as e:
+                print(f"⚠️ Falló el análisis empaquetado ({len(paquete)} imágenes), usando modo individual: {e}")
 
-        # Si no se encontró JSON en markdown, intentar parsear todo el contenido
-        if analisis is None:
+        # Fallback individual para lo que no se resolvió en el paquete
+        for offset, ruta in enumerate(paquete):
+            if resultados[inicio + offset] is not None:
+                continue
             try:
-                analisis = json.loads(content)
-                print(f"JSON parseado directamente: {analisis}")
-            except json.JSONDecodeError:
-                print(f"Error parseando JSON directamente: {content[:200]}...")
-
-        # Si aún no hay análisis válido, usar heurística
-        if analisis is None:
-            print(f"Advertencia: Servicio de análisis retornó respuesta no-JSON, usando heurística: {content[:200]}...")
-            analisis = {
-                "smog_visible": "smog" in content.lower() and "false" not in content.lower().split("smog")[1][:20] if "smog" in content.lower() else False,
-                "porcentaje_smog": 50,  # valor por defecto
-                "nivel_confianza": 70,  # valor por defecto
-                "descripcion_corta": content.replace('```json\n', '').replace('\n```', '').strip()[:200],
-                "placa": "undefined"
-            }
+                resultados[inicio + offset] = await analizar_imagen_openai(ruta)
+            except Exception as e:
+                resultados[inicio + offset] = e
 
-        return analisis
\ No newline at end of file
+    return resultados
@@ -0,0 +1,195 @@
+"""
+Particionado mensual por rango de predicciones (fecha_prediccion) e imagenes (fecha_subida).
+
+    python particiones.py --inicializar          # convierte las tablas (una vez; reescribe la tabla)
+    python particiones.py                        # crea las particiones de los próximos meses
+    python particiones.py --archivar-antes 2024-01
+    python particiones.py --status
+
+MySQL exige que toda clave única incluya la columna de partición y no admite claves
+foráneas en tablas particionadas, así que:
+  - la migración 6 (migrations.py) reemplaza el UNIQUE de predicciones.imagen_id por un
+    índice normal y elimina las FK entre imagenes, predicciones, usuarios y ubicaciones;
+    db.py tampoco las declara y cnn_queue evita las predicciones duplicadas,
+  - --inicializar aplica las migraciones pendientes y cambia la PK a (id, fecha)
+    — el ORM sigue usando id como identidad.
+
+Las consultas que filtran por fecha_prediccion / fecha_subida sin envolver la columna
+en funciones (histogramas, /emisiones, exportación) leen solo las particiones del rango.
+
+--archivar-antes mueve cada partición anterior al mes indicado a <tabla>_archivo_AAAAMM
+con EXCHANGE PARTITION (solo intercambia metadatos) y la elimina. Los agregados
+diarios y sketches conservan esos datos; no ejecute `rollups.py --rebuild` después
+de archivar o los reportes dejarán de incluir el histórico archivado.
+"""
+import os
+from datetime import date
+from typing import List, Tuple
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.engine import Connection, Engine
+
+TABLAS = {"predicciones": "fecha_prediccion", "imagenes": "fecha_subida"}
+PARTICIONES_MESES_FUTUROS = int(os.getenv("PARTICIONES_MESES_FUTUROS", "3"))
+PARTICION_FUTURO = "pfuturo"
+
+
+def _mes(d: date) -> date:
+    return date(d.year, d.month, 1)
+
+
+def _siguiente(mes: date) -> date:
+    return date(mes.year + (mes.month == 12), mes.month % 12 + 1, 1)
+
+
+def _nombre(mes: date) -> str:
+    return f"p{mes:%Y%m}"
+
+
+def _particion(mes: date) -> str:
+    return f"PARTITION {_nombre(mes)} VALUES LESS THAN ('{_siguiente(mes):%Y-%m-%d}')"
+
+
+def _meses(desde: date, hasta: date) -> List[date]:
+    meses, mes = [], _mes(desde)
+    while mes <= hasta:
+        meses.append(mes)
+        mes = _siguiente(mes)
+    return meses
+
+
+def _horizonte(meses_futuros: int) -> date:
+    mes = _mes(date.today())
+    for _ in range(meses_futuros):
+        mes = _siguiente(mes)
+    return mes
+
+
+def particiones(conn: Connection, tabla: str) -> List[Tuple[str, str, int]]:
+    """(nombre, límite superior, filas estimadas) en orden; vacía si la tabla no está particionada."""
+    filas = conn.execute(
+        text(
+            "SELECT partition_name, partition_description, table_rows FROM information_schema.partitions "
+            "WHERE table_schema = DATABASE() AND table_name = :t AND partition_name IS NOT NULL "
+            "ORDER BY partition_ordinal_position"
+        ),
+        {"t": tabla},
+    ).fetchall()
+    return [(r[0], r[1], int(r[2] or 0)) for r in filas]
+
+
+def eliminar_claves_foraneas(conn: Connection) -> None:
+    fks = conn.execute(
+        text(
+            "SELECT DISTINCT table_name, constraint_name FROM information_schema.key_column_usage "
+            "WHERE table_schema = DATABASE() AND referenced_table_name IS NOT NULL "
+            "AND (table_name IN :tablas OR referenced_table_name IN :tablas)"
+        ).bindparams(bindparam("tablas", expanding=True)),
+        {"tablas": list(TABLAS)},
+    ).fetchall()
+    for tabla, fk in fks:
+        print(f"  - FK {tabla}.{fk}")
+        conn.execute(text(f"ALTER TABLE `{tabla}` DROP FOREIGN KEY `{fk}`"))
+
+
+def unico_a_indice(conn: Connection, tabla: str, columna: str, indice: str) -> None:
+    unicos = conn.execute(
+        text(
+            "SELECT DISTINCT index_name FROM information_schema.statistics "
+            "WHERE table_schema = DATABASE() AND table_name = :t AND column_name = :c "
+            "AND non_unique = 0 AND index_name <> 'PRIMARY'"
+        ),
+        {"t": tabla, "c": columna},
+    ).fetchall()
+    for (nombre,) in unicos:
+        print(f"  ~ {tabla}.{nombre}: UNIQUE -> {indice}")
+        conn.execute(text(f"ALTER TABLE `{tabla}` DROP INDEX `{nombre}`, ADD INDEX `{indice}` (`{columna}`)"))
+
+
+def inicializar(engine: Engine, meses_futuros: int = PARTICIONES_MESES_FUTUROS) -> None:
+    from migrations import asegurar_esquema
+
+    # La migración 6 quita las FK y el UNIQUE que el particionado no admite
+    asegurar_esquema(engine, aplicar=True)
+
+    for tabla, columna in TABLAS.items():
+        with engine.begin() as conn:
+            if particiones(conn, tabla):
+                print(f"  {tabla} ya está particionada")
+                continue
+            minimo = conn.execute(text(f"SELECT MIN(`{columna}`) FROM `{tabla}`")).scalar()
+            inicio = minimo.date() if minimo else date.today()
+            meses = _meses(inicio, _horizonte(meses_futuros))
+            definicion = ", ".join(
+                [_particion(m) for m in meses] + [f"PARTITION {PARTICION_FUTURO} VALUES LESS THAN (MAXVALUE)"]
+            )
+            print(f"▶ Particionando {tabla} por {columna}: {len(meses)} meses")
+            conn.execute(text(f"ALTER TABLE `{tabla}` DROP PRIMARY KEY, ADD PRIMARY KEY (`id`, `{columna}`)"))
+            conn.execute(text(f"ALTER TABLE `{tabla}` PARTITION BY RANGE COLUMNS(`{columna}`) ({definicion})"))
+
+
+def mantener(engine: Engine, meses_futuros: int = PARTICIONES_MESES_FUTUROS) -> None:
+    """Divide pfuturo para que existan particiones hasta `meses_futuros` meses adelante."""
+    for tabla in TABLAS:
+        with engine.begin() as conn:
+            actuales = particiones(conn, tabla)
+            if not actuales:
+                print(f"⚠️ {tabla} no está particionada; ejecute --inicializar")
+                continue
+            mensuales = [p[0] for p in actuales if p[0] != PARTICION_FUTURO]
+            ultimo = date(int(mensuales[-1][1:5]), int(mensuales[-1][5:7]), 1)
+            nuevos = _meses(_siguiente(ultimo), _horizonte(meses_futuros))
+            if not nuevos:
+                continue
+            print(f"  + {tabla}: {', '.join(_nombre(m) for m in nuevos)}")
+            definicion = ", ".join(
+                [_particion(m) for m in nuevos] + [f"PARTITION {PARTICION_FUTURO} VALUES LESS THAN (MAXVALUE)"]
+            )
+            conn.execute(text(f"ALTER TABLE `{tabla}` REORGANIZE PARTITION {PARTICION_FUTURO} INTO ({definicion})"))
+
+
+def archivar(engine: Engine, antes: date) -> None:
+    """Mueve las particiones de meses anteriores a `antes` a tablas <tabla>_archivo_AAAAMM."""
+    limite = _nombre(_mes(antes))
+    for tabla in TABLAS:
+        with engine.begin() as conn:
+            viejas = [p[0] for p in particiones(conn, tabla) if p[0] != PARTICION_FUTURO and p[0] < limite]
+        for particion in viejas:
+            archivo = f"{tabla}_archivo_{particion[1:]}"
+            with engine.begin() as conn:
+                conn.execute(text(f"CREATE TABLE IF NOT EXISTS `{archivo}` LIKE `{tabla}`"))
+                if particiones(conn, archivo):
+                    conn.execute(text(f"ALTER TABLE `{archivo}` REMOVE PARTITIONING"))
+                if conn.execute(text(f"SELECT COUNT(*) FROM `{archivo}`")).scalar():
+                    print(f"⚠️ {archivo} ya contiene filas; se omite {tabla}.{particion}")
+                    continue
+                print(f"  → {tabla}.{particion} -> {archivo}")
+                conn.execute(text(f"ALTER TABLE `{tabla}` EXCHANGE PARTITION {particion} WITH TABLE `{archivo}`"))
+                conn.execute(text(f"ALTER TABLE `{tabla}` DROP PARTITION {particion}"))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from db import engine
+
+    parser = argparse.ArgumentParser(description="Particionado mensual de predicciones e imagenes")
+    parser.add_argument("--inicializar", action="store_true", help="Particiona las tablas (operación larga)")
+    parser.add_argument("--archivar-antes", metavar="AAAA-MM", help="Archiva las particiones anteriores a ese mes")
+    parser.add_argument("--meses-futuros", type=int, default=PARTICIONES_MESES_FUTUROS)
+    parser.add_argument("--status", action="store_true", help="Muestra las particiones actuales")
+    args = parser.parse_args()
+
+    if args.status:
+        with engine.connect() as conn:
+            for tabla in TABLAS:
+                print(f"{tabla}:")
+                for nombre, limite, filas in particiones(conn, tabla) or [("(sin particionar)", "", 0)]:
+                    print(f"  {nombre:<12} < {limite:<14} ~{filas:,} filas")
+    elif args.archivar_antes:
+        archivar(engine, date.fromisoformat(args.archivar_antes + "-01"))
+    else:
+        if args.inicializar:
+            inicializar(engine, args.meses_futuros)
+        mantener(engine, args.meses_futuros)
+        print("✅ Particiones al día")
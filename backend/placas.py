@@ -0,0 +1,341 @@
+"""
+Plate search API: exact / prefix / fuzzy lookup, capture history and repeat offenders.
+
+Imagen.placa_normalizada is kept in sync with placa_manual by a before_flush
+listener on db.AppSession (uppercase, alphanumerics only, common OCR confusions
+folded). Fuzzy search narrows candidates through the placa_trigramas table and
+then ranks them by edit distance.
+
+Backfill for existing rows:
+    python placas.py --reindexar
+"""
+import re
+from datetime import datetime, date, timedelta
+from typing import List, Optional, Set
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from pydantic import BaseModel
+from sqlalchemy import bindparam, case, event, func, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from auth import get_current_user
+from report_cache import cached_report, get_report_db
+from db import get_async_read_db, AppSession, Usuario, Imagen, Prediccion, PlacaTrigrama
+
+LARGO_PLACA = 16
+# Lectura OCR ambigua -> carácter canónico
+_PLIEGUE_OCR = str.maketrans({"O": "0", "Q": "0", "I": "1", "Z": "2", "S": "5", "B": "8"})
+_NO_ALFANUMERICO = re.compile(r"[^A-Z0-9]")
+
+router = APIRouter()
+
+
+def normalizar_placa(placa: Optional[str]) -> Optional[str]:
+    """'abc-1O2' -> 'A8C102'. None si no queda ningún carácter útil."""
+    if not placa or placa.strip().lower() == "undefined":
+        return None
+    norm = _NO_ALFANUMERICO.sub("", placa.upper()).translate(_PLIEGUE_OCR)[:LARGO_PLACA]
+    return norm or None
+
+
+def trigramas(placa: str) -> Set[str]:
+    relleno = f"__{placa}_"
+    return {relleno[i:i + 3] for i in range(len(relleno) - 2)}
+
+
+def distancia_edicion(a: str, b: str) -> int:
+    """Levenshtein."""
+    if len(a) < len(b):
+        a, b = b, a
+    previa = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        actual = [i]
+        for j, cb in enumerate(b, 1):
+            actual.append(min(previa[j] + 1, actual[j - 1] + 1, previa[j - 1] + (ca != cb)))
+        previa = actual
+    return previa[-1]
+
+
+def _insertar_trigramas(conn, placas: Set[str]) -> None:
+    filas = [{"trigrama": t, "placa": p} for p in placas for t in trigramas(p)]
+    if filas:
+        conn.execute(mysql_insert(PlacaTrigrama.__table__).prefix_with("IGNORE"), filas)
+
+
+def _before_flush(session: Session, flush_context, instances) -> None:
+    nuevas: Set[str] = set()
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Imagen):
+            continue
+        norm = normalizar_placa(obj.placa_manual)
+        if norm != obj.placa_normalizada:
+            obj.placa_normalizada = norm
+            if norm:
+                nuevas.add(norm)
+    if nuevas:
+        _insertar_trigramas(session, nuevas)
+
+
+event.listen(AppSession, "before_flush", _before_flush)
+
+
+def reindexar(conn, lote: int = 5000) -> None:
+    """Recalcula placa_normalizada de todas las imágenes y reconstruye placa_trigramas."""
+    PlacaTrigrama.__table__.create(conn, checkfirst=True)
+    tabla = Imagen.__table__
+    actualizar = (
+        tabla.update()
+        .where(tabla.c.id == bindparam("_id"))
+        .values(placa_normalizada=bindparam("_norm"))
+    )
+    ultimo, normalizadas = 0, 0
+    while True:
+        filas = conn.execute(
+            select(tabla.c.id, tabla.c.placa_manual, tabla.c.placa_normalizada)
+            .where(tabla.c.id > ultimo)
+            .order_by(tabla.c.id)
+            .limit(lote)
+        ).fetchall()
+        if not filas:
+            break
+        ultimo = filas[-1].id
+        cambios = []
+        for r in filas:
+            norm = normalizar_placa(r.placa_manual)
+            if norm != r.placa_normalizada:
+                cambios.append({"_id": r.id, "_norm": norm})
+        if cambios:
+            conn.execute(actualizar, cambios)
+            normalizadas += len(cambios)
+
+    placas = {
+        r[0] for r in conn.execute(
+            select(tabla.c.placa_normalizada).where(tabla.c.placa_normalizada.isnot(None)).distinct()
+        )
+    }
+    conn.execute(PlacaTrigrama.__table__.delete())
+    _insertar_trigramas(conn, placas)
+    print(f"  placas: {normalizadas} normalizadas, {len(placas)} indexadas")
+
+
+# --- Response models ---
+
+class PlacaResumen(BaseModel):
+    placa: str
+    capturas: int
+    smog: int
+    ultima_captura: Optional[datetime]
+    distancia: int = 0
+
+
+class CapturaPlaca(BaseModel):
+    imagen_id: int
+    ruta_archivo: str
+    placa_manual: Optional[str]
+    fecha_subida: datetime
+    ubicacion_id: Optional[int]
+    clase_predicha: Optional[str]
+    confianza: Optional[float]
+    p_smog: Optional[float]
+    fecha_prediccion: Optional[datetime]
+
+
+def _resumen(db: Session, filtro, limit: int):
+    smog = func.sum(case((Prediccion.clase_predicha == "smog", 1), else_=0))
+    return (
+        db.query(
+            Imagen.placa_normalizada.label("placa"),
+            func.count(Imagen.id).label("capturas"),
+            func.coalesce(smog, 0).label("smog"),
+            func.max(Imagen.fecha_subida).label("ultima_captura"),
+        )
+        .outerjoin(Prediccion, Prediccion.imagen_id == Imagen.id)
+        .filter(filtro)
+        .group_by(Imagen.placa_normalizada)
+        .limit(limit)
+        .all()
+    )
+
+
+def _candidatos_difusos(db: Session, placa: str, distancia: int, limit: int) -> List[str]:
+    tri = trigramas(placa)
+    # Cada edición destruye como máximo 3 trigramas
+    minimo = max(1, len(tri) - 3 * distancia)
+    comunes = func.count(PlacaTrigrama.trigrama)
+    filas = (
+        db.query(PlacaTrigrama.placa, comunes.label("comunes"))
+        .filter(PlacaTrigrama.trigrama.in_(tri))
+        .group_by(PlacaTrigrama.placa)
+        .having(comunes >= minimo)
+        .order_by(comunes.desc())
+        .limit(limit * 10)
+        .all()
+    )
+    return [f.placa for f in filas if distancia_edicion(placa, f.placa) <= distancia]
+
+
+def buscar(db: Session, placa: str, modo: str, distancia: int, limit: int) -> List[PlacaResumen]:
+    if modo == "exacta":
+        filas = _resumen(db, Imagen.placa_normalizada == placa, limit)
+    elif modo == "prefijo":
+        filas = _resumen(db, Imagen.placa_normalizada.like(f"{placa}%"), limit)
+    else:
+        candidatos = _candidatos_difusos(db, placa, distancia, limit)
+        filas = _resumen(db, Imagen.placa_normalizada.in_(candidatos), limit) if candidatos else []
+
+    resultados = [
+        PlacaResumen(
+            placa=f.placa,
+            capturas=int(f.capturas),
+            smog=int(f.smog or 0),
+            ultima_captura=f.ultima_captura,
+            distancia=distancia_edicion(placa, f.placa),
+        )
+        for f in filas
+    ]
+    resultados.sort(key=lambda r: (r.distancia, -r.capturas))
+    return resultados
+
+
+@router.get("/buscar", response_model=List[PlacaResumen])
+async def buscar_placas(
+    current_user: Usuario = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_read_db),
+    q: str = Query(..., min_length=1, description="Placa o fragmento"),
+    modo: str = Query("exacta", regex="^(exacta|prefijo|difusa)$"),
+    distancia: int = Query(1, ge=1, le=3, description="Distancia de edición máxima (modo difusa)"),
+    limit: int = Query(20, ge=1, le=200),
+):
+    """Plates matching `q` with their capture and smog counts."""
+    placa = normalizar_placa(q)
+    if placa is None:
+        raise HTTPException(status_code=400, detail="Placa inválida")
+    return await db.run_sync(buscar, placa, modo, distancia, limit)
+
+
+def reincidentes(
+    db: Session, desde: Optional[date], hasta: Optional[date], minimo: int, limit: int
+) -> List[PlacaResumen]:
+    smog = func.count(Prediccion.id)
+    q = (
+        db.query(
+            Imagen.placa_normalizada.label("placa"),
+            smog.label("smog"),
+            func.max(Prediccion.fecha_prediccion).label("ultima_captura"),
+        )
+        .join(Imagen, Imagen.id == Prediccion.imagen_id)
+        .filter(Prediccion.clase_predicha == "smog", Imagen.placa_normalizada.isnot(None))
+    )
+    if desde is not None:
+        q = q.filter(Prediccion.fecha_prediccion >= datetime.combine(desde, datetime.min.time()))
+    if hasta is not None:
+        q = q.filter(Prediccion.fecha_prediccion < datetime.combine(hasta + timedelta(days=1), datetime.min.time()))
+    filas = (
+        q.group_by(Imagen.placa_normalizada)
+        .having(smog >= minimo)
+        .order_by(smog.desc(), func.max(Prediccion.fecha_prediccion).desc())
+        .limit(limit)
+        .all()
+    )
+    if not filas:
+        return []
+
+    capturas = dict(
+        db.query(Imagen.placa_normalizada, func.count(Imagen.id))
+        .filter(Imagen.placa_normalizada.in_([f.placa for f in filas]))
+        .group_by(Imagen.placa_normalizada)
+        .all()
+    )
+    return [
+        PlacaResumen(
+            placa=f.placa,
+            capturas=int(capturas.get(f.placa, 0)),
+            smog=int(f.smog),
+            ultima_captura=f.ultima_captura,
+        )
+        for f in filas
+    ]
+
+
+@router.get("/reincidentes", response_model=List[PlacaResumen])
+@cached_report
+async def get_reincidentes(
+    request: Request,
+    current_user: Usuario = Depends(get_current_user),
+    db: AsyncSession = Depends(get_report_db),
+    desde: Optional[date] = Query(None, description="YYYY-MM-DD"),
+    hasta: Optional[date] = Query(None, description="YYYY-MM-DD"),
+    minimo: int = Query(2, ge=1, description="Detecciones de smog mínimas"),
+    limit: int = Query(50, ge=1, le=500),
+):
+    """Plates ranked by smog detections in the date range."""
+    return await db.run_sync(reincidentes, desde, hasta, minimo, limit)
+
+
+def historial(db: Session, placa: str, limit: int) -> List[CapturaPlaca]:
+    filas = (
+        db.query(
+            Imagen.id,
+            Imagen.ruta_archivo,
+            Imagen.placa_manual,
+            Imagen.fecha_subida,
+            Imagen.ubicacion_id,
+            Prediccion.clase_predicha,
+            Prediccion.confianza,
+            Prediccion.p_smog,
+            Prediccion.fecha_prediccion,
+        )
+        .outerjoin(Prediccion, Prediccion.imagen_id == Imagen.id)
+        .filter(Imagen.placa_normalizada == placa)
+        .order_by(Imagen.fecha_subida.desc())
+        .limit(limit)
+        .all()
+    )
+    return [
+        CapturaPlaca(
+            imagen_id=f.id,
+            ruta_archivo=f.ruta_archivo,
+            placa_manual=f.placa_manual,
+            fecha_subida=f.fecha_subida,
+            ubicacion_id=f.ubicacion_id,
+            clase_predicha=f.clase_predicha,
+            confianza=float(f.confianza) if f.confianza is not None else None,
+            p_smog=float(f.p_smog) if f.p_smog is not None else None,
+            fecha_prediccion=f.fecha_prediccion,
+        )
+        for f in filas
+    ]
+
+
+@router.get("/{placa}/historial", response_model=List[CapturaPlaca])
+async def get_historial_placa(
+    placa: str,
+    current_user: Usuario = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_read_db),
+    limit: int = Query(200, ge=1, le=1000),
+):
+    """Captures of one plate, newest first, with their smog verdict."""
+    norm = normalizar_placa(placa)
+    if norm is None:
+        raise HTTPException(status_code=400, detail="Placa inválida")
+    return await db.run_sync(historial, norm, limit)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from db import engine, Base
+
+    parser = argparse.ArgumentParser(description="Mantenimiento del índice de placas")
+    parser.add_argument("--reindexar", action="store_true", help="Recalcula placas normalizadas y trigramas")
+    args = parser.parse_args()
+
+    if not args.reindexar:
+        parser.print_help()
+    else:
+        Base.metadata.create_all(bind=engine)
+        with engine.begin() as conn:
+            reindexar(conn)
+        print("✅ Índice de placas reconstruido")
@@ -0,0 +1,336 @@
+"""
+Response cache for the reports router.
+
+Key = endpoint path + sorted query parameters + global data version. The data
+version is bumped, from a background thread, after any commit that touched
+Imagen/Prediccion/Ubicacion/Usuario (CNN queue, analysis endpoints and jobs), so
+stale entries are never served; they simply stop being reachable and get evicted.
+
+Responses carry a strong ETag; a matching If-None-Match gets 304 Not Modified.
+
+Backend: in-memory LRU by default. Its entries are per process, but the data
+version is shared through the estado_compartido table, so a commit in any API
+worker or in a CLI (`python rollups.py --rebuild`) invalidates every worker's
+entries within REPORTS_VERSION_VIGENCIA seconds. Set REPORTS_CACHE_URL=redis://host:6379/0
+to share entries and the version counter through Redis instead (requires `pip install redis`).
+
+With a read replica (DATABASE_READ_URL), reports are computed on the primary for
+REPORTS_REPLICA_MARGEN seconds after each version bump: a lagging replica would
+otherwise get its pre-change result cached under the new version.
+"""
+import atexit
+import functools
+import hashlib
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional, Tuple
+
+import orjson
+from fastapi import Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import event, func, select, text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+import metrics
+from db import (
+    DATABASE_READ_URL, DATABASE_URL, AppSession, AsyncReadSessionLocal, AsyncSessionLocal,
+    EstadoCompartido, Imagen, Prediccion, Ubicacion, Usuario, engine,
+)
+
+REPORTS_CACHE_URL = os.getenv("REPORTS_CACHE_URL", "")
+REPORTS_CACHE_MAX_ENTRIES = int(os.getenv("REPORTS_CACHE_MAX_ENTRIES", "512"))
+REPORTS_CACHE_TTL = int(os.getenv("REPORTS_CACHE_TTL", "3600"))
+# Cada cuánto relee cada proceso la versión compartida (backend en memoria)
+REPORTS_VERSION_VIGENCIA = float(os.getenv("REPORTS_VERSION_VIGENCIA", "1"))
+# Segundos tras un cambio de datos en los que los reportes se calculan en la principal y no en la réplica
+REPORTS_REPLICA_MARGEN = float(os.getenv("REPORTS_REPLICA_MARGEN", "10"))
+REPLICA = DATABASE_READ_URL != DATABASE_URL
+
+MODELOS_OBSERVADOS = (Imagen, Prediccion, Ubicacion, Usuario)
+
+
+class SharedVersion:
+    """Data version stored in estado_compartido, read at most once every `vigencia` seconds."""
+    CLAVE = "reports_version"
+
+    def __init__(self, vigencia: float, clave: str = CLAVE):
+        self.vigencia = vigencia
+        self.clave = clave
+        self._valor = 0
+        self._cambiada_en: Optional[datetime] = None
+        self._leida = float("-inf")
+
+    @property
+    def valor(self) -> int:
+        """Last value read, without going to the database."""
+        return self._valor
+
+    def vencida(self) -> bool:
+        """True if the next get() goes to the database."""
+        return time.monotonic() - self._leida >= self.vigencia
+
+    def get(self) -> int:
+        if self.vencida():
+            with engine.connect() as conn:
+                fila = conn.execute(
+                    select(EstadoCompartido.valor, EstadoCompartido.actualizado_en)
+                    .where(EstadoCompartido.clave == self.clave)
+                ).first()
+            self._valor, self._cambiada_en = (int(fila.valor or 0), fila.actualizado_en) if fila else (0, None)
+            self._leida = time.monotonic()
+        return self._valor
+
+    def edad(self) -> float:
+        """Segundos desde el último incremento (según la última lectura)."""
+        self.get()
+        if self._cambiada_en is None:
+            return float("inf")
+        return (datetime.utcnow() - self._cambiada_en).total_seconds()
+
+    def incr(self) -> None:
+        stmt = mysql_insert(EstadoCompartido.__table__).values(
+            clave=self.clave, valor="1", actualizado_en=func.utc_timestamp()
+        )
+        with engine.begin() as conn:
+            conn.execute(stmt.on_duplicate_key_update(
+                valor=text("CAST(valor AS UNSIGNED) + 1"),
+                actualizado_en=stmt.inserted.actualizado_en,
+            ))
+        # Este proceso ve su propio cambio de inmediato
+        self._leida = float("-inf")
+
+
+class MemoryBackend:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[bytes, str]]" = OrderedDict()
+        self._version = SharedVersion(REPORTS_VERSION_VIGENCIA)
+        self._lock = threading.Lock()
+
+    def version(self) -> int:
+        return self._version.get()
+
+    def bump(self) -> None:
+        self._version.incr()
+
+    def edad(self) -> float:
+        return self._version.edad()
+
+    def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, body: bytes, etag: str) -> None:
+        with self._lock:
+            self._entries[key] = (body, etag)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = len(self._entries)
+        return {"backend": "memory", "entries": entries, "version": self._version._valor}
+
+
+class RedisBackend:
+    VERSION_KEY = "reports:data_version"
+    BUMPED_AT_KEY = "reports:data_version_at"
+
+    def __init__(self, url: str, ttl: int):
+        import redis  # dependencia opcional
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def version(self) -> int:
+        return int(self.client.get(self.VERSION_KEY) or 0)
+
+    def bump(self) -> None:
+        pipe = self.client.pipeline()
+        pipe.incr(self.VERSION_KEY)
+        pipe.set(self.BUMPED_AT_KEY, time.time())
+        pipe.execute()
+
+    def edad(self) -> float:
+        bumped_at = self.client.get(self.BUMPED_AT_KEY)
+        return time.time() - float(bumped_at) if bumped_at else float("inf")
+
+    def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        entry = self.client.hmget(key, "body", "etag")
+        if entry[0] is None:
+            return None
+        return entry[0], entry[1].decode()
+
+    def set(self, key: str, body: bytes, etag: str) -> None:
+        pipe = self.client.pipeline()
+        pipe.hset(key, mapping={"body": body, "etag": etag})
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def stats(self) -> dict:
+        return {"backend": "redis", "version": self.version()}
+
+
+def _crear_backend():
+    if REPORTS_CACHE_URL.startswith("redis://"):
+        try:
+            return RedisBackend(REPORTS_CACHE_URL, REPORTS_CACHE_TTL)
+        except ImportError:
+            print("⚠️ REPORTS_CACHE_URL apunta a Redis pero el paquete 'redis' no está instalado; usando memoria")
+    return MemoryBackend(REPORTS_CACHE_MAX_ENTRIES)
+
+
+backend = _crear_backend()
+metrics.register_section("reports_cache", lambda: backend.stats())
+
+
+def bump_data_version() -> None:
+    try:
+        backend.bump()
+    except Exception as e:
+        print(f"⚠️ No se pudo incrementar la versión de datos de reportes: {e}")
+
+
+def _before_flush(session, flush_context, instances) -> None:
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, MODELOS_OBSERVADOS):
+            session.info["reports_datos_modificados"] = True
+            return
+
+
+# El incremento es un UPSERT síncrono: no se hace dentro de after_commit, que con AsyncSession
+# corre en el event loop, sino en un hilo propio. Varios commits seguidos se agrupan en uno.
+_bump_pendiente = threading.Event()
+_bump_hilo: Optional[threading.Thread] = None
+_bump_lock = threading.Lock()
+
+
+def _bumper() -> None:
+    while True:
+        _bump_pendiente.wait()
+        _bump_pendiente.clear()
+        bump_data_version()
+
+
+def _programar_bump() -> None:
+    global _bump_hilo
+    _bump_pendiente.set()
+    with _bump_lock:
+        if _bump_hilo is None:
+            _bump_hilo = threading.Thread(target=_bumper, name="reports-bump", daemon=True)
+            _bump_hilo.start()
+
+
+@atexit.register
+def _bump_al_salir() -> None:
+    # Scripts de corta vida: que el último commit no quede sin invalidar la caché
+    if _bump_pendiente.is_set():
+        _bump_pendiente.clear()
+        bump_data_version()
+
+
+def _after_commit(session) -> None:
+    if session.info.pop("reports_datos_modificados", False):
+        _programar_bump()
+
+
+def _after_soft_rollback(session, previous_transaction) -> None:
+    session.info.pop("reports_datos_modificados", None)
+
+
+event.listen(AppSession, "before_flush", _before_flush)
+event.listen(AppSession, "after_commit", _after_commit)
+event.listen(AppSession, "after_soft_rollback", _after_soft_rollback)
+
+
+async def fabrica_de_lectura(request: Request):
+    """
+    Session factory for computing this request's report, chosen once per request together
+    with the data version the cache key uses: the primary within REPORTS_REPLICA_MARGEN
+    seconds of a bump (only with a replica configured), the read sessions otherwise.
+    """
+    if not hasattr(request.state, "reports_fabrica"):
+        version, principal = None, False
+        try:
+            version = await run_in_threadpool(backend.version)
+            if REPLICA:
+                principal = await run_in_threadpool(backend.edad) < REPORTS_REPLICA_MARGEN
+        except Exception as e:
+            print(f"⚠️ Caché de reportes no disponible: {e}")
+        if principal:
+            metrics.increment("reports_lecturas_principal")
+        request.state.reports_version = version
+        request.state.reports_fabrica = AsyncSessionLocal if principal else AsyncReadSessionLocal
+    return request.state.reports_fabrica
+
+
+async def get_report_db(request: Request):
+    """Like db.get_async_read_db, on the session chosen by fabrica_de_lectura."""
+    fabrica = await fabrica_de_lectura(request)
+    async with fabrica() as db:
+        yield db
+
+
+def _cache_key(request: Request, version: int) -> str:
+    query = "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+    return f"reports:{version}:{request.url.path}?{query}"
+
+
+def _server_timing(tiempos: dict) -> str:
+    return ", ".join(f"{nombre};dur={ms:.2f}" for nombre, ms in tiempos.items())
+
+
+def _respuesta(body: bytes, etag: str, request: Request, server_timing: str = 'cache;desc="hit"') -> Response:
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Server-Timing": server_timing}
+    if request.headers.get("if-none-match") == etag:
+        metrics.increment("reports_cache_not_modified")
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def cached_report(fn):
+    """
+    Decorator for report endpoints. The endpoint must declare `request: Request`.
+    Authentication and other dependencies still run; only the computation is skipped.
+    """
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        request: Request = kwargs["request"]
+        await fabrica_de_lectura(request)
+        key, entry = None, None
+        # Sin versión (backend caído) se calcula sin cachear
+        if request.state.reports_version is not None:
+            try:
+                key = _cache_key(request, request.state.reports_version)
+                entry = await run_in_threadpool(backend.get, key)
+            except Exception as e:
+                print(f"⚠️ Caché de reportes no disponible: {e}")
+                key, entry = None, None
+
+        if entry is not None:
+            metrics.increment("reports_cache_hits")
+            return _respuesta(entry[0], entry[1], request)
+
+        metrics.increment("reports_cache_misses")
+        result = await fn(*args, **kwargs)
+        body = orjson.dumps(jsonable_encoder(result))
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        if key is not None:
+            try:
+                await run_in_threadpool(backend.set, key, body, etag)
+            except Exception as e:
+                print(f"⚠️ No se pudo guardar en la caché de reportes: {e}")
+        # Tiempos medidos ahora (request.state.server_timing): van en la cabecera, nunca en el cuerpo cacheado
+        tiempos = getattr(request.state, "server_timing", None)
+        return _respuesta(body, etag, request, _server_timing(tiempos) if tiempos else 'cache;desc="miss"')
+
+    return wrapper
@@ -1,16 +1,33 @@
 """
 Reports API: aggregated data for dashboards and charts.
 All endpoints require authentication (get_current_user).
+Counts, trends and per-location/per-user figures are read from the daily rollup
+tables maintained by rollups.py, so they do not scan predicciones/imagenes.
+Responses are cached per data version with ETags (see report_cache.py).
 """
-from fastapi import APIRouter, Depends, Query
+import asyncio
+import os
+import time
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from sqlalchemy import func, case
-from typing import List, Optional
+from sqlalchemy import func, case, text, bindparam, String
+from sqlalchemy.exc import DBAPIError
+from typing import Dict, List, Optional, Tuple
 from pydantic import BaseModel
 from datetime import datetime, date, timedelta
 
 from auth import get_current_user
-from db import get_db, Usuario, Imagen, Prediccion, Ubicacion
+import sketches
+from report_cache import cached_report, fabrica_de_lectura, get_report_db
+from db import (
+    Usuario, Imagen, Prediccion, Ubicacion,
+    RollupDiarioUbicacion, RollupDiarioUsuario, SketchDiarioUbicacion,
+)
+
+# Secciones de /dashboard calculadas a la vez (cada una con su propia conexión)
+REPORTS_DASHBOARD_WORKERS = int(os.getenv("REPORTS_DASHBOARD_WORKERS", "4"))
 
 router = APIRouter()
 
@@ -53,6 +70,23 @@ class PorUbicacionItem(BaseModel):
     pct_smog: float
 
 
+class MapaCelda(BaseModel):
+    celda: str
+    latitud: float
+    longitud: float
+    ubicaciones: int
+    ubicacion_id: Optional[int]
+    total: int
+    smog: int
+    pct_smog: float
+
+
+class MapaResponse(BaseModel):
+    zoom: int
+    tamano_celda: float
+    celdas: List[MapaCelda]
+
+
 class PorUsuarioItem(BaseModel):
     usuario_id: int
     nombre: str
@@ -70,6 +104,25 @@ class TablaResumenRow(BaseModel):
     p_smog_promedio: float
 
 
+class PercentilesItem(BaseModel):
+    periodo: Optional[str]
+    ubicacion_id: Optional[int]
+    n: int
+    percentiles: Dict[str, Optional[float]]
+
+
+class DashboardResponse(BaseModel):
+    kpis: KPIsResponse
+    clase_predicha: List[ClasePredichaItem]
+    tendencia_predicciones: List[TendenciaItem]
+    tendencia_imagenes: List[TendenciaItem]
+    distribucion_confianza: List[HistogramBucket]
+    distribucion_p_smog: List[HistogramBucket]
+    por_ubicacion: List[PorUbicacionItem]
+    por_usuario: List[PorUsuarioItem]
+    tabla_resumen: List[TablaResumenRow]
+
+
 def _parse_date(s: Optional[str]) -> Optional[date]:
     if not s:
         return None
@@ -79,66 +132,94 @@ def _parse_date(s: Optional[str]) -> Optional[date]:
         return None
 
 
-@router.get("/kpis", response_model=KPIsResponse)
-async def get_kpis(
-    current_user: Usuario = Depends(get_current_user),
-    db: Session = Depends(get_db),
-):
-    """Totals and averages for KPI cards and gauge."""
-    total_imagenes = db.query(func.count(Imagen.id)).scalar() or 0
-    total_predicciones = db.query(func.count(Prediccion.id)).scalar() or 0
-
-    smog_count = (
-        db.query(func.count(Prediccion.id))
-        .filter(Prediccion.clase_predicha == "smog")
-        .scalar()
-    ) or 0
-    pct_smog = (smog_count / total_predicciones * 100.0) if total_predicciones else 0.0
-
-    confianza_avg = (
-        db.query(func.avg(Prediccion.confianza)).scalar()
+def _sumas(modelo):
+    return (
+        func.coalesce(func.sum(modelo.imagenes), 0).label("imagenes"),
+        func.coalesce(func.sum(modelo.predicciones), 0).label("predicciones"),
+        func.coalesce(func.sum(modelo.smog), 0).label("smog"),
+        func.coalesce(func.sum(modelo.sin_smog), 0).label("sin_smog"),
+        func.coalesce(func.sum(modelo.suma_confianza), 0).label("suma_confianza"),
+        func.coalesce(func.sum(modelo.suma_p_smog), 0).label("suma_p_smog"),
     )
-    confianza_promedio = float(confianza_avg) if confianza_avg is not None else 0.0
 
-    ubicaciones_activas = (
-        db.query(func.count(func.distinct(Imagen.ubicacion_id)))
-        .filter(Imagen.ubicacion_id.isnot(None))
-        .scalar()
-    ) or 0
 
-    usuarios_activos = (
-        db.query(func.count(func.distinct(Imagen.usuario_id)))
-        .filter(Imagen.usuario_id.isnot(None))
-        .scalar()
-    ) or 0
+def _filtrar_dias(q, columna, desde: Optional[str], hasta: Optional[str]):
+    d = _parse_date(desde)
+    h = _parse_date(hasta)
+    if d is not None:
+        q = q.filter(columna >= d)
+    if h is not None:
+        q = q.filter(columna <= h)
+    return q
+
+
+def kpis(db: Session, desde: Optional[str] = None, hasta: Optional[str] = None) -> KPIsResponse:
+    R = RollupDiarioUbicacion
+    tot = _filtrar_dias(
+        db.query(
+            *_sumas(R),
+            func.count(func.distinct(case(((R.ubicacion_id != 0) & (R.imagenes > 0), R.ubicacion_id)))).label("ubicaciones"),
+        ),
+        R.dia, desde, hasta,
+    ).one()
+
+    usuarios_activos = _filtrar_dias(
+        db.query(func.count(func.distinct(RollupDiarioUsuario.usuario_id)))
+        .filter(RollupDiarioUsuario.usuario_id != 0, RollupDiarioUsuario.imagenes > 0),
+        RollupDiarioUsuario.dia, desde, hasta,
+    ).scalar() or 0
+
+    total_predicciones = int(tot.predicciones)
+    smog_count = int(tot.smog)
+    pct_smog = (smog_count / total_predicciones * 100.0) if total_predicciones else 0.0
+    confianza_promedio = float(tot.suma_confianza) / total_predicciones if total_predicciones else 0.0
 
     return KPIsResponse(
-        total_imagenes=total_imagenes,
+        total_imagenes=int(tot.imagenes),
         total_predicciones=total_predicciones,
         pct_smog=round(pct_smog, 2),
         confianza_promedio=round(confianza_promedio, 4),
-        ubicaciones_activas=ubicaciones_activas,
+        ubicaciones_activas=int(tot.ubicaciones or 0),
         usuarios_activos=usuarios_activos,
     )
 
 
-@router.get("/clase-predicha", response_model=List[ClasePredichaItem])
-async def get_clase_predicha(
+@router.get("/kpis", response_model=KPIsResponse)
+@cached_report
+async def get_kpis(
+    request: Request,
     current_user: Usuario = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_report_db),
 ):
-    """Counts by predicted class (smog / sin_smog) for pie and bar charts."""
-    rows = (
-        db.query(Prediccion.clase_predicha, func.count(Prediccion.id))
-        .group_by(Prediccion.clase_predicha)
-        .all()
-    )
+    """Totals and averages for KPI cards and gauge (read from the daily rollups)."""
+    return await db.run_sync(kpis)
+
+
+def clase_predicha(db: Session, desde: Optional[str] = None, hasta: Optional[str] = None) -> List[ClasePredichaItem]:
+    R = RollupDiarioUbicacion
+    tot = _filtrar_dias(db.query(*_sumas(R)), R.dia, desde, hasta).one()
+    smog = int(tot.smog)
+    sin_smog = int(tot.sin_smog)
+    # Cualquier otro valor de clase_predicha (filas cargadas a mano o de versiones anteriores)
+    otras = int(tot.predicciones) - smog - sin_smog
     return [
-        ClasePredichaItem(clase=clase or "sin_clasificar", cantidad=count)
-        for clase, count in rows
+        ClasePredichaItem(clase=clase, cantidad=count)
+        for clase, count in (("smog", smog), ("sin_smog", sin_smog), ("otras", otras))
+        if count > 0
     ]
 
 
+@router.get("/clase-predicha", response_model=List[ClasePredichaItem])
+@cached_report
+async def get_clase_predicha(
+    request: Request,
+    current_user: Usuario = Depends(get_current_user),
+    db: AsyncSession = Depends(get_report_db),
+):
+    """Counts by predicted class (smog / sin_smog / otras) for pie and bar charts."""
+    return await db.run_sync(clase_predicha)
+
+
 def _truncate_date(column, agrupar: str):
     if agrupar == "mes":
         return func.date_format(column, "%Y-%m")
@@ -148,137 +229,178 @@ def _truncate_date(column, agrupar: str):
     return func.date(column)
 
 
+def tendencia_predicciones(
+    db: Session, desde: Optional[str] = None, hasta: Optional[str] = None, agrupar: str = "dia"
+) -> List[TendenciaItem]:
+    R = RollupDiarioUbicacion
+    col = _truncate_date(R.dia, agrupar)
+    q = (
+        db.query(
+            col.label("periodo"),
+            func.sum(R.predicciones).label("total"),
+            func.sum(R.smog).label("smog"),
+        )
+        .filter(R.predicciones != 0)
+        .group_by(col)
+        .order_by(col)
+    )
+    rows = _filtrar_dias(q, R.dia, desde, hasta).all()
+    return [
+        TendenciaItem(
+            periodo=str(r.periodo),
+            total=int(r.total or 0),
+            smog=int(r.smog or 0),
+            sin_smog=int(r.total or 0) - int(r.smog or 0),
+        )
+        for r in rows
+    ]
+
+
 @router.get("/tendencia-predicciones", response_model=List[TendenciaItem])
+@cached_report
 async def get_tendencia_predicciones(
+    request: Request,
     current_user: Usuario = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_report_db),
     desde: Optional[str] = Query(None, description="YYYY-MM-DD"),
     hasta: Optional[str] = Query(None, description="YYYY-MM-DD"),
     agrupar: str = Query("dia", regex="^(dia|semana|mes)$"),
 ):
     """Time series of prediction counts (total, smog, sin_smog) for line/area charts."""
-    col = _truncate_date(Prediccion.fecha_prediccion, agrupar)
+    return await db.run_sync(tendencia_predicciones, desde, hasta, agrupar)
+
+
+def tendencia_imagenes(
+    db: Session, desde: Optional[str] = None, hasta: Optional[str] = None, agrupar: str = "dia"
+) -> List[TendenciaItem]:
+    R = RollupDiarioUbicacion
+    col = _truncate_date(R.dia, agrupar)
     q = (
         db.query(
             col.label("periodo"),
-            func.count(Prediccion.id).label("total"),
-            func.sum(case((Prediccion.clase_predicha == "smog", 1), else_=0)).label("smog"),
-            func.sum(case((Prediccion.clase_predicha != "smog", 1), else_=0)).label("sin_smog"),
+            func.sum(R.imagenes).label("total"),
         )
+        .filter(R.imagenes != 0)
         .group_by(col)
         .order_by(col)
     )
-    d = _parse_date(desde)
-    h = _parse_date(hasta)
-    if d is not None:
-        q = q.filter(Prediccion.fecha_prediccion >= datetime.combine(d, datetime.min.time()))
-    if h is not None:
-        q = q.filter(Prediccion.fecha_prediccion < datetime.combine(h + timedelta(days=1), datetime.min.time()))
-    rows = q.all()
+    rows = _filtrar_dias(q, R.dia, desde, hasta).all()
     return [
-        TendenciaItem(
-            periodo=str(r.periodo),
-            total=r.total or 0,
-            smog=int(r.smog or 0),
-            sin_smog=int(r.sin_smog or 0),
-        )
+        TendenciaItem(periodo=str(r.periodo), total=int(r.total or 0), smog=0, sin_smog=0)
         for r in rows
     ]
 
 
 @router.get("/tendencia-imagenes", response_model=List[TendenciaItem])
+@cached_report
 async def get_tendencia_imagenes(
+    request: Request,
     current_user: Usuario = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_report_db),
     desde: Optional[str] = Query(None, description="YYYY-MM-DD"),
     hasta: Optional[str] = Query(None, description="YYYY-MM-DD"),
     agrupar: str = Query("dia", regex="^(dia|semana|mes)$"),
 ):
     """Time series of image upload counts (total only; smog/sin_smog = 0 for compatibility)."""
-    col = _truncate_date(Imagen.fecha_subida, agrupar)
+    return await db.run_sync(tendencia_imagenes, desde, hasta, agrupar)
+
+
+def _etiqueta_rango(low: float, high: float) -> str:
+    dec = 1 if all(abs(round(x, 1) - x) < 1e-9 for x in (low, high)) else 2
+    return f"{low:.{dec}f}-{high:.{dec}f}"
+
+
+def histograma(
+    db: Session,
+    columna,
+    bins: int = 5,
+    minimo: float = 0.0,
+    maximo: float = 1.0,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    ubicacion_id: Optional[int] = None,
+    clase: Optional[str] = None,
+) -> List[HistogramBucket]:
+    """
+    Histogram of a Prediccion column with `bins` equal-width bins over [minimo, maximo],
+    computed in a single grouped query. The last bin includes `maximo`; empty bins are
+    returned with cantidad=0.
+    """
+    ancho = (maximo - minimo) / bins
+    # (v - min) * bins / (max - min) evita errores de redondeo de dividir por el ancho
+    bucket = func.least(func.floor((columna - minimo) * bins / (maximo - minimo)), bins - 1)
     q = (
-        db.query(
-            col.label("periodo"),
-            func.count(Imagen.id).label("total"),
-        )
-        .group_by(col)
-        .order_by(col)
+        db.query(bucket.label("bucket"), func.count(Prediccion.id).label("cantidad"))
+        .filter(columna >= minimo, columna <= maximo)
+        .group_by(bucket)
     )
     d = _parse_date(desde)
     h = _parse_date(hasta)
     if d is not None:
-        q = q.filter(Imagen.fecha_subida >= datetime.combine(d, datetime.min.time()))
+        q = q.filter(Prediccion.fecha_prediccion >= datetime.combine(d, datetime.min.time()))
     if h is not None:
-        q = q.filter(Imagen.fecha_subida < datetime.combine(h + timedelta(days=1), datetime.min.time()))
-    rows = q.all()
+        q = q.filter(Prediccion.fecha_prediccion < datetime.combine(h + timedelta(days=1), datetime.min.time()))
+    if clase:
+        q = q.filter(Prediccion.clase_predicha == clase)
+    if ubicacion_id is not None:
+        q = q.join(Imagen, Imagen.id == Prediccion.imagen_id).filter(Imagen.ubicacion_id == ubicacion_id)
+
+    conteos = {int(r.bucket): int(r.cantidad) for r in q.all()}
     return [
-        TendenciaItem(periodo=str(r.periodo), total=r.total or 0, smog=0, sin_smog=0)
-        for r in rows
+        HistogramBucket(
+            rango=_etiqueta_rango(minimo + i * ancho, minimo + (i + 1) * ancho),
+            cantidad=conteos.get(i, 0),
+        )
+        for i in range(bins)
     ]
 
 
-BUCKETS = [(0.0, 0.2), (0.2, 0.4), (0.4, 0.6), (0.6, 0.8), (0.8, 1.01)]
-
-
 @router.get("/distribucion-confianza", response_model=List[HistogramBucket])
+@cached_report
 async def get_distribucion_confianza(
+    request: Request,
     current_user: Usuario = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_report_db),
+    bins: int = Query(5, ge=1, le=100),
+    desde: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    hasta: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    ubicacion_id: Optional[int] = None,
+    clase: Optional[str] = None,
 ):
     """Confidence distribution buckets for histogram."""
-    result = []
-    for low, high in BUCKETS:
-        label = f"{low:.1f}-{high:.1f}" if high <= 1.0 else "0.8-1.0"
-        count = (
-            db.query(func.count(Prediccion.id))
-            .filter(
-                Prediccion.confianza >= low,
-                Prediccion.confianza < high,
-            )
-            .scalar()
-        ) or 0
-        result.append(HistogramBucket(rango=label, cantidad=count))
-    return result
+    return await db.run_sync(
+        histograma, Prediccion.confianza, bins, desde=desde, hasta=hasta, ubicacion_id=ubicacion_id, clase=clase
+    )
 
 
 @router.get("/distribucion-p-smog", response_model=List[HistogramBucket])
+@cached_report
 async def get_distribucion_p_smog(
+    request: Request,
     current_user: Usuario = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_report_db),
+    bins: int = Query(5, ge=1, le=100),
+    desde: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    hasta: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    ubicacion_id: Optional[int] = None,
+    clase: Optional[str] = None,
 ):
     """p_smog distribution buckets for histogram."""
-    result = []
-    for low, high in BUCKETS:
-        label = f"{low:.1f}-{high:.1f}" if high <= 1.0 else "0.8-1.0"
-        count = (
-            db.query(func.count(Prediccion.id))
-            .filter(
-                Prediccion.p_smog >= low,
-                Prediccion.p_smog < high,
-            )
-            .scalar()
-        ) or 0
-        result.append(HistogramBucket(rango=label, cantidad=count))
-    return result
+    return await db.run_sync(
+        histograma, Prediccion.p_smog, bins, desde=desde, hasta=hasta, ubicacion_id=ubicacion_id, clase=clase
+    )
 
 
-@router.get("/por-ubicacion", response_model=List[PorUbicacionItem])
-async def get_por_ubicacion(
-    current_user: Usuario = Depends(get_current_user),
-    db: Session = Depends(get_db),
-):
-    """Counts and % smog per location for bar chart and map."""
-    sub = (
+def por_ubicacion(db: Session, desde: Optional[str] = None, hasta: Optional[str] = None) -> List[PorUbicacionItem]:
+    R = RollupDiarioUbicacion
+    sub = _filtrar_dias(
         db.query(
-            Imagen.ubicacion_id,
-            func.count(Prediccion.id).label("total"),
-            func.sum(case((Prediccion.clase_predicha == "smog", 1), else_=0)).label("smog"),
-        )
-        .join(Prediccion, Imagen.id == Prediccion.imagen_id)
-        .filter(Imagen.ubicacion_id.isnot(None))
-        .group_by(Imagen.ubicacion_id)
-        .subquery()
-    )
+            R.ubicacion_id,
+            func.sum(R.predicciones).label("total"),
+            func.sum(R.smog).label("smog"),
+        ).filter(R.ubicacion_id != 0),
+        R.dia, desde, hasta,
+    ).group_by(R.ubicacion_id).having(func.sum(R.predicciones) > 0).subquery()
     rows = (
         db.query(
             Ubicacion.id,
@@ -296,50 +418,223 @@ async def get_por_ubicacion(
             nombre=None,
             latitud=float(r.latitud),
             longitud=float(r.longitud),
-            total=r.total,
+            total=int(r.total),
             smog=int(r.smog or 0),
-            sin_smog=r.total - int(r.smog or 0),
+            sin_smog=int(r.total) - int(r.smog or 0),
             pct_smog=round(float(r.smog or 0) / float(r.total) * 100.0, 2) if r.total else 0.0,
         )
         for r in rows
     ]
 
 
-@router.get("/por-usuario", response_model=List[PorUsuarioItem])
-async def get_por_usuario(
+@router.get("/por-ubicacion", response_model=List[PorUbicacionItem])
+@cached_report
+async def get_por_ubicacion(
+    request: Request,
     current_user: Usuario = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_report_db),
 ):
-    """Image and prediction counts per user for bar chart."""
-    sub_img = (
-        db.query(
-            Imagen.usuario_id,
-            func.count(Imagen.id).label("img_count"),
+    """Counts and % smog per location for bar chart and map."""
+    return await db.run_sync(por_ubicacion)
+
+
+def _parse_cuantiles(q: str) -> List[float]:
+    try:
+        valores = [float(x) for x in q.split(",") if x.strip()]
+    except ValueError:
+        valores = []
+    if not valores or any(not 0 <= v <= 1 for v in valores):
+        raise HTTPException(status_code=400, detail="q debe ser una lista de cuantiles entre 0 y 1, p.ej. 0.5,0.9,0.99")
+    return valores
+
+
+def percentiles(
+    db: Session,
+    metrica: str,
+    cuantiles: List[float],
+    por: str = "total",
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    ubicacion_id: Optional[int] = None,
+) -> List[PercentilesItem]:
+    S = SketchDiarioUbicacion
+    grupo = {"total": None, "dia": S.dia, "ubicacion": S.ubicacion_id}[por]
+    columnas = [S.bin, func.sum(S.n).label("n")]
+    if grupo is not None:
+        columnas.insert(0, grupo.label("grupo"))
+    consulta = db.query(*columnas).filter(S.metrica == metrica)
+    if ubicacion_id is not None:
+        consulta = consulta.filter(S.ubicacion_id == ubicacion_id)
+    elif por == "ubicacion":
+        consulta = consulta.filter(S.ubicacion_id != 0)
+    consulta = _filtrar_dias(consulta, S.dia, desde, hasta)
+    consulta = consulta.group_by(*([grupo] if grupo is not None else []), S.bin)
+
+    conteos: Dict[object, Dict[int, int]] = {}
+    for r in consulta.all():
+        clave = r.grupo if grupo is not None else None
+        if r.n and r.n > 0:
+            conteos.setdefault(clave, {})[int(r.bin)] = int(r.n)
+
+    return [
+        PercentilesItem(
+            periodo=str(clave) if por == "dia" else None,
+            ubicacion_id=int(clave) if por == "ubicacion" else ubicacion_id,
+            n=sum(c.values()),
+            percentiles=sketches.cuantiles(c, cuantiles),
         )
-        .filter(Imagen.usuario_id.isnot(None))
-        .group_by(Imagen.usuario_id)
-        .subquery()
+        for clave, c in sorted(conteos.items(), key=lambda kv: kv[0] or 0)
+    ]
+
+
+@router.get("/percentiles", response_model=List[PercentilesItem])
+@cached_report
+async def get_percentiles(
+    request: Request,
+    current_user: Usuario = Depends(get_current_user),
+    db: AsyncSession = Depends(get_report_db),
+    metrica: str = Query("p_smog", regex="^(p_smog|confianza)$"),
+    q: str = Query("0.5,0.9,0.99", description="Cuantiles separados por coma"),
+    por: str = Query("total", regex="^(total|dia|ubicacion)$"),
+    desde: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    hasta: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    ubicacion_id: Optional[int] = None,
+):
+    """
+    Percentiles of p_smog or confianza, overall or per day / per location, merged from
+    the daily sketches: cost depends on days x bins, not on the number of predictions.
+    """
+    return await db.run_sync(percentiles, metrica, _parse_cuantiles(q), por, desde, hasta, ubicacion_id)
+
+
+# Celdas por ancho de tile en cada nivel de zoom (tile = 360 / 2^zoom grados)
+CELDAS_POR_TILE = 4
+# La migración 2 puede aplicarse o revertirse con la API corriendo: se vuelve a comprobar cada tanto
+INDICE_ESPACIAL_VIGENCIA = 300.0
+# (instante de la comprobación, resultado)
+_indice_espacial: Tuple[float, Optional[bool]] = (0.0, None)
+
+
+def _usa_indice_espacial(db: Session) -> bool:
+    """True si la migración 2 (columna ubicaciones.coordenadas + SPATIAL INDEX) está aplicada."""
+    global _indice_espacial
+    comprobado, usa = _indice_espacial
+    if usa is None or time.monotonic() - comprobado > INDICE_ESPACIAL_VIGENCIA:
+        from migrations import columna_existe
+        usa = columna_existe(db.connection(), "ubicaciones", "coordenadas")
+        _indice_espacial = (time.monotonic(), usa)
+    return usa
+
+
+def mapa(
+    db: Session,
+    sur: float,
+    oeste: float,
+    norte: float,
+    este: float,
+    zoom: int,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+) -> MapaResponse:
+    global _indice_espacial
+    tamano = 360.0 / (2 ** zoom) / CELDAS_POR_TILE
+    R = RollupDiarioUbicacion
+    fila = func.floor(Ubicacion.latitud / tamano)
+    columna = func.floor(Ubicacion.longitud / tamano)
+    total = func.sum(R.predicciones)
+
+    q = db.query(
+        fila.label("fila"),
+        columna.label("columna"),
+        func.count(func.distinct(Ubicacion.id)).label("ubicaciones"),
+        func.min(Ubicacion.id).label("ubicacion_id"),
+        total.label("total"),
+        func.sum(R.smog).label("smog"),
+        (func.sum(Ubicacion.latitud * R.predicciones) / total).label("latitud"),
+        (func.sum(Ubicacion.longitud * R.predicciones) / total).label("longitud"),
+    ).join(R, R.ubicacion_id == Ubicacion.id)
+    q = _filtrar_dias(q, R.dia, desde, hasta).group_by(fila, columna).having(total > 0)
+
+    def celdas(con_indice: bool):
+        if con_indice:
+            caja = f"POLYGON(({oeste} {sur}, {este} {sur}, {este} {norte}, {oeste} {norte}, {oeste} {sur}))"
+            return q.filter(
+                func.MBRContains(func.ST_GeomFromText(bindparam("wkt", caja, type_=String), 0), text("ubicaciones.coordenadas"))
+            ).all()
+        return q.filter(Ubicacion.latitud.between(sur, norte), Ubicacion.longitud.between(oeste, este)).all()
+
+    con_indice = _usa_indice_espacial(db)
+    try:
+        rows = celdas(con_indice)
+    except DBAPIError:
+        if not con_indice:
+            raise
+        # p. ej. la migración 2 se revirtió: se responde con la caja por latitud/longitud y la próxima consulta vuelve a comprobar
+        db.rollback()
+        _indice_espacial = (0.0, None)
+        rows = celdas(False)
+
+    return MapaResponse(
+        zoom=zoom,
+        tamano_celda=tamano,
+        celdas=[
+            MapaCelda(
+                celda=f"{zoom}:{int(r.fila)}:{int(r.columna)}",
+                latitud=float(r.latitud),
+                longitud=float(r.longitud),
+                ubicaciones=int(r.ubicaciones),
+                ubicacion_id=int(r.ubicacion_id) if r.ubicaciones == 1 else None,
+                total=int(r.total),
+                smog=int(r.smog or 0),
+                pct_smog=round(float(r.smog or 0) / float(r.total) * 100.0, 2),
+            )
+            for r in rows
+        ],
     )
-    sub_pred = (
+
+
+@router.get("/mapa", response_model=MapaResponse)
+@cached_report
+async def get_mapa(
+    request: Request,
+    current_user: Usuario = Depends(get_current_user),
+    db: AsyncSession = Depends(get_report_db),
+    sur: float = Query(..., ge=-90, le=90),
+    oeste: float = Query(..., ge=-180, le=180),
+    norte: float = Query(..., ge=-90, le=90),
+    este: float = Query(..., ge=-180, le=180),
+    zoom: int = Query(..., ge=0, le=22),
+    desde: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    hasta: Optional[str] = Query(None, description="YYYY-MM-DD"),
+):
+    """
+    Locations inside the bounding box aggregated into grid cells sized for the zoom level.
+    Cells holding a single location also return its ubicacion_id.
+    """
+    if sur > norte or oeste > este:
+        raise HTTPException(status_code=400, detail="Caja envolvente inválida")
+    return await db.run_sync(mapa, sur, oeste, norte, este, zoom, desde, hasta)
+
+
+def por_usuario(db: Session, desde: Optional[str] = None, hasta: Optional[str] = None) -> List[PorUsuarioItem]:
+    R = RollupDiarioUsuario
+    sub = _filtrar_dias(
         db.query(
-            Imagen.usuario_id,
-            func.count(Prediccion.id).label("pred_count"),
-        )
-        .join(Prediccion, Imagen.id == Prediccion.imagen_id)
-        .filter(Imagen.usuario_id.isnot(None))
-        .group_by(Imagen.usuario_id)
-        .subquery()
-    )
+            R.usuario_id,
+            func.sum(R.imagenes).label("img_count"),
+            func.sum(R.predicciones).label("pred_count"),
+        ).filter(R.usuario_id != 0),
+        R.dia, desde, hasta,
+    ).group_by(R.usuario_id).subquery()
     rows = (
         db.query(
             Usuario.id,
             Usuario.nombre,
             Usuario.username,
-            func.coalesce(sub_img.c.img_count, 0).label("img_count"),
-            func.coalesce(sub_pred.c.pred_count, 0).label("pred_count"),
+            func.coalesce(sub.c.img_count, 0).label("img_count"),
+            func.coalesce(sub.c.pred_count, 0).label("pred_count"),
         )
-        .outerjoin(sub_img, Usuario.id == sub_img.c.usuario_id)
-        .outerjoin(sub_pred, Usuario.id == sub_pred.c.usuario_id)
+        .outerjoin(sub, Usuario.id == sub.c.usuario_id)
         .all()
     )
     return [
@@ -354,42 +649,98 @@ async def get_por_usuario(
     ]
 
 
-@router.get("/tabla-resumen", response_model=List[TablaResumenRow])
-async def get_tabla_resumen(
+@router.get("/por-usuario", response_model=List[PorUsuarioItem])
+@cached_report
+async def get_por_usuario(
+    request: Request,
     current_user: Usuario = Depends(get_current_user),
-    db: Session = Depends(get_db),
-    desde: Optional[str] = Query(None, description="YYYY-MM-DD"),
-    hasta: Optional[str] = Query(None, description="YYYY-MM-DD"),
-    agrupar: str = Query("dia", regex="^(dia|semana|mes)$"),
+    db: AsyncSession = Depends(get_report_db),
 ):
-    """Summary table by period (total, smog, %, avg confidence, avg p_smog)."""
-    col = _truncate_date(Prediccion.fecha_prediccion, agrupar)
+    """Image and prediction counts per user for bar chart."""
+    return await db.run_sync(por_usuario)
+
+
+def tabla_resumen(
+    db: Session, desde: Optional[str] = None, hasta: Optional[str] = None, agrupar: str = "dia"
+) -> List[TablaResumenRow]:
+    R = RollupDiarioUbicacion
+    col = _truncate_date(R.dia, agrupar)
     q = (
-        db.query(
-            col.label("periodo"),
-            func.count(Prediccion.id).label("total"),
-            func.sum(case((Prediccion.clase_predicha == "smog", 1), else_=0)).label("smog"),
-            func.avg(Prediccion.confianza).label("confianza"),
-            func.avg(Prediccion.p_smog).label("p_smog"),
-        )
+        db.query(col.label("periodo"), *_sumas(R))
+        .filter(R.predicciones != 0)
         .group_by(col)
         .order_by(col)
     )
-    d = _parse_date(desde)
-    h = _parse_date(hasta)
-    if d is not None:
-        q = q.filter(Prediccion.fecha_prediccion >= datetime.combine(d, datetime.min.time()))
-    if h is not None:
-        q = q.filter(Prediccion.fecha_prediccion < datetime.combine(h + timedelta(days=1), datetime.min.time()))
-    rows = q.all()
+    rows = _filtrar_dias(q, R.dia, desde, hasta).all()
     return [
         TablaResumenRow(
             periodo=str(r.periodo),
-            total_predicciones=int(r.total or 0),
+            total_predicciones=int(r.predicciones or 0),
             total_smog=int(r.smog or 0),
-            pct_smog=round(float(r.smog or 0) / float(r.total or 1) * 100.0, 2),
-            confianza_promedio=round(float(r.confianza or 0), 4),
-            p_smog_promedio=round(float(r.p_smog or 0), 4),
+            pct_smog=round(float(r.smog or 0) / float(r.predicciones or 1) * 100.0, 2),
+            confianza_promedio=round(float(r.suma_confianza or 0) / float(r.predicciones or 1), 4),
+            p_smog_promedio=round(float(r.suma_p_smog or 0) / float(r.predicciones or 1), 4),
         )
         for r in rows
     ]
+
+
+@router.get("/tabla-resumen", response_model=List[TablaResumenRow])
+@cached_report
+async def get_tabla_resumen(
+    request: Request,
+    current_user: Usuario = Depends(get_current_user),
+    db: AsyncSession = Depends(get_report_db),
+    desde: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    hasta: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    agrupar: str = Query("dia", regex="^(dia|semana|mes)$"),
+):
+    """Summary table by period (total, smog, %, avg confidence, avg p_smog)."""
+    return await db.run_sync(tabla_resumen, desde, hasta, agrupar)
+
+
+async def _seccion(semaforo: asyncio.Semaphore, fabrica, fn, *args):
+    """Runs one dashboard section on its own session (a session runs one query at a time)."""
+    async with semaforo:
+        t0 = time.perf_counter()
+        async with fabrica() as db:
+            return await db.run_sync(fn, *args), (time.perf_counter() - t0) * 1000
+
+
+@router.get("/dashboard", response_model=DashboardResponse)
+@cached_report
+async def get_dashboard(
+    request: Request,
+    current_user: Usuario = Depends(get_current_user),
+    desde: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    hasta: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    agrupar: str = Query("dia", regex="^(dia|semana|mes)$"),
+    bins: int = Query(5, ge=1, le=100),
+):
+    """
+    All Reportes sections in one response, filtered by the same date range.
+    Sections run concurrently, each on its own connection. The time spent in each goes in the
+    Server-Timing header of computed responses, not in the (cached) body.
+    """
+    t0 = time.perf_counter()
+    semaforo = asyncio.Semaphore(REPORTS_DASHBOARD_WORKERS)
+    fabrica = await fabrica_de_lectura(request)
+    secciones = {
+        "kpis": (kpis, desde, hasta),
+        "clase_predicha": (clase_predicha, desde, hasta),
+        "tendencia_predicciones": (tendencia_predicciones, desde, hasta, agrupar),
+        "tendencia_imagenes": (tendencia_imagenes, desde, hasta, agrupar),
+        "distribucion_confianza": (lambda db: histograma(db, Prediccion.confianza, bins, desde=desde, hasta=hasta),),
+        "distribucion_p_smog": (lambda db: histograma(db, Prediccion.p_smog, bins, desde=desde, hasta=hasta),),
+        "por_ubicacion": (por_ubicacion, desde, hasta),
+        "por_usuario": (por_usuario, desde, hasta),
+        "tabla_resumen": (tabla_resumen, desde, hasta, agrupar),
+    }
+    resultados = await asyncio.gather(
+        *(_seccion(semaforo, fabrica, *args) for args in secciones.values())
+    )
+
+    tiempos = {nombre: r[1] for nombre, r in zip(secciones, resultados)}
+    tiempos["total"] = (time.perf_counter() - t0) * 1000
+    request.state.server_timing = tiempos
+    return DashboardResponse(**{nombre: r[0] for nombre, r in zip(secciones, resultados)})
@@ -0,0 +1,261 @@
+"""
+Tablas de agregados diarios (rollup_diario_ubicacion / rollup_diario_usuario) y
+sketches de cuantiles por día y ubicación (sketch_diario_ubicacion, ver sketches.py).
+
+Se mantienen de forma incremental con un listener before_flush sobre db.AppSession:
+cualquier inserción o actualización de Prediccion/Imagen (cnn_queue, endpoints de
+análisis, trabajos de análisis) suma o resta su aporte en la misma transacción.
+
+Reconstrucción completa (backfill):
+    python rollups.py --rebuild
+"""
+from collections import defaultdict
+from datetime import date, datetime
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import event, func, case, inspect
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.orm import Session
+
+import sketches
+from report_cache import bump_data_version
+from db import (
+    AppSession,
+    SessionLocal,
+    Imagen,
+    Prediccion,
+    RollupDiarioUbicacion,
+    RollupDiarioUsuario,
+    SketchDiarioUbicacion,
+)
+
+COLUMNAS = ("imagenes", "predicciones", "smog", "sin_smog", "suma_confianza", "suma_p_smog")
+
+# (modelo, dia, clave) -> deltas por columna
+Deltas = Dict[Tuple[type, date, int], Dict[str, float]]
+# (dia, ubicacion_id, metrica, bin) -> delta de n
+DeltasSketch = Dict[Tuple[date, int, str, int], int]
+
+
+def _valores(session: Session, obj, attr: str):
+    """(valor confirmado en BD, valor actual) de un atributo."""
+    state = inspect(obj)
+    hist = state.attrs[attr].history
+    nuevo = getattr(obj, attr)
+    if hist.deleted:
+        return hist.deleted[0], nuevo
+    if hist.unchanged:
+        return hist.unchanged[0], nuevo
+    if state.persistent and hist.added:
+        # El atributo estaba expirado (p.ej. tras un commit) cuando se asignó: leer el valor confirmado
+        modelo = type(obj)
+        return session.query(getattr(modelo, attr)).filter(modelo.id == obj.id).scalar(), nuevo
+    return nuevo, nuevo
+
+
+def _dia(valor) -> date:
+    # Días en UTC, como fecha_subida y fecha_prediccion; fecha_prediccion puede ser una expresión SQL hasta el flush
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, date):
+        return valor
+    return datetime.utcnow().date()
+
+
+def _sumar(deltas: Deltas, dia: date, ubicacion_id: Optional[int], usuario_id: Optional[int], signo: int, **valores):
+    for modelo, clave in (
+        (RollupDiarioUbicacion, int(ubicacion_id or 0)),
+        (RollupDiarioUsuario, int(usuario_id or 0)),
+    ):
+        fila = deltas[(modelo, dia, clave)]
+        for col, v in valores.items():
+            fila[col] = fila.get(col, 0) + signo * v
+
+
+def _aporte_prediccion(clase, confianza, p_smog) -> dict:
+    return {
+        "predicciones": 1,
+        "smog": 1 if clase == "smog" else 0,
+        "sin_smog": 1 if clase == "sin_smog" else 0,
+        "suma_confianza": float(confianza or 0),
+        "suma_p_smog": float(p_smog or 0),
+    }
+
+
+def _sumar_sketch(sk: DeltasSketch, dia: date, ubicacion_id: Optional[int], signo: int, confianza, p_smog) -> None:
+    for metrica, valor in (("p_smog", p_smog), ("confianza", confianza)):
+        sk[(dia, int(ubicacion_id or 0), metrica, sketches.bin_de(valor))] += signo
+
+
+def _aplicar_sketch(session: Session, sk: DeltasSketch) -> None:
+    filas = [
+        {"dia": dia, "ubicacion_id": ub, "metrica": metrica, "bin": b, "n": n}
+        for (dia, ub, metrica, b), n in sk.items()
+        if n
+    ]
+    if not filas:
+        return
+    tabla = SketchDiarioUbicacion.__table__
+    stmt = mysql_insert(tabla)
+    session.execute(stmt.on_duplicate_key_update(n=tabla.c.n + stmt.inserted.n), filas)
+
+
+def _aplicar(session: Session, deltas: Deltas) -> None:
+    for (modelo, dia, clave), valores in deltas.items():
+        if not any(valores.values()):
+            continue
+        clave_col = "ubicacion_id" if modelo is RollupDiarioUbicacion else "usuario_id"
+        fila = {c: valores.get(c, 0) for c in COLUMNAS}
+        stmt = mysql_insert(modelo.__table__).values(dia=dia, **{clave_col: clave}, **fila)
+        stmt = stmt.on_duplicate_key_update(
+            **{c: modelo.__table__.c[c] + stmt.inserted[c] for c in COLUMNAS}
+        )
+        session.execute(stmt)
+
+
+def _before_flush(session: Session, flush_context, instances) -> None:
+    deltas: Deltas = defaultdict(dict)
+    sk: DeltasSketch = defaultdict(int)
+    preds_modificadas = set()
+
+    with session.no_autoflush:
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if not isinstance(obj, Prediccion):
+                continue
+            imagen = obj.imagen if obj.imagen is not None else session.get(Imagen, obj.imagen_id)
+            if imagen is None:
+                continue
+            ub_old, ub_new = _valores(session, imagen, "ubicacion_id")
+            us_old, us_new = _valores(session, imagen, "usuario_id")
+            preds_modificadas.add(obj.imagen_id)
+
+            if obj in session.new:
+                _sumar(deltas, _dia(obj.fecha_prediccion), ub_new, us_new, +1,
+                       **_aporte_prediccion(obj.clase_predicha, obj.confianza, obj.p_smog))
+                _sumar_sketch(sk, _dia(obj.fecha_prediccion), ub_new, +1, obj.confianza, obj.p_smog)
+                continue
+
+            clase_old, clase_new = _valores(session, obj, "clase_predicha")
+            conf_old, conf_new = _valores(session, obj, "confianza")
+            p_old, p_new = _valores(session, obj, "p_smog")
+            fecha_old, fecha_new = _valores(session, obj, "fecha_prediccion")
+
+            _sumar(deltas, _dia(fecha_old), ub_old, us_old, -1, **_aporte_prediccion(clase_old, conf_old, p_old))
+            _sumar_sketch(sk, _dia(fecha_old), ub_old, -1, conf_old, p_old)
+            if obj not in session.deleted:
+                _sumar(deltas, _dia(fecha_new), ub_new, us_new, +1, **_aporte_prediccion(clase_new, conf_new, p_new))
+                _sumar_sketch(sk, _dia(fecha_new), ub_new, +1, conf_new, p_new)
+
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if not isinstance(obj, Imagen):
+                continue
+            if obj in session.new:
+                _sumar(deltas, _dia(obj.fecha_subida), obj.ubicacion_id, obj.usuario_id, +1, imagenes=1)
+                continue
+
+            ub_old, ub_new = _valores(session, obj, "ubicacion_id")
+            us_old, us_new = _valores(session, obj, "usuario_id")
+            fecha_old, fecha_new = _valores(session, obj, "fecha_subida")
+            if (ub_old, us_old, _dia(fecha_old)) == (ub_new, us_new, _dia(fecha_new)) and obj not in session.deleted:
+                continue
+
+            _sumar(deltas, _dia(fecha_old), ub_old, us_old, -1, imagenes=1)
+            if obj not in session.deleted:
+                _sumar(deltas, _dia(fecha_new), ub_new, us_new, +1, imagenes=1)
+
+            # Mover el aporte de su predicción si no se procesó arriba
+            if obj.id in preds_modificadas or obj in session.deleted:
+                continue
+            pred = session.query(Prediccion).filter(Prediccion.imagen_id == obj.id).first()
+            if pred is not None:
+                aporte = _aporte_prediccion(pred.clase_predicha, pred.confianza, pred.p_smog)
+                _sumar(deltas, _dia(pred.fecha_prediccion), ub_old, us_old, -1, **aporte)
+                _sumar(deltas, _dia(pred.fecha_prediccion), ub_new, us_new, +1, **aporte)
+                if ub_old != ub_new:
+                    _sumar_sketch(sk, _dia(pred.fecha_prediccion), ub_old, -1, pred.confianza, pred.p_smog)
+                    _sumar_sketch(sk, _dia(pred.fecha_prediccion), ub_new, +1, pred.confianza, pred.p_smog)
+
+        _aplicar(session, deltas)
+        _aplicar_sketch(session, sk)
+
+
+event.listen(AppSession, "before_flush", _before_flush)
+
+
+def _rebuild_sketch(db: Session) -> DeltasSketch:
+    sk: DeltasSketch = defaultdict(int)
+    dia_pred = func.date(Prediccion.fecha_prediccion)
+    for metrica in sketches.METRICAS:
+        columna = getattr(Prediccion, metrica)
+        bucket = func.least(func.greatest(func.floor(columna * sketches.BINS), 0), sketches.BINS - 1)
+        for r in (
+            db.query(dia_pred.label("dia"), Imagen.ubicacion_id, bucket.label("bin"), func.count(Prediccion.id).label("n"))
+            .join(Imagen, Imagen.id == Prediccion.imagen_id)
+            .group_by(dia_pred, Imagen.ubicacion_id, bucket)
+        ):
+            sk[(r.dia, int(r.ubicacion_id or 0), metrica, int(r.bin))] += int(r.n)
+    return sk
+
+
+def rebuild(db: Session) -> None:
+    """Recalcula las tablas de agregados y de sketches desde imagenes y predicciones."""
+    deltas: Deltas = defaultdict(dict)
+
+    dia_img = func.date(Imagen.fecha_subida)
+    for r in (
+        db.query(dia_img.label("dia"), Imagen.ubicacion_id, Imagen.usuario_id, func.count(Imagen.id).label("n"))
+        .group_by(dia_img, Imagen.ubicacion_id, Imagen.usuario_id)
+    ):
+        _sumar(deltas, r.dia, r.ubicacion_id, r.usuario_id, +1, imagenes=r.n)
+
+    dia_pred = func.date(Prediccion.fecha_prediccion)
+    for r in (
+        db.query(
+            dia_pred.label("dia"),
+            Imagen.ubicacion_id,
+            Imagen.usuario_id,
+            func.count(Prediccion.id).label("n"),
+            func.sum(case((Prediccion.clase_predicha == "smog", 1), else_=0)).label("smog"),
+            func.sum(case((Prediccion.clase_predicha == "sin_smog", 1), else_=0)).label("sin_smog"),
+            func.sum(Prediccion.confianza).label("confianza"),
+            func.sum(Prediccion.p_smog).label("p_smog"),
+        )
+        .join(Imagen, Imagen.id == Prediccion.imagen_id)
+        .group_by(dia_pred, Imagen.ubicacion_id, Imagen.usuario_id)
+    ):
+        _sumar(
+            deltas, r.dia, r.ubicacion_id, r.usuario_id, +1,
+            predicciones=int(r.n), smog=int(r.smog or 0), sin_smog=int(r.sin_smog or 0),
+            suma_confianza=float(r.confianza or 0), suma_p_smog=float(r.p_smog or 0),
+        )
+
+    sk = _rebuild_sketch(db)
+
+    db.query(RollupDiarioUbicacion).delete()
+    db.query(RollupDiarioUsuario).delete()
+    db.query(SketchDiarioUbicacion).delete()
+    _aplicar(db, deltas)
+    _aplicar_sketch(db, sk)
+    db.commit()
+    bump_data_version()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from db import engine, Base
+
+    parser = argparse.ArgumentParser(description="Mantenimiento de tablas de agregados diarios")
+    parser.add_argument("--rebuild", action="store_true", help="Reconstruye los agregados desde cero")
+    args = parser.parse_args()
+
+    if not args.rebuild:
+        parser.print_help()
+    else:
+        Base.metadata.create_all(bind=engine)
+        session = SessionLocal()
+        try:
+            rebuild(session)
+            print("✅ Agregados diarios reconstruidos")
+        finally:
+            session.close()
@@ -0,0 +1,45 @@
+"""
+Sketches de cuantiles para p_smog y confianza.
+
+Ambas métricas están acotadas en [0, 1], así que el sketch es un histograma de
+resolución fija: BINS contadores por (día, ubicación, métrica). A diferencia de
+t-digest/KLL admite restas exactas (las predicciones se re-analizan y cambian de
+valor), y dos sketches se combinan sumando contadores. El error de cualquier
+cuantil es como máximo 1 / BINS.
+"""
+from typing import Dict, Iterable, Optional
+
+BINS = 200
+METRICAS = ("p_smog", "confianza")
+
+
+def bin_de(valor) -> int:
+    v = min(max(float(valor or 0), 0.0), 1.0)
+    return min(int(v * BINS), BINS - 1)
+
+
+def cuantil(conteos: Dict[int, int], q: float) -> Optional[float]:
+    """Cuantil q (0..1) interpolando linealmente dentro del intervalo que lo contiene."""
+    total = sum(conteos.values())
+    if total <= 0:
+        return None
+    objetivo = q * total
+    acumulado = 0
+    for b in sorted(conteos):
+        n = conteos[b]
+        if n <= 0:
+            continue
+        if acumulado + n >= objetivo:
+            fraccion = (objetivo - acumulado) / n
+            return round((b + fraccion) / BINS, 4)
+        acumulado += n
+    return 1.0
+
+
+def cuantiles(conteos: Dict[int, int], qs: Iterable[float]) -> Dict[str, Optional[float]]:
+    return {etiqueta(q): cuantil(conteos, q) for q in qs}
+
+
+def etiqueta(q: float) -> str:
+    """0.5 -> 'p50', 0.999 -> 'p99.9'."""
+    return "p" + f"{q * 100:.4f}".rstrip("0").rstrip(".")
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 from pathlib import Path
+from typing import List
 import numpy as np
 import tensorflow as tf
 from PIL import Image
@@ -26,6 +27,19 @@ def preprocess_image(image_path: str) -> np.ndarray:
     arr = np.array(img, dtype=np.float32) / 255.0
     return np.expand_dims(arr, axis=0)
 
+def _resultado(p: float) -> dict:
+    # Por seguridad: clamp
+    p = max(0.0, min(1.0, p))
+
+    clase = "smog" if p >= 0.5 else "sin_smog"
+    confianza = p if clase == "smog" else (1.0 - p)
+
+    return {
+        "clase_predicha": clase,
+        "p_smog": p,
+        "confianza": confianza
+    }
+
 def predict_smog(image_path: str) -> dict:
     """
     Retorna:
@@ -38,16 +52,17 @@ def predict_smog(image_path: str) -> dict:
     y = model.predict(x, verbose=0)
 
     # Caso típico binario: salida (1,1) o (1,) con probabilidad de "smog"
-    p = float(np.squeeze(y))
-
-    # Por seguridad: clamp
-    p = max(0.0, min(1.0, p))
+    return _resultado(float(np.squeeze(y)))
 
-    clase = "smog" if p >= 0.5 else "sin_smog"
-    confianza = p if clase == "smog" else (1.0 - p)
-
-    return {
-        "clase_predicha": clase,
-        "p_smog": p,
-        "confianza": confianza
-    }
+def predict_smog_lote(image_paths: List[str], tamano_lote: int = 32) -> List[dict]:
+    """
+    Igual que predict_smog para varias imágenes, con una llamada al modelo por
+    cada `tamano_lote` imágenes. Retorna un dict por imagen, en el mismo orden.
+    """
+    model = load_model_once()
+    resultados = []
+    for i in range(0, len(image_paths), tamano_lote):
+        x = np.concatenate([preprocess_image(p) for p in image_paths[i:i + tamano_lote]])
+        y = model.predict(x, batch_size=tamano_lote, verbose=0)
+        resultados.extend(_resultado(float(v)) for v in np.reshape(y, (len(x), -1))[:, 0])
+    return resultados
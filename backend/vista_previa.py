@@ -0,0 +1,172 @@
+"""
+Vista previa en vivo (MJPEG) de lo que ve el detector: GET /api/captura/preview.
+
+camera_capture_loop solo deja una referencia al último frame anotado con
+publicar_frame(); nunca codifica ni espera a los clientes. Un hilo aparte, a
+PREVIEW_FPS, reduce el frame a PREVIEW_ANCHO y lo codifica en JPEG una sola vez por
+tick, sin importar cuántos clientes estén mirando. El JPEG se deja además en
+storage/preview.jpg para que los workers que no son líderes (ver liderazgo.py)
+también puedan servirlo.
+
+Cada cliente recibe siempre el frame más reciente: a un cliente lento se le
+descartan los intermedios en lugar de acumularlos. detener() borra preview.jpg y un
+JPEG más viejo que VIGENCIA no se sirve (un líder que murió sin detener la cámara);
+el stream termina tras FIN_SIN_FRAMES segundos sin frames nuevos.
+"""
+import asyncio
+import os
+import threading
+import time
+from typing import Optional, Tuple
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import StreamingResponse
+
+import almacenamiento
+import metrics
+from auth import get_current_user_stream
+from db import Usuario
+
+router = APIRouter()
+
+PREVIEW_FPS = float(os.getenv("PREVIEW_FPS", "5"))
+PREVIEW_ANCHO = int(os.getenv("PREVIEW_ANCHO", "640"))
+PREVIEW_CALIDAD = int(os.getenv("PREVIEW_CALIDAD", "70"))
+PREVIEW_ARCHIVO = os.path.join(almacenamiento.STORAGE_DIR, "preview.jpg")
+BOUNDARY = "frame"
+# Segundos tras los que el último JPEG ya no representa una captura en curso
+VIGENCIA = max(2.0, 5 / PREVIEW_FPS)
+# Sin frames vigentes durante este tiempo (incluye el arranque de la cámara), el stream se cierra
+FIN_SIN_FRAMES = 10.0
+
+# (seq, frame) del detector y (id, jpeg) ya codificado; se reemplazan como tuplas completas
+_frame: Tuple[int, object] = (0, None)
+_jpeg: Tuple[int, Optional[bytes]] = (0, None)
+# Copia del archivo compartido leída por este proceso: (mtime_ns, jpeg)
+_compartido: Tuple[int, Optional[bytes]] = (0, None)
+_activo = False
+_hilo: Optional[threading.Thread] = None
+_clientes = 0
+_lock = threading.Lock()
+
+
+def publicar_frame(frame) -> None:
+    """Llamada por el detector en cada frame; O(1), sin copiar ni codificar."""
+    global _frame
+    _frame = (_frame[0] + 1, frame)
+
+
+def _guardar(jpeg: bytes) -> None:
+    global _jpeg
+    _jpeg = (time.time_ns(), jpeg)
+    tmp = f"{PREVIEW_ARCHIVO}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(jpeg)
+    os.replace(tmp, PREVIEW_ARCHIVO)
+    metrics.increment("preview_frames_codificados")
+
+
+def _codificar() -> None:
+    import cv2
+
+    intervalo = 1.0 / PREVIEW_FPS
+    ultimo = 0
+    while _activo:
+        t0 = time.monotonic()
+        seq, frame = _frame
+        if frame is not None and seq != ultimo:
+            ultimo = seq
+            try:
+                alto, ancho = frame.shape[:2]
+                if ancho > PREVIEW_ANCHO:
+                    frame = cv2.resize(frame, (PREVIEW_ANCHO, alto * PREVIEW_ANCHO // ancho), interpolation=cv2.INTER_AREA)
+                ok, buf = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_CALIDAD])
+                if ok:
+                    _guardar(buf.tobytes())
+            except Exception as e:
+                print(f"⚠️ Vista previa: {e}")
+        time.sleep(max(0.0, intervalo - (time.monotonic() - t0)))
+
+
+def iniciar() -> None:
+    global _activo, _hilo
+    with _lock:
+        if _hilo is not None and _hilo.is_alive():
+            return
+        _activo = True
+        _hilo = threading.Thread(target=_codificar, daemon=True, name="vista-previa")
+        _hilo.start()
+
+
+def detener() -> None:
+    global _activo, _frame, _jpeg
+    _activo = False
+    _frame = (_frame[0], None)
+    _jpeg = (0, None)
+    try:
+        os.remove(PREVIEW_ARCHIVO)
+    except FileNotFoundError:
+        pass
+
+
+def _ultimo_jpeg() -> Tuple[int, Optional[bytes]]:
+    """
+    Último JPEG vigente: el propio si este proceso es el que captura; si no, el del archivo
+    compartido. (0, None) si no hay ninguno de los últimos VIGENCIA segundos.
+    """
+    global _compartido
+    if _activo:
+        ultimo = _jpeg
+    else:
+        try:
+            mtime = os.stat(PREVIEW_ARCHIVO).st_mtime_ns
+            if mtime != _compartido[0]:
+                with open(PREVIEW_ARCHIVO, "rb") as f:
+                    _compartido = (mtime, f.read())
+        except FileNotFoundError:
+            return 0, None
+        ultimo = _compartido
+    # El id es un instante en ns (time_ns o mtime_ns del archivo)
+    if ultimo[1] is None or time.time_ns() - ultimo[0] > VIGENCIA * 1e9:
+        return 0, None
+    return ultimo
+
+
+async def _mjpeg():
+    global _clientes
+    intervalo = 1.0 / PREVIEW_FPS
+    enviado = None
+    ultimo_frame = time.monotonic()
+    _clientes += 1
+    try:
+        while True:
+            ident, jpeg = _ultimo_jpeg()
+            if jpeg:
+                ultimo_frame = time.monotonic()
+            elif time.monotonic() - ultimo_frame > FIN_SIN_FRAMES:
+                # La captura no está corriendo: se cierra en lugar de mantener la conexión abierta
+                metrics.increment("preview_streams_sin_captura")
+                return
+            if jpeg and ident != enviado:
+                enviado = ident
+                # El envío espera al cliente; mientras tanto se publican frames nuevos y los intermedios se pierden
+                yield (
+                    f"--{BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(jpeg)}\r\n\r\n".encode()
+                    + jpeg
+                    + b"\r\n"
+                )
+            await asyncio.sleep(intervalo)
+    finally:
+        _clientes -= 1
+
+
+metrics.register_section("vista_previa", lambda: {"clientes": _clientes, "codificando": _activo, "fps": PREVIEW_FPS})
+
+
+@router.get("/preview")
+async def preview(current_user: Usuario = Depends(get_current_user_stream)):
+    return StreamingResponse(
+        _mjpeg(),
+        media_type=f"multipart/x-mixed-replace; boundary={BOUNDARY}",
+        headers={"Cache-Control": "no-cache, no-store"},
+    )
@@ -0,0 +1,25 @@
+import { useEffect, useRef } from 'react';
+
+type EventHandlers = Record<string, (data: any) => void>;
+
+// Subscribes to the backend pipeline events (GET /api/eventos, Server-Sent Events).
+// EventSource cannot send the Authorization header, so the token goes in the URL; on
+// reconnect it sends Last-Event-ID by itself and the backend replays what was missed.
+export const useEventos = (handlers: EventHandlers) => {
+  const handlersRef = useRef(handlers);
+  handlersRef.current = handlers;
+  const tipos = Object.keys(handlers).join(',');
+
+  useEffect(() => {
+    const token = localStorage.getItem('token') || '';
+    const source = new EventSource(
+      `http://localhost:8000/api/eventos?tipos=${encodeURIComponent(tipos)}&token=${encodeURIComponent(token)}`
+    );
+    tipos.split(',').forEach((tipo) => {
+      source.addEventListener(tipo, (e) => {
+        handlersRef.current[tipo]?.(JSON.parse((e as MessageEvent).data));
+      });
+    });
+    return () => source.close();
+  }, [tipos]);
+};
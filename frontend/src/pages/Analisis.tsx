@@ -18,6 +18,8 @@ const Analisis: React.FC = () => {
   const [analisisData, setAnalisisData] = useState<AnalisisItem[]>([]);
   const [loading, setLoading] = useState(true);
   const [selectedImage, setSelectedImage] = useState<string | null>(null);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [loadingMore, setLoadingMore] = useState(false);
 
   useEffect(() => {
     loadAnalisisData();
@@ -28,6 +30,7 @@ const Analisis: React.FC = () => {
     try {
       const response = await axios.get('http://localhost:8000/api/analisis/emisiones');
       setAnalisisData(response.data);
+      setNextCursor(response.headers['x-next-cursor'] || null);
     } catch (err) {
       console.error('Error loading analysis data:', err);
     } finally {
@@ -35,6 +38,22 @@ const Analisis: React.FC = () => {
     }
   };
 
+  const loadMore = async () => {
+    if (!nextCursor) return;
+    setLoadingMore(true);
+    try {
+      const response = await axios.get('http://localhost:8000/api/analisis/emisiones', {
+        params: { cursor: nextCursor },
+      });
+      setAnalisisData((prev) => [...prev, ...response.data]);
+      setNextCursor(response.headers['x-next-cursor'] || null);
+    } catch (err) {
+      console.error('Error loading more analysis data:', err);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
 
   const formatConfidence = (confidence: number) => {
     return `${(confidence * 100).toFixed(2)}%`;
@@ -99,7 +118,7 @@ const Analisis: React.FC = () => {
                           <div className="flex-shrink-0 h-12 w-12">
                             <img
                               className="h-12 w-12 rounded-lg object-cover cursor-pointer hover:opacity-80 transition-opacity"
-                              src={item.ruta_archivo}
+                              src={`${item.ruta_archivo}?w=160&fmt=webp`}
                               alt={item.filename_original}
                               onClick={() => setSelectedImage(item.ruta_archivo)}
                               onError={(e) => {
@@ -143,6 +162,17 @@ const Analisis: React.FC = () => {
                 </tbody>
               </table>
             )}
+            {!loading && nextCursor && (
+              <div className="text-center py-4 border-t border-gray-200">
+                <button
+                  onClick={loadMore}
+                  disabled={loadingMore}
+                  className="bg-vino text-white px-6 py-2 rounded-lg hover:bg-opacity-90 disabled:opacity-50"
+                >
+                  {loadingMore ? 'Cargando...' : 'Cargar más'}
+                </button>
+              </div>
+            )}
           </div>
         </div>
       </div>
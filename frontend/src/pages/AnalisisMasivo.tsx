@@ -1,17 +1,56 @@
-import React, { useState } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import axios from 'axios';
 
 interface BulkAnalysisResult {
+  job_id: string;
+  estado: string;
+  total: number;
+  omitidas: number;
   processed_count: number;
   success_count: number;
   failed_count: number;
   errors: string[];
 }
 
+const JOBS_URL = 'http://localhost:8000/api/analisis/jobs';
+const ESTADOS_FINALES = ['completado', 'cancelado', 'error'];
+
 const AnalisisMasivo: React.FC = () => {
   const [loading, setLoading] = useState(false);
   const [result, setResult] = useState<BulkAnalysisResult | null>(null);
 
+  const pollRef = useRef<ReturnType<typeof setInterval> | null>(null);
+
+  const stopPolling = () => {
+    if (pollRef.current) {
+      clearInterval(pollRef.current);
+      pollRef.current = null;
+    }
+  };
+
+  useEffect(() => stopPolling, []);
+
+  const pollJob = (jobId: string) => {
+    stopPolling();
+    pollRef.current = setInterval(async () => {
+      try {
+        const response = await axios.get(`${JOBS_URL}/${jobId}`);
+        setResult(response.data);
+        if (ESTADOS_FINALES.includes(response.data.estado)) {
+          stopPolling();
+          setLoading(false);
+          if (response.data.estado === 'completado') {
+            alert('Análisis masivo completado exitosamente');
+          }
+        }
+      } catch (err: any) {
+        console.error('Error polling analysis job:', err);
+        stopPolling();
+        setLoading(false);
+      }
+    }, 2000);
+  };
+
   const handleAnalizarTodas = async () => {
     setLoading(true);
     setResult(null);
@@ -19,15 +58,28 @@ const AnalisisMasivo: React.FC = () => {
     try {
       const response = await axios.post('http://localhost:8000/api/analisis/analizar-todas-hoy');
       setResult(response.data);
-      alert('Análisis masivo completado exitosamente');
+      if (ESTADOS_FINALES.includes(response.data.estado)) {
+        setLoading(false);
+      } else {
+        pollJob(response.data.job_id);
+      }
     } catch (err: any) {
       console.error('Error analyzing all images:', err);
       alert(`Error en el análisis masivo: ${err.response?.data?.detail || 'Error desconocido'}`);
-    } finally {
       setLoading(false);
     }
   };
 
+  const handleCancelar = async () => {
+    if (!result) return;
+    try {
+      const response = await axios.post(`${JOBS_URL}/${result.job_id}/cancelar`);
+      setResult(response.data);
+    } catch (err: any) {
+      console.error('Error cancelling analysis job:', err);
+    }
+  };
+
   return (
     <div className="max-w-4xl mx-auto py-6 sm:px-6 lg:px-8">
       <div className="px-4 py-6 sm:px-0">
@@ -60,9 +112,20 @@ const AnalisisMasivo: React.FC = () => {
               </button>
 
               {loading && (
-                <p className="text-sm text-gray-500 mt-4">
-                  Este proceso puede tomar varios minutos dependiendo del número de imágenes...
-                </p>
+                <>
+                  <p className="text-sm text-gray-500 mt-4">
+                    Este proceso puede tomar varios minutos dependiendo del número de imágenes...
+                    {result && ` (${result.processed_count} de ${result.total})`}
+                  </p>
+                  {result && (
+                    <button
+                      onClick={handleCancelar}
+                      className="mt-3 text-sm text-vino underline hover:opacity-80"
+                    >
+                      Cancelar análisis
+                    </button>
+                  )}
+                </>
               )}
             </div>
 
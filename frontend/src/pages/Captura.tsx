@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import axios from 'axios';
+import { useEventos } from '../hooks/useEventos';
 
 interface CapturedImage {
   filename: string;
@@ -22,16 +23,17 @@ const Captura: React.FC = () => {
   useEffect(() => {
     checkStatus();
     loadImages();
-
-    // Set up interval to refresh images when capture is running
-    const interval = setInterval(() => {
-      if (status.is_running) {
-        loadImages();
-      }
-    }, 3000); // Refresh every 3 seconds when running
-
-    return () => clearInterval(interval);
-  }, [status.is_running]);
+  }, []);
+
+  // Pushed by the backend instead of polling: new captures and camera start/stop
+  useEventos({
+    captura_guardada: (image: CapturedImage) => {
+      setImages((prev) => [image, ...prev.filter((i) => i.url !== image.url)].slice(0, 20));
+    },
+    captura_estado: ({ is_running }: { is_running: boolean }) => {
+      setStatus((prev) => ({ ...prev, is_running }));
+    },
+  });
 
   const checkStatus = async () => {
     try {
@@ -45,9 +47,9 @@ const Captura: React.FC = () => {
   const loadImages = async () => {
     try {
       setRefreshing(true);
-      const response = await axios.get('http://localhost:8000/api/captura/imagenes');
-      // Limit to most recent 20 images to prevent UI overload
-      setImages(response.data.slice(0, 20));
+      // Most recent 20 images only, to prevent UI overload
+      const response = await axios.get('http://localhost:8000/api/captura/imagenes', { params: { limit: 20 } });
+      setImages(response.data);
     } catch (err) {
       console.error('Error loading images:', err);
     } finally {
@@ -138,6 +140,18 @@ const Captura: React.FC = () => {
           )}
         </div>
 
+        {/* Live Preview (MJPEG; <img> cannot send the Authorization header, so the token goes in the URL) */}
+        {status.is_running && (
+          <div className="bg-white rounded-lg shadow-md p-6 mb-8 border border-gray-200">
+            <h2 className="text-xl font-semibold text-vino mb-4">Vista Previa en Vivo</h2>
+            <img
+              src={`http://localhost:8000/api/captura/preview?token=${encodeURIComponent(localStorage.getItem('token') || '')}`}
+              alt="Vista previa del detector"
+              className="w-full max-w-3xl mx-auto rounded-md bg-gray-100"
+            />
+          </div>
+        )}
+
         {/* Images Grid */}
         <div className="bg-white rounded-lg shadow-md p-6 border border-gray-200">
           <div className="flex justify-between items-center mb-4">
@@ -161,7 +175,7 @@ const Captura: React.FC = () => {
                 <div key={image.filename} className="border border-gray-200 rounded-lg overflow-hidden">
                   <div className="aspect-w-4 aspect-h-3 bg-gray-100">
                     <img
-                      src={image.url}
+                      src={`${image.url}?w=480&fmt=webp`}
                       alt={image.filename}
                       className="w-full h-48 object-cover"
                       loading="lazy"
@@ -3,6 +3,7 @@ import axios from 'axios';
 import { MapContainer, TileLayer, Marker, Popup } from 'react-leaflet';
 import L from 'leaflet';
 import 'leaflet/dist/leaflet.css';
+import { useEventos } from '../hooks/useEventos';
 
 // Fix default marker icon in react-leaflet (webpack)
 const defaultIcon = L.icon({
@@ -149,55 +150,61 @@ const ProcesarCapturas: React.FC = () => {
   }, [mapPinPosition, setLocationAndFetchName]);
 
   // ✅ Get CNN processing status
+  const applyCnnStatus = useCallback((data: CnnQueueStatus) => {
+    setCnnStatus(data);
+
+    // Update progress bar based on processing status
+    if (data.running) {
+      const total = data.processed + data.pending;
+      if (total > 0) {
+        const currentProgress = (data.processed / total) * 100;
+        setProgress(currentProgress);
+      }
+    } else if (processingCNN) {
+      // Process finished, set to 100%
+      setProgress(100);
+      setTimeout(() => {
+        setProcessingCNN(false);
+        setProgress(0);
+      }, 1000);
+    }
+
+    // If finished, turn off button state
+    if (!data.running) {
+      setProcessingCNN(false);
+    }
+  }, [processingCNN]);
+
   const loadCnnStatus = useCallback(async () => {
     try {
       const res = await axios.get('http://localhost:8000/api/analisis/estado-cnn');
-      setCnnStatus(res.data);
-
-      // Update progress bar based on processing status
-      if (res.data.running) {
-        const total = res.data.processed + res.data.pending;
-        if (total > 0) {
-          const currentProgress = (res.data.processed / total) * 100;
-          setProgress(currentProgress);
-        }
-      } else if (processingCNN) {
-        // Process finished, set to 100%
-        setProgress(100);
-        setTimeout(() => {
-          setProcessingCNN(false);
-          setProgress(0);
-        }, 1000);
-      }
-
-      // If finished, turn off button state
-      if (!res.data.running) {
-        setProcessingCNN(false);
-      }
+      applyCnnStatus(res.data);
     } catch (err) {
       // If it fails, don't break the UI
       // (for example if endpoint doesn't exist yet)
       // console.error('Error getting CNN status:', err);
     }
-  }, [processingCNN]);
+  }, [applyCnnStatus]);
 
   useEffect(() => {
     loadImages();
+    loadCnnStatus();
+  }, []);
 
-    // ✅ Refresh CNN status always (every 1.5s)
-    const interval = setInterval(() => {
-      loadCnnStatus();
-    }, 1500);
-
-    return () => clearInterval(interval);
-  }, [loadCnnStatus]);
+  // ✅ Queue progress and new captures are pushed by the backend (no polling)
+  useEventos({
+    cola_progreso: applyCnnStatus,
+    captura_guardada: (image: CapturedImage) => {
+      setImages((prev) => [image, ...prev.filter((i) => i.url !== image.url)].slice(0, 20));
+    },
+  });
 
   const loadImages = async () => {
     try {
       setRefreshing(true);
-      const response = await axios.get('http://localhost:8000/api/captura/imagenes');
-      // Limit to most recent 20 images to prevent UI overload
-      setImages(response.data.slice(0, 20));
+      // Most recent 20 images only, to prevent UI overload
+      const response = await axios.get('http://localhost:8000/api/captura/imagenes', { params: { limit: 20 } });
+      setImages(response.data);
     } catch (err) {
       console.error('Error loading images:', err);
     } finally {
@@ -426,7 +433,7 @@ const ProcesarCapturas: React.FC = () => {
                 <div key={image.filename} className="border border-gray-200 rounded-lg overflow-hidden">
                   <div className="aspect-w-4 aspect-h-3 bg-gray-100">
                     <img
-                      src={image.url}
+                      src={`${image.url}?w=480&fmt=webp`}
                       alt={image.filename}
                       className="w-full h-48 object-cover"
                       loading="lazy"
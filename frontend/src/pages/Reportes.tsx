@@ -18,7 +18,8 @@ import {
   RadialBarChart,
   RadialBar,
 } from 'recharts';
-import { MapContainer, TileLayer, CircleMarker, Popup } from 'react-leaflet';
+import { MapContainer, TileLayer, CircleMarker, Popup, useMapEvents } from 'react-leaflet';
+import type { Map as LeafletMap } from 'leaflet';
 import 'leaflet/dist/leaflet.css';
 
 const API_BASE = 'http://localhost:8000/api/reports';
@@ -60,6 +61,23 @@ interface PorUbicacionItem {
   pct_smog: number;
 }
 
+interface MapaCelda {
+  celda: string;
+  latitud: number;
+  longitud: number;
+  ubicaciones: number;
+  ubicacion_id: number | null;
+  total: number;
+  smog: number;
+  pct_smog: number;
+}
+
+interface MapaResponse {
+  zoom: number;
+  tamano_celda: number;
+  celdas: MapaCelda[];
+}
+
 interface PorUsuarioItem {
   usuario_id: number;
   nombre: string;
@@ -77,6 +95,18 @@ interface TablaResumenRow {
   p_smog_promedio: number;
 }
 
+interface DashboardResponse {
+  kpis: KPIs;
+  clase_predicha: ClasePredichaItem[];
+  tendencia_predicciones: TendenciaItem[];
+  tendencia_imagenes: TendenciaItem[];
+  distribucion_confianza: HistogramBucket[];
+  distribucion_p_smog: HistogramBucket[];
+  por_ubicacion: PorUbicacionItem[];
+  por_usuario: PorUsuarioItem[];
+  tabla_resumen: TablaResumenRow[];
+}
+
 const COLORS = ['#7A1E2B', '#2d5a27', '#C6B38E', '#6B1F2B', '#1E1E1E'];
 
 function getSmogColor(pct: number): string {
@@ -85,6 +115,72 @@ function getSmogColor(pct: number): string {
   return '#2d5a27';
 }
 
+function clampLng(lng: number): number {
+  return Math.max(-180, Math.min(180, lng));
+}
+
+// Pide al backend las celdas agregadas del área visible cada vez que el mapa se mueve
+const CeldasMapa: React.FC<{ desde: string; hasta: string }> = ({ desde, hasta }) => {
+  const [celdas, setCeldas] = useState<MapaCelda[]>([]);
+
+  const cargar = useCallback(
+    async (map: LeafletMap) => {
+      const b = map.getBounds();
+      const params: Record<string, string | number> = {
+        sur: Math.max(-90, b.getSouth()),
+        oeste: clampLng(b.getWest()),
+        norte: Math.min(90, b.getNorth()),
+        este: clampLng(b.getEast()),
+        zoom: Math.round(map.getZoom()),
+      };
+      if (desde) params.desde = desde;
+      if (hasta) params.hasta = hasta;
+      try {
+        const res = await axios.get<MapaResponse>(`${API_BASE}/mapa`, { params });
+        setCeldas(res.data.celdas);
+      } catch (err) {
+        console.error('Error cargando celdas del mapa', err);
+      }
+    },
+    [desde, hasta]
+  );
+
+  const map = useMapEvents({
+    moveend: () => cargar(map),
+    zoomend: () => cargar(map),
+  });
+
+  useEffect(() => {
+    cargar(map);
+  }, [cargar, map]);
+
+  return (
+    <>
+      {celdas.map((c) => (
+        <CircleMarker
+          key={c.celda}
+          center={[c.latitud, c.longitud]}
+          radius={8 + Math.min(c.total / 5, 12)}
+          pathOptions={{
+            fillColor: getSmogColor(c.pct_smog),
+            color: '#1E1E1E',
+            weight: 1,
+            fillOpacity: 0.8,
+          }}
+        >
+          <Popup>
+            <strong>
+              {c.ubicacion_id !== null ? `Ubicación ${c.ubicacion_id}` : `${c.ubicaciones} ubicaciones`}
+            </strong>
+            <br />
+            Total: {c.total} | Smog: {c.smog} ({c.pct_smog.toFixed(1)}%)
+          </Popup>
+        </CircleMarker>
+      ))}
+    </>
+  );
+};
+
 const Reportes: React.FC = () => {
   const [desde, setDesde] = useState<string>('');
   const [hasta, setHasta] = useState<string>('');
@@ -111,37 +207,17 @@ const Reportes: React.FC = () => {
     if (hasta) params.hasta = hasta;
 
     try {
-      const [
-        kpisRes,
-        claseRes,
-        tendPredRes,
-        tendImgRes,
-        distConfRes,
-        distSmogRes,
-        ubicRes,
-        userRes,
-        tablaRes,
-      ] = await Promise.all([
-        axios.get<KPIs>(`${API_BASE}/kpis`),
-        axios.get<ClasePredichaItem[]>(`${API_BASE}/clase-predicha`),
-        axios.get<TendenciaItem[]>(`${API_BASE}/tendencia-predicciones`, { params }),
-        axios.get<TendenciaItem[]>(`${API_BASE}/tendencia-imagenes`, { params }),
-        axios.get<HistogramBucket[]>(`${API_BASE}/distribucion-confianza`),
-        axios.get<HistogramBucket[]>(`${API_BASE}/distribucion-p-smog`),
-        axios.get<PorUbicacionItem[]>(`${API_BASE}/por-ubicacion`),
-        axios.get<PorUsuarioItem[]>(`${API_BASE}/por-usuario`),
-        axios.get<TablaResumenRow[]>(`${API_BASE}/tabla-resumen`, { params }),
-      ]);
-
-      setKpis(kpisRes.data);
-      setClasePredicha(claseRes.data);
-      setTendenciaPredicciones(tendPredRes.data);
-      setTendenciaImagenes(tendImgRes.data);
-      setDistribucionConfianza(distConfRes.data);
-      setDistribucionPSmog(distSmogRes.data);
-      setPorUbicacion(ubicRes.data);
-      setPorUsuario(userRes.data);
-      setTablaResumen(tablaRes.data);
+      const { data } = await axios.get<DashboardResponse>(`${API_BASE}/dashboard`, { params });
+
+      setKpis(data.kpis);
+      setClasePredicha(data.clase_predicha);
+      setTendenciaPredicciones(data.tendencia_predicciones);
+      setTendenciaImagenes(data.tendencia_imagenes);
+      setDistribucionConfianza(data.distribucion_confianza);
+      setDistribucionPSmog(data.distribucion_p_smog);
+      setPorUbicacion(data.por_ubicacion);
+      setPorUsuario(data.por_usuario);
+      setTablaResumen(data.tabla_resumen);
     } catch (err: unknown) {
       const msg = axios.isAxiosError(err) ? err.response?.data?.detail || err.message : String(err);
       setError(msg);
@@ -420,25 +496,7 @@ const Reportes: React.FC = () => {
                     style={{ height: '100%', width: '100%' }}
                   >
                     <TileLayer url="https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png" />
-                    {porUbicacion.map((u) => (
-                      <CircleMarker
-                        key={u.ubicacion_id}
-                        center={[u.latitud, u.longitud]}
-                        radius={8 + Math.min(u.total / 5, 12)}
-                        pathOptions={{
-                          fillColor: getSmogColor(u.pct_smog),
-                          color: '#1E1E1E',
-                          weight: 1,
-                          fillOpacity: 0.8,
-                        }}
-                      >
-                        <Popup>
-                          <strong>{u.nombre || `Ubicación ${u.ubicacion_id}`}</strong>
-                          <br />
-                          Total: {u.total} | Smog: {u.smog} ({u.pct_smog.toFixed(1)}%)
-                        </Popup>
-                      </CircleMarker>
-                    ))}
+                    <CeldasMapa desde={desde} hasta={hasta} />
                   </MapContainer>
                 </div>
               ) : (